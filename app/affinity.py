@@ -0,0 +1,43 @@
+import os
+import logging
+from typing import List, Sequence
+
+logger = logging.getLogger(__name__)
+
+
+def available_cores() -> List[int]:
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def plan_core_sets(num_workers: int, threads_per_worker: int = 0) -> List[List[int]]:
+    cores = available_cores()
+    num_workers = max(1, num_workers)
+    if threads_per_worker <= 0:
+        threads_per_worker = max(1, len(cores) // num_workers)
+
+    if num_workers * threads_per_worker > len(cores):
+        logger.warning(
+            f"[Affinity] {num_workers} workers x {threads_per_worker} threads "
+            f"oversubscribe {len(cores)} available cores"
+        )
+
+    plan = []
+    for idx in range(num_workers):
+        start = (idx * threads_per_worker) % len(cores)
+        plan.append([cores[(start + i) % len(cores)] for i in range(threads_per_worker)])
+    return plan
+
+
+def pin_current_thread(cores: Sequence[int]) -> bool:
+    # В Linux sched_setaffinity(0, ...) действует на вызывающий поток,
+    # а потоки OpenMP, созданные им позже, наследуют маску.
+    if not cores or not hasattr(os, "sched_setaffinity"):
+        return False
+    try:
+        os.sched_setaffinity(0, set(cores))
+        return True
+    except OSError as e:
+        logger.warning(f"[Affinity] Failed to pin thread to cores {list(cores)}: {e}")
+        return False
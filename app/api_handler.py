@@ -1,30 +1,59 @@
 import os
-import uuid
+import json
+import asyncio
+import time
 import queue
 import logging
 from pathlib import Path
-from typing import Any, Dict, Optional
+from typing import Any, Dict, List, Optional, Tuple
 
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException
-from fastapi.responses import JSONResponse
-from starlette.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, StreamingResponse
 
 from . import config
+from .payload import build_image_payload, start_spool_sweeper
+from .result_broker import new_task_id
+from .scheduler import PRIORITY_BATCH, QueueFullError
+from .tiling import TILING_MODES
+from .tracing import record_request, server_timing
+from .video import SAMPLING_MODES
 
 logger = logging.getLogger(__name__)
 
 
+def _sse(event: str, payload: Dict[str, Any]) -> str:
+    return f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+def _usage(timing: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    # Сколько токенов модель сгенерировала и сколько из них вошло в ответ
+    if not timing:
+        return {}
+    return {
+        key: timing[key]
+        for key in ("input_tokens", "output_tokens", "used_tokens", "stop_reason", "tiles")
+        if key in timing
+    }
+
+
 class ApiHandler:
     def __init__(
         self,
         task_queue: "queue.Queue[Dict[str, Any]]",
         result_broker,
         storage_dir: str = "uploads",
+        response_cache=None,
+        job_manager=None,
     ) -> None:
         self.task_queue = task_queue
         self.result_broker = result_broker
+        self.response_cache = response_cache
+        self.job_manager = job_manager
         self.storage_dir = Path(storage_dir)
         self.storage_dir.mkdir(parents=True, exist_ok=True)
+        # Периодическая уборка «потерянных» файлов (первый проход — сразу). Только старше VLM_SPOOL_MAX_AGE:
+        # свежие файлы могут принадлежать другому процессу с тем же каталогом, их задачи ещё в очереди
+        start_spool_sweeper(self.storage_dir, max_age=config.SPOOL_MAX_AGE)
 
         app = FastAPI(title="VLM API", version="1.0.0")
         self.app = app
@@ -33,89 +62,208 @@ class ApiHandler:
         async def convert(
             image: Optional[UploadFile] = File(default=None),
             query: str = Form(..., description="User question / prompt"),
+            max_new_tokens: Optional[int] = Form(default=None, description="Token budget, default depends on mode"),
+            model: Optional[str] = Form(default=None, description="Model size, e.g. 256M or 500M; auto = routed by the server"),
         ):
+            started = time.perf_counter()
             if not query or not query.strip():
                 raise HTTPException(status_code=400, detail="'query' is nessesary, it can't be empty.")
+            self._check_budget(max_new_tokens)
+            self._check_model(model)
 
-            if image is None:
-                demo_path = Path(config.DEMO_IMAGE)
-                if not demo_path.exists():
-                    raise HTTPException(
-                        status_code=500,
-                        detail=f"Demo-image was not found by this path: {demo_path}",
-                    )
-                image_path = demo_path
-            else:
-                content_type = (image.content_type or "").lower()
-                if not content_type.startswith("image/"):
-                    raise HTTPException(
-                        status_code=400,
-                        detail=f"Image file is wated, get a type: '{content_type}'.",
-                    )
+            image_payload, raw = await self._resolve_chat_image(image)
+
+            task_id = new_task_id()
+            task = {
+                "id": task_id,
+                **image_payload,
+                "prompt": query,
+                "mode": "chat",  
+                "max_new_tokens": max_new_tokens,
+                "model": model,
+                "source": "api",
+                "priority": PRIORITY_BATCH,
+                "enqueued_at": time.time(),
+            }
+            cached = await asyncio.to_thread(self._enqueue, task, raw, started)
+            if cached is not None:
+                record_request("chat", "api", "cached", started)
+                return {"id": task_id, "result": cached, "cached": True, "model": task.get("model")}
+
+            result = await self._wait_result(task_id, "Time of model wating is finish.", "chat", started)
+            return self._respond(task_id, result, "chat", started, task.get("model"))
+
+        @app.post("/convert/stream")
+        async def convert_stream(
+            image: Optional[UploadFile] = File(default=None),
+            query: str = Form(..., description="User question / prompt"),
+            max_new_tokens: Optional[int] = Form(default=None, description="Token budget, default depends on mode"),
+            model: Optional[str] = Form(default=None, description="Model size, e.g. 256M or 500M; auto = routed by the server"),
+        ):
+            started = time.perf_counter()
+            if not query or not query.strip():
+                raise HTTPException(status_code=400, detail="'query' is nessesary, it can't be empty.")
+            self._check_budget(max_new_tokens)
+            self._check_model(model)
+
+            image_payload, raw = await self._resolve_chat_image(image)
+
+            task_id = new_task_id()
+            task = {
+                "id": task_id,
+                **image_payload,
+                "prompt": query,
+                "mode": "chat",
+                "max_new_tokens": max_new_tokens,
+                "model": model,
+                "stream": True,
+                "source": "api",
+                "priority": PRIORITY_BATCH,
+                "enqueued_at": time.time(),
+            }
+            cached = await asyncio.to_thread(self._enqueue, task, raw, started)
 
-                suffix = Path(image.filename or "").suffix or ".png"
-                fname = f"{uuid.uuid4().hex}{suffix}"
-                image_path = self.storage_dir / fname
+            stream = None if cached is not None else self.result_broker.register_stream_async(task_id)
 
+            async def events():
+                if cached is not None:
+                    record_request("chat", "api", "cached", started)
+                    yield _sse("done", {"id": task_id, "result": cached, "cached": True, "model": task.get("model")})
+                    return
+
+                outcome = "cancelled"
                 try:
-                    raw = await image.read()
-                    image_path.write_bytes(raw)
-                except Exception as e:
-                    logger.exception("I can't find this file")
-                    raise HTTPException(
-                        status_code=500,
-                        detail=f"I can't find this file: {e}",
-                    )
+                    while True:
+                        try:
+                            message = await asyncio.wait_for(stream.get(), timeout=config.INFERENCE_TIMEOUT)
+                        except asyncio.TimeoutError:
+                            outcome = "timeout"
+                            yield _sse("error", {"id": task_id, "error": "Time of model wating is finish."})
+                            return
 
-            task_id = uuid.uuid4().int & ((1 << 31) - 1)
-            self.task_queue.put(
-                {
-                    "id": task_id,
-                    "image_path": str(image_path),
-                    "prompt": query,
-                    "mode": "chat",  
-                }
+                        if "delta" in message:
+                            yield _sse("token", {"id": task_id, "delta": message["delta"]})
+                        elif "error" in message:
+                            outcome = "error"
+                            yield _sse("error", {"id": task_id, "error": message["error"]})
+                            return
+                        else:
+                            outcome = "ok"
+                            done = {"id": task_id, "result": message.get("result", ""), "model": task.get("model")}
+                            usage = _usage(message.get("timing"))
+                            if usage:
+                                done["usage"] = usage
+                            # Заголовки уже отправлены, поэтому разбивка по стадиям едет в самом событии
+                            if config.TIMING_HEADER and message.get("timing"):
+                                done["timing"] = message["timing"]
+                            yield _sse("done", done)
+                            return
+                finally:
+                    record_request("chat", "api", outcome, started)
+                    await self._cancel(task_id)
+
+            return StreamingResponse(
+                events(),
+                media_type="text/event-stream",
+                headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
             )
 
-            waiter = self.result_broker.register(task_id)
+        @app.post("/video")
+        async def video(
+            video: UploadFile = File(..., description="Video clip"),
+            query: str = Form(..., description="Question about the video"),
+            sampling: Optional[str] = Form(default=None, description="uniform | fps | scene"),
+            max_frames: Optional[int] = Form(default=None, description="Frame limit, capped by the server"),
+            max_new_tokens: Optional[int] = Form(default=None, description="Token budget, default depends on mode"),
+            model: Optional[str] = Form(default=None, description="Model size, e.g. 256M or 500M; auto = routed by the server"),
+        ):
+            started = time.perf_counter()
+            if not query or not query.strip():
+                raise HTTPException(status_code=400, detail="'query' is nessesary, it can't be empty.")
 
-            def wait_for_result(timeout: int = config.INFERENCE_TIMEOUT):
-                try:
-                    return waiter.get(timeout=timeout)
-                except queue.Empty:
-                    raise TimeoutError("Time of model wating is finish.")
+            content_type = (video.content_type or "").lower()
+            if not content_type.startswith("video/"):
+                raise HTTPException(status_code=400, detail=f"Video file is wated, get a type: '{content_type}'.")
+            if sampling is not None and sampling not in SAMPLING_MODES:
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"Unknown sampling {sampling!r}, use one of: {', '.join(SAMPLING_MODES)}.",
+                )
+            if max_frames is not None and max_frames < 1:
+                raise HTTPException(status_code=400, detail="'max_frames' must be positive.")
+            self._check_budget(max_new_tokens)
+            self._check_model(model)
 
+            raw = await video.read()
+            if len(raw) > config.VIDEO_MAX_BYTES:
+                raise HTTPException(
+                    status_code=413,
+                    detail=f"Video is larger than {config.VIDEO_MAX_BYTES // (1024 * 1024)} MB.",
+                )
             try:
-                result = await run_in_threadpool(wait_for_result)
-            except TimeoutError as e:
-                raise HTTPException(status_code=504, detail=str(e))
+                # Видео едет через ту же передачу, что и картинки: в памяти или через uploads/
+                payload = build_image_payload(raw, video.filename, self.storage_dir)
+            except Exception as e:
+                logger.exception("I can't save the video")
+                raise HTTPException(status_code=500, detail=f"I can't save this file: {e}")
 
-            if "error" in result:
-                return JSONResponse(
-                    status_code=500,
-                    content={"id": task_id, "error": result["error"]},
-                )
+            task_id = new_task_id()
+            task = {
+                "id": task_id,
+                **payload,
+                "prompt": query,
+                "mode": "video",
+                "sampling": sampling,
+                "max_frames": max_frames,
+                "max_new_tokens": max_new_tokens,
+                "model": model,
+                "source": "api",
+                "priority": PRIORITY_BATCH,
+                "enqueued_at": time.time(),
+            }
+            cached = await asyncio.to_thread(self._enqueue, task, raw, started)
+            if cached is not None:
+                record_request("video", "api", "cached", started)
+                return {"id": task_id, "result": cached, "cached": True, "model": task.get("model")}
+
+            result = await self._wait_result(task_id, "Time of video wating is finish.", "video", started)
+            return self._respond(task_id, result, "video", started, task.get("model"))
 
-            return {"id": task_id, "result": result.get("result", "")}
+        @app.get("/models")
+        async def models():
+            # С RemoteTaskQueue это запрос к брокеру по сети — не в event loop
+            snapshot = getattr(self.task_queue, "snapshot", None)
+            return {"models": await asyncio.to_thread(snapshot) if snapshot is not None else []}
+
+        @app.get("/tasks/{task_id}")
+        async def task_status(task_id: int):
+            position = getattr(self.task_queue, "position", None)
+            info = await asyncio.to_thread(position, task_id) if position is not None else None
+            if info is None:
+                return {"id": task_id, "state": "not_queued"}
+            return {"id": task_id, "state": "queued", **info}
 
         @app.post("/ocr")
         async def ocr(
             image: UploadFile = File(..., description="Изображение с текстом"),
+            max_new_tokens: Optional[int] = Form(default=None, description="Token budget, default depends on mode"),
+            model: Optional[str] = Form(default=None, description="Model size, e.g. 256M or 500M; auto = routed by the server"),
+            tiling: Optional[str] = Form(default=None, description="Document mode: off, auto or on (default VLM_OCR_TILING)"),
         ):
+            started = time.perf_counter()
+            self._check_budget(max_new_tokens)
+            self._check_model(model)
             content_type = (image.content_type or "").lower()
             if not content_type.startswith("image/"):
                 raise HTTPException(
                     status_code=400,
                     detail=f"For OCR we wait image, type: '{content_type}'.",
                 )
-
-            suffix = Path(image.filename or "").suffix or ".png"
-            fname = f"{uuid.uuid4().hex}{suffix}"
-            image_path = self.storage_dir / fname
+            self._check_tiling(tiling)
 
             try:
                 raw = await image.read()
-                image_path.write_bytes(raw)
+                image_payload = build_image_payload(raw, image.filename, self.storage_dir)
             except Exception as e:
                 logger.exception("I can't save the inage")
                 raise HTTPException(
@@ -123,33 +271,205 @@ class ApiHandler:
                     detail=f"I can't save this file: {e}",
                 )
 
-            task_id = uuid.uuid4().int & ((1 << 31) - 1)
-            self.task_queue.put(
-                {
-                    "id": task_id,
-                    "image_path": str(image_path),
-                    "prompt": "",  
-                    "mode": "ocr",
+            task_id = new_task_id()
+            task = {
+                "id": task_id,
+                **image_payload,
+                "prompt": "",  
+                "mode": "ocr",
+                "tiling": tiling.lower() if tiling else None,
+                "max_new_tokens": max_new_tokens,
+                "model": model,
+                "source": "api",
+                "priority": PRIORITY_BATCH,
+                "enqueued_at": time.time(),
+            }
+            cached = await asyncio.to_thread(self._enqueue, task, raw, started)
+            if cached is not None:
+                record_request("ocr", "api", "cached", started)
+                return {"id": task_id, "result": cached, "cached": True, "model": task.get("model")}
+
+            result = await self._wait_result(task_id, "Time of wating OCR is finish.", "ocr", started)
+            return self._respond(task_id, result, "ocr", started, task.get("model"))
+
+        @app.post("/jobs", status_code=202)
+        async def submit_job(
+            images: List[UploadFile] = File(..., description="Images to process, one job item each"),
+            mode: str = Form(default="ocr", description="ocr or chat"),
+            query: Optional[str] = Form(default=None, description="Prompt for every image (chat jobs)"),
+            max_new_tokens: Optional[int] = Form(default=None, description="Token budget, default depends on mode"),
+            model: Optional[str] = Form(default=None, description="Model size, e.g. 256M or 500M; auto = routed by the server"),
+            tiling: Optional[str] = Form(default=None, description="Document mode for OCR: off, auto or on"),
+            webhook: Optional[str] = Form(default=None, description="URL that gets a POST with the job when it finishes"),
+        ):
+            jobs = self._require_jobs()
+            mode = mode.lower()
+            if mode not in ("chat", "ocr"):
+                raise HTTPException(status_code=400, detail=f"Unknown mode {mode!r}, use chat or ocr.")
+            if mode == "chat" and not (query and query.strip()):
+                raise HTTPException(status_code=400, detail="'query' is nessesary for chat jobs.")
+            self._check_budget(max_new_tokens)
+            self._check_model(model)
+            self._check_tiling(tiling)
+            if not images or len(images) > config.JOBS_MAX_ITEMS:
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"A job takes from 1 to {config.JOBS_MAX_ITEMS} images, got {len(images)}.",
+                )
+            if webhook and not webhook.startswith(("http://", "https://")):
+                raise HTTPException(status_code=400, detail="'webhook' must be an http(s) URL.")
+
+            items = []
+            for image in images:
+                content_type = (image.content_type or "").lower()
+                if not content_type.startswith("image/"):
+                    raise HTTPException(
+                        status_code=400,
+                        detail=f"Image file is wated, get a type: '{content_type}' ({image.filename}).",
+                    )
+                task = {
+                    "prompt": query if mode == "chat" else "",
+                    "mode": mode,
+                    "tiling": tiling.lower() if tiling and mode == "ocr" else None,
+                    "max_new_tokens": max_new_tokens,
+                    "model": model,
                 }
+                items.append((task, await image.read()))
+
+            # Одна запись на диск на всё задание; ответ — сразу, не дожидаясь модели
+            job_id = await asyncio.to_thread(jobs.submit, items, webhook or None)
+            return {"id": job_id, "status": "queued", "total": len(items)}
+
+        @app.get("/jobs/{job_id}")
+        async def job_status(job_id: str):
+            job = await asyncio.to_thread(self._require_jobs().get, job_id)
+            if job is None:
+                raise HTTPException(status_code=404, detail=f"Job {job_id} was not found.")
+            return job
+
+        @app.delete("/jobs/{job_id}")
+        async def cancel_job(job_id: str):
+            jobs = self._require_jobs()
+            if not await asyncio.to_thread(jobs.cancel, job_id):
+                raise HTTPException(status_code=404, detail=f"Job {job_id} was not found.")
+            return await asyncio.to_thread(jobs.get, job_id)
+
+    async def _wait_result(self, task_id: int, timeout_detail: str, mode: str, started: float) -> Dict[str, Any]:
+        future = self.result_broker.register_async(task_id)
+        try:
+            return await asyncio.wait_for(future, timeout=config.INFERENCE_TIMEOUT)
+        except asyncio.TimeoutError:
+            await self._cancel(task_id)
+            record_request(mode, "api", "timeout", started)
+            raise HTTPException(status_code=504, detail=timeout_detail)
+        except asyncio.CancelledError:
+            # Клиент отключился
+            await self._cancel(task_id)
+            record_request(mode, "api", "cancelled", started)
+            raise
+
+    def _respond(
+        self, task_id: int, result: Dict[str, Any], mode: str, started: float, model: Optional[str] = None
+    ) -> JSONResponse:
+        headers = {}
+        if config.TIMING_HEADER and result.get("timing"):
+            headers["Server-Timing"] = server_timing(result["timing"])
+
+        if "error" in result:
+            record_request(mode, "api", "error", started)
+            return JSONResponse(
+                status_code=500,
+                content={"id": task_id, "error": result["error"]},
+                headers=headers,
             )
 
-            waiter = self.result_broker.register(task_id)
+        record_request(mode, "api", "ok", started)
+        content: Dict[str, Any] = {"id": task_id, "result": result.get("result", "")}
+        if model is not None:
+            content["model"] = model
+        usage = _usage(result.get("timing"))
+        if usage:
+            content["usage"] = usage
+        return JSONResponse(content=content, headers=headers)
 
-            def wait_for_result(timeout: int = config.INFERENCE_TIMEOUT):
-                try:
-                    return waiter.get(timeout=timeout)
-                except queue.Empty:
-                    raise TimeoutError("Time of wating OCR is finish.")
+    def _check_model(self, model: Optional[str]) -> None:
+        if model is None or model == "auto":
+            return
+        models = getattr(self.task_queue, "models", None) or []
+        if model not in models:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Unknown model {model!r}, use one of: {', '.join(['auto', *models])}.",
+            )
 
-            try:
-                result = await run_in_threadpool(wait_for_result)
-            except TimeoutError as e:
-                raise HTTPException(status_code=504, detail=str(e))
+    @staticmethod
+    def _check_tiling(tiling: Optional[str]) -> None:
+        if tiling is not None and tiling.lower() not in TILING_MODES:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Unknown tiling {tiling!r}, use one of: {', '.join(TILING_MODES)}.",
+            )
+
+    def _require_jobs(self):
+        if self.job_manager is None:
+            raise HTTPException(status_code=503, detail="Jobs are disabled: VLM_JOBS_DB is empty or can't be opened.")
+        return self.job_manager
+
+    @staticmethod
+    def _check_budget(max_new_tokens: Optional[int]) -> None:
+        if max_new_tokens is not None and not 1 <= max_new_tokens <= config.MAX_NEW_TOKENS_LIMIT:
+            raise HTTPException(
+                status_code=400,
+                detail=f"'max_new_tokens' must be between 1 and {config.MAX_NEW_TOKENS_LIMIT}.",
+            )
+
+    def _enqueue(self, task: Dict[str, Any], image_bytes: bytes, started: float) -> Optional[str]:
+        try:
+            if self.response_cache is None:
+                self.task_queue.put(task)
+                return None
+            return self.response_cache.submit(self.task_queue, task, image_bytes)
+        except QueueFullError as e:
+            record_request(task.get("mode", "chat"), "api", "rejected", started)
+            raise HTTPException(
+                status_code=429,
+                detail=f"Server is overloaded: {e.reason} Retry after {e.retry_after_header}s.",
+                headers={"Retry-After": e.retry_after_header},
+            )
+
+    async def _cancel(self, task_id: int) -> None:
+        # Брокер — в памяти, снимаем сразу; очередь может быть удалённой (сеть) или с диском — в потоке
+        self.result_broker.discard(task_id)
+        cancel = getattr(self.task_queue, "cancel", None)
+        if cancel is not None:
+            await asyncio.to_thread(cancel, task_id)
+
+    async def _resolve_chat_image(self, image: Optional[UploadFile]) -> Tuple[Dict[str, Any], bytes]:
+        if image is None:
+            demo_path = Path(config.DEMO_IMAGE)
+            if not demo_path.exists():
+                raise HTTPException(
+                    status_code=500,
+                    detail=f"Demo-image was not found by this path: {demo_path}",
+                )
+            image_payload = {"image_path": str(demo_path)}
+            raw = demo_path.read_bytes()
+        else:
+            content_type = (image.content_type or "").lower()
+            if not content_type.startswith("image/"):
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"Image file is wated, get a type: '{content_type}'.",
+                )
 
-            if "error" in result:
-                return JSONResponse(
+            try:
+                raw = await image.read()
+                image_payload = build_image_payload(raw, image.filename, self.storage_dir)
+            except Exception as e:
+                logger.exception("I can't find this file")
+                raise HTTPException(
                     status_code=500,
-                    content={"id": task_id, "error": result["error"]},
+                    detail=f"I can't find this file: {e}",
                 )
 
-            return {"id": task_id, "result": result.get("result", "")}
+        return image_payload, raw
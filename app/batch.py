@@ -0,0 +1,296 @@
+import argparse
+import json
+import logging
+import math
+import queue
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Set, Tuple
+
+from PIL import Image
+
+from . import config
+from .preprocess import prepare_document, prepare_image
+from .tiling import TILING_MODES, PreparedDocument
+from .video import prepare_video
+
+logger = logging.getLogger(__name__)
+
+IMAGE_SUFFIXES = (".png", ".jpg", ".jpeg", ".webp", ".bmp", ".tif", ".tiff", ".gif")
+
+
+def iter_directory(root: Path, mode: str, prompt: str, recursive: bool) -> Iterator[Dict[str, Any]]:
+    pattern = "**/*" if recursive else "*"
+    for path in sorted(root.glob(pattern)):
+        if path.is_file() and path.suffix.lower() in IMAGE_SUFFIXES:
+            yield {"id": str(path.relative_to(root)), "image": str(path), "mode": mode, "prompt": prompt}
+
+
+def iter_manifest(path: Path, mode: str, prompt: str) -> Iterator[Dict[str, Any]]:
+    # Строка манифеста: {"id": ..., "image": "путь", "prompt": "...", "mode": "ocr|chat|video",
+    # "max_new_tokens": N (необязательно)}; относительные пути считаются от каталога манифеста
+    with path.open(encoding="utf-8") as f:
+        for line_no, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                item = json.loads(line)
+            except json.JSONDecodeError as e:
+                logger.warning(f"[Batch] Skipping bad manifest line {line_no}: {e}")
+                continue
+            image = Path(item.get("image") or item.get("image_path") or "")
+            if not image.is_absolute():
+                image = path.parent / image
+            entry = {
+                "id": str(item.get("id", line_no)),
+                "image": str(image),
+                "mode": item.get("mode", mode),
+                "prompt": item.get("prompt", prompt),
+            }
+            if item.get("max_new_tokens"):
+                entry["max_new_tokens"] = int(item["max_new_tokens"])
+            yield entry
+
+
+def load_done(output: Path) -> Set[str]:
+    # Выходной JSONL и есть чекпоинт: всё, что в нём уже посчитано успешно, повторно не считаем;
+    # элементы с ошибкой пробуем снова (новая строка с тем же id идёт в конец файла).
+    # Недописанную последнюю строку (процесс убили посреди записи) отрезаем.
+    done: Set[str] = set()
+    if not output.exists():
+        return done
+    valid_bytes = 0
+    with output.open("rb") as f:
+        for raw in f:
+            try:
+                record = json.loads(raw)
+            except (json.JSONDecodeError, UnicodeDecodeError):
+                break
+            if not raw.endswith(b"\n"):
+                break
+            valid_bytes += len(raw)
+            if "error" not in record:
+                done.add(str(record.get("id")))
+    if valid_bytes < output.stat().st_size:
+        logger.warning(f"[Batch] Truncating a partial record at the end of {output}")
+        with output.open("r+b") as f:
+            f.truncate(valid_bytes)
+    return done
+
+
+def estimate_tiles(image_path: str, image_processor: Any) -> int:
+    # Сколько тайлов даст нарезка: столько же блоков картинки в промпте.
+    # Размер читается из заголовка файла, без декодирования.
+    try:
+        with Image.open(image_path) as image:
+            width, height = image.size
+    except Exception:
+        return 0
+    if not getattr(image_processor, "do_image_splitting", True):
+        return 1
+    longest = (getattr(image_processor, "size", None) or {}).get("longest_edge")
+    tile = (getattr(image_processor, "max_image_size", None) or {}).get("longest_edge")
+    if not longest or not tile:
+        return 1
+    scale = longest / max(width, height)
+    return math.ceil(height * scale / tile) * math.ceil(width * scale / tile)
+
+
+def bucket_key(item: Dict[str, Any], image_processor: Any) -> Tuple[str, int, int]:
+    # Батчи собираются из похожих задач: тот же режим, столько же тайлов,
+    # близкая длина промпта — так почти нет паддинга
+    if item["mode"] == "video":
+        return ("video", 0, 0)
+    return (item["mode"], estimate_tiles(item["image"], image_processor), len(item["prompt"]) // 64)
+
+
+def plan_batches(items: List[Dict[str, Any]], image_processor: Any, batch_size: int) -> List[List[Dict[str, Any]]]:
+    buckets: Dict[Tuple[str, int, int], List[Dict[str, Any]]] = {}
+    for item in items:
+        buckets.setdefault(bucket_key(item, image_processor), []).append(item)
+
+    batches = []
+    for key in sorted(buckets):
+        group = buckets[key]
+        size = 1 if key[0] == "video" else batch_size
+        for start in range(0, len(group), size):
+            batches.append(group[start:start + size])
+    return batches
+
+
+class BatchRunner:
+    def __init__(
+        self,
+        worker: Any,
+        output: Path,
+        batch_size: int,
+        window: int,
+        prepare_threads: int,
+        max_new_tokens: int | None = None,
+        tiling: str = "off",
+    ) -> None:
+        self.worker = worker
+        self.max_new_tokens = max_new_tokens
+        self.tiling = tiling
+        self.output = output
+        self.batch_size = max(1, batch_size)
+        self.window = max(self.batch_size, window)
+        self.pool = ThreadPoolExecutor(max_workers=max(1, prepare_threads), thread_name_prefix="BatchPrepare")
+        self.processed = 0
+        self.failed = 0
+        self.output_tokens = 0
+        self.used_tokens = 0
+        self.started = time.perf_counter()
+
+    def _prepare(self, item: Dict[str, Any]) -> Any:
+        if item["mode"] == "video":
+            return prepare_video(self.worker, item["image"])
+        if item["mode"] == "ocr" and self.tiling != "off":
+            return prepare_document(self.worker, item["image"], self.tiling)
+        return prepare_image(self.worker, item["image"])
+
+    def _submit(self, batch: List[Dict[str, Any]]) -> List[Any]:
+        return [self.pool.submit(self._prepare, item) for item in batch]
+
+    def _infer(self, batch: List[Dict[str, Any]], prepared: List[Any]) -> List[Dict[str, Any]]:
+        timings: List[Dict[str, Any]] = [{} for _ in batch]
+        budgets = [item.get("max_new_tokens", self.max_new_tokens) for item in batch]
+        if batch[0]["mode"] == "video":
+            text = self.worker.analyze_video(
+                prepared[0], batch[0]["prompt"], timing=timings[0], max_new_tokens=budgets[0]
+            )
+            return [{"result": text, "timing": timings[0]}]
+        # Страницы, разрезанные на полосы, идут поштучно: их полосы и так собираются в батчи
+        texts: Dict[int, str] = {}
+        for i, source in enumerate(prepared):
+            if isinstance(source, PreparedDocument):
+                texts[i] = self.worker.analyze_document(source, timing=timings[i], max_new_tokens=budgets[i])
+        rest = [i for i in range(len(batch)) if i not in texts]
+        if rest:
+            items = [(prepared[i], batch[i]["prompt"], batch[i]["mode"]) for i in rest]
+            results = self.worker.analyze_batch(
+                items, timings=[timings[i] for i in rest], budgets=[budgets[i] for i in rest]
+            )
+            texts.update(zip(rest, results))
+        return [{"result": texts[i], "timing": timing} for i, timing in enumerate(timings)]
+
+    def _run(self, batch: List[Dict[str, Any]], futures: List[Any]) -> List[Dict[str, Any]]:
+        prepared, errors = [], {}
+        for i, future in enumerate(futures):
+            try:
+                prepared.append(future.result())
+            except Exception as e:
+                errors[i] = str(e)
+                prepared.append(None)
+
+        good = [i for i in range(len(batch)) if i not in errors]
+        outputs: Dict[int, Dict[str, Any]] = {i: {"error": err} for i, err in errors.items()}
+        if good:
+            try:
+                for i, out in zip(good, self._infer([batch[i] for i in good], [prepared[i] for i in good])):
+                    outputs[i] = out
+            except Exception as e:
+                if len(good) == 1:
+                    logger.exception(f"[Batch] Item {batch[good[0]]['id']} failed")
+                    outputs[good[0]] = {"error": str(e)}
+                else:
+                    # Как и в воркере: повторяем поштучно, чтобы одна плохая картинка не валила весь батч
+                    logger.exception("[Batch] Batch failed, retrying one by one")
+                    for i in good:
+                        try:
+                            outputs[i] = self._infer([batch[i]], [prepared[i]])[0]
+                        except Exception as item_error:
+                            outputs[i] = {"error": str(item_error)}
+        return [outputs[i] for i in range(len(batch))]
+
+    def run(self, items: Iterator[Dict[str, Any]], done: Set[str]) -> None:
+        pending = (item for item in items if item["id"] not in done)
+        image_processor = self.worker.processor.image_processor
+        with self.output.open("a", encoding="utf-8") as out:
+            while True:
+                window = list(islice(pending, self.window))
+                if not window:
+                    break
+                batches = plan_batches(window, image_processor, self.batch_size)
+                # Следующий батч готовится в пуле, пока модель считает текущий
+                futures = self._submit(batches[0])
+                for idx, batch in enumerate(batches):
+                    next_futures = self._submit(batches[idx + 1]) if idx + 1 < len(batches) else None
+                    outputs = self._run(batch, futures)
+                    for item, result in zip(batch, outputs):
+                        out.write(json.dumps({**item, **result}, ensure_ascii=False) + "\n")
+                        self.failed += "error" in result
+                        timing = result.get("timing") or {}
+                        self.output_tokens += timing.get("output_tokens", 0)
+                        self.used_tokens += timing.get("used_tokens", 0)
+                    # Запись на диск после каждого батча: убитый процесс продолжит с этого места
+                    out.flush()
+                    self.processed += len(batch)
+                    self._report()
+                    futures = next_futures
+        self.pool.shutdown(wait=False)
+
+    def _report(self) -> None:
+        elapsed = time.perf_counter() - self.started
+        rate = self.processed / elapsed if elapsed > 0 else 0.0
+        logger.info(f"[Batch] {self.processed} done ({self.failed} failed), {rate:.2f} images/s")
+
+    def summary(self) -> Dict[str, Any]:
+        elapsed = time.perf_counter() - self.started
+        return {
+            "processed": self.processed,
+            "failed": self.failed,
+            "elapsed_s": round(elapsed, 3),
+            "images_per_s": round(self.processed / elapsed, 3) if elapsed > 0 else 0.0,
+            "output_tokens": self.output_tokens,
+            "used_tokens": self.used_tokens,
+        }
+
+
+def main(argv: List[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="Offline OCR / VQA over a directory of images or a JSONL manifest")
+    parser.add_argument("input", help="Directory with images or a JSONL manifest")
+    parser.add_argument("--output", required=True, help="JSONL file with results; also used to resume")
+    parser.add_argument("--mode", default="ocr", choices=("ocr", "chat", "video"), help="Default task mode")
+    parser.add_argument("--prompt", default="", help="Default prompt for chat / video items")
+    parser.add_argument("--max-new-tokens", type=int, default=None, help="Token budget (default depends on mode)")
+    parser.add_argument("--batch-size", type=int, default=max(4, config.BATCH_MAX_SIZE))
+    parser.add_argument("--window", type=int, default=256, help="Items read ahead and sorted into buckets")
+    parser.add_argument("--prepare-threads", type=int, default=max(1, config.PREPROCESS_THREADS))
+    parser.add_argument("--recursive", action="store_true", help="Walk subdirectories")
+    parser.add_argument("--no-resume", action="store_true", help="Start over instead of skipping finished items")
+    parser.add_argument("--tiling", default=config.OCR_TILING, choices=TILING_MODES, help="Document mode for OCR items")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s] [%(levelname)s] %(name)s: %(message)s")
+
+    source = Path(args.input)
+    if source.is_dir():
+        items = iter_directory(source, args.mode, args.prompt, args.recursive)
+    else:
+        items = iter_manifest(source, args.mode, args.prompt)
+
+    output = Path(args.output)
+    output.parent.mkdir(parents=True, exist_ok=True)
+    if args.no_resume and output.exists():
+        output.unlink()
+    done = load_done(output)
+    if done:
+        logger.info(f"[Batch] Resuming: {len(done)} item(s) already in {output}")
+
+    # Без FastAPI/Gradio: воркер нужен только ради модели и кэшей, его потоки не запускаются
+    from .inference import InferenceWorker
+
+    worker = InferenceWorker(task_queue=queue.Queue(), result_queue=queue.Queue())
+    runner = BatchRunner(
+        worker, output, args.batch_size, args.window, args.prepare_threads, args.max_new_tokens, args.tiling
+    )
+    runner.run(items, done)
+    print(json.dumps(runner.summary()))
+
+
+if __name__ == "__main__":
+    main()
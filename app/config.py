@@ -15,7 +15,49 @@ if MODEL_SIZE not in SMOLVLM2_MODELS:
         f"Use one of: {', '.join(SMOLVLM2_MODELS.keys())}"
     )
 
-MODEL_ID = SMOLVLM2_MODELS[MODEL_SIZE]
+# VLM_MODEL_ID — явный id на Hub или локальный путь (например, крошечная модель для бенчмарков);
+# если задан, VLM_MODEL_SIZE игнорируется
+MODEL_ID = os.getenv("VLM_MODEL_ID") or SMOLVLM2_MODELS[MODEL_SIZE]
+
+# --- Несколько моделей в одном сервере ---
+# VLM_MODELS: какие размеры обслуживать, например "256M,500M"; у каждой своя очередь и воркеры.
+# Пусто — только VLM_MODEL_SIZE. Модель VLM_MODEL_SIZE грузится при старте, остальные — при первом запросе.
+SERVED_MODELS = [m.strip() for m in os.getenv("VLM_MODELS", "").split(",") if m.strip()]
+for _name in SERVED_MODELS:
+    if _name not in SMOLVLM2_MODELS:
+        raise ValueError(f"Invalid model {_name!r} in VLM_MODELS. Use any of: {', '.join(SMOLVLM2_MODELS.keys())}")
+if MODEL_SIZE not in SERVED_MODELS:
+    SERVED_MODELS.insert(0, MODEL_SIZE)
+# Куда отправлять запросы без явной модели, по режиму: "ocr=256M,video=500M"; остальное — на VLM_MODEL_SIZE
+ROUTE_BY_MODE = {
+    mode.strip(): name.strip()
+    for mode, _, name in (item.partition("=") for item in os.getenv("VLM_ROUTE_BY_MODE", "").split(","))
+    if name.strip()
+}
+for _name in ROUTE_BY_MODE.values():
+    if _name not in SERVED_MODELS:
+        raise ValueError(f"VLM_ROUTE_BY_MODE uses {_name!r}, which is not in VLM_MODELS ({', '.join(SERVED_MODELS)})")
+# Если ожидаемое время ответа выбранной модели (очередь + обработка) больше этого, запрос уходит
+# на загруженную модель, которая ответит быстрее (0 = выкл)
+ROUTE_SLO_S = float(os.getenv("VLM_ROUTE_SLO_S", "0"))
+# Бюджет памяти на веса всех моделей, МБ: перед загрузкой простаивающие модели выгружаются (0 = без ограничения)
+MODEL_MEMORY_MB = int(os.getenv("VLM_MODEL_MEMORY_MB", "0"))
+# Выгружать модель, которая простаивает дольше стольких секунд (0 = не выгружать; основная модель не выгружается)
+MODEL_IDLE_UNLOAD_S = float(os.getenv("VLM_MODEL_IDLE_UNLOAD_S", "0"))
+
+# --- Спекулятивное декодирование: черновая модель предлагает токены, основная их проверяет ---
+# VLM_DRAFT_MODEL_SIZE: "" = выкл, "256M" — черновик для 500M (токенизатор у них общий)
+DRAFT_MODEL_SIZE = os.getenv("VLM_DRAFT_MODEL_SIZE", "")
+if DRAFT_MODEL_SIZE and DRAFT_MODEL_SIZE not in SMOLVLM2_MODELS:
+    raise ValueError(
+        f"Invalid VLM_DRAFT_MODEL_SIZE={DRAFT_MODEL_SIZE!r}. "
+        f"Use one of: {', '.join(SMOLVLM2_MODELS.keys())} or leave it empty"
+    )
+DRAFT_MODEL_ID = os.getenv("VLM_DRAFT_MODEL_ID") or SMOLVLM2_MODELS.get(DRAFT_MODEL_SIZE, "")
+# Сколько токенов черновик предлагает за раз; при адаптивном режиме число подстраивается
+# под долю принятых токенов (+2 если приняты все, -1 если нет)
+SPEC_NUM_TOKENS = max(1, int(os.getenv("VLM_SPEC_NUM_TOKENS", "5")))
+SPEC_ADAPTIVE = os.getenv("VLM_SPEC_ADAPTIVE", "1") == "1"
 
 # --- Режим устройства: "auto" | "cuda" | "cpu" ---
 DEVICE_MODE = os.getenv("VLM_DEVICE", "auto").lower()
@@ -38,6 +80,24 @@ DEMO_IMAGE = BASE_DIR / "images" / "cat.jpg"
 MAX_NEW_TOKENS = int(os.getenv("VLM_MAX_NEW_TOKENS", "256"))
 GENERATION_TEMPERATURE = float(os.getenv("VLM_TEMPERATURE", "0.0"))  # 0 = greedy
 
+# --- Бюджет новых токенов по режимам (0 = VLM_MAX_NEW_TOKENS) ---
+# Короткие ответы в чате, длинные для плотных документов; запрос может задать свой,
+# но не больше VLM_MAX_NEW_TOKENS_LIMIT
+CHAT_MAX_NEW_TOKENS = int(os.getenv("VLM_CHAT_MAX_NEW_TOKENS", "0"))
+OCR_MAX_NEW_TOKENS = int(os.getenv("VLM_OCR_MAX_NEW_TOKENS", "1024"))
+VIDEO_MAX_NEW_TOKENS = int(os.getenv("VLM_VIDEO_MAX_NEW_TOKENS", "0"))
+MAX_NEW_TOKENS_LIMIT = int(os.getenv("VLM_MAX_NEW_TOKENS_LIMIT", "2048"))
+
+# --- Ранняя остановка генерации ---
+# Дополнительные стоп-строки для всех режимов, через "|"
+STOP_STRINGS = [s for s in os.getenv("VLM_STOP_STRINGS", "").split("|") if s]
+# После стольких токенов ответ в чате заканчивается на первом конце предложения; 0 = выкл
+CHAT_SOFT_MAX_TOKENS = int(os.getenv("VLM_CHAT_SOFT_MAX_TOKENS", "96"))
+# Поиск зацикливания (чаще всего в OCR): максимальный период повтора (0 = выкл)
+# и минимальная длина петли в токенах
+LOOP_MAX_PERIOD = int(os.getenv("VLM_LOOP_MAX_PERIOD", "32"))
+LOOP_MIN_SPAN = int(os.getenv("VLM_LOOP_MIN_SPAN", "48"))
+
 # --- OCR промпт ---
 OCR_SYSTEM_PROMPT = (
     "You are an OCR engine. Read ALL legible text from the image and "
@@ -45,5 +105,160 @@ OCR_SYSTEM_PROMPT = (
     "Do not add explanations, comments, or extra words."
 )
 
+# --- OCR документов по тайлам ---
+# "off" — страница целиком, "on" — всегда полосами, "auto" — полосами, если процессор
+# уменьшил бы страницу сильнее VLM_OCR_TILE_MIN_SCALE. Запрос может переопределить поле tiling
+OCR_TILING = os.getenv("VLM_OCR_TILING", "off").lower()
+if OCR_TILING not in ("off", "auto", "on"):
+    raise ValueError(f"VLM_OCR_TILING must be off, auto or on, got {OCR_TILING!r}")
+OCR_TILE_MIN_SCALE = float(os.getenv("VLM_OCR_TILE_MIN_SCALE", "0.75"))
+# Перекрытие соседних полос (доля высоты полосы), если разрез не попал в пустой промежуток между строк
+OCR_TILE_OVERLAP = min(0.5, max(0.0, float(os.getenv("VLM_OCR_TILE_OVERLAP", "0.1"))))
+OCR_MAX_TILES = max(1, int(os.getenv("VLM_OCR_MAX_TILES", "8")))
+# Сколько полос одной страницы идёт в один generate()
+OCR_TILE_BATCH = max(1, int(os.getenv("VLM_OCR_TILE_BATCH", "4")))
+
 # Тайм-аут ожидания ответа модели (для API/UI) в секундах
 INFERENCE_TIMEOUT = int(os.getenv("VLM_INFERENCE_TIMEOUT", "120"))
+
+# --- Брокер результатов ---
+# Сколько секунд живут осиротевшие записи: результат без ожидающего, ожидающий без результата,
+# метка отменённой задачи (поздний результат по ней сразу выбрасывается)
+BROKER_TTL_S = float(os.getenv("VLM_BROKER_TTL_S", str(max(300, 2 * INFERENCE_TIMEOUT))))
+# Число независимых частей состояния со своими блокировками
+BROKER_SHARDS = max(1, int(os.getenv("VLM_BROKER_SHARDS", "16")))
+
+# --- Динамический микро-батчинг в InferenceWorker ---
+# Максимальный размер батча (1 = батчинг выключен) и сколько миллисекунд
+# воркер ждёт дополнительные задачи после получения первой.
+BATCH_MAX_SIZE = max(1, int(os.getenv("VLM_BATCH_MAX_SIZE", "1")))
+BATCH_MAX_WAIT_MS = float(os.getenv("VLM_BATCH_MAX_WAIT_MS", "10"))
+
+# --- Кэш признаков изображений (выход vision encoder + connector) ---
+# Лимит памяти в МБ; 0 отключает кэш
+IMAGE_CACHE_MB = int(os.getenv("VLM_IMAGE_CACHE_MB", "256"))
+
+# --- Кэш past_key_values для общих префиксов промпта (OCR-инструкция, картинка в чате) ---
+# Лимит памяти в МБ; 0 отключает кэш
+PREFIX_CACHE_MB = int(os.getenv("VLM_PREFIX_CACHE_MB", "512"))
+
+# --- Кэш готовых ответов (только при GENERATION_TEMPERATURE == 0) ---
+RESPONSE_CACHE_SIZE = int(os.getenv("VLM_RESPONSE_CACHE_SIZE", "1024"))  # записей в памяти, 0 = выкл
+RESPONSE_CACHE_TTL = float(os.getenv("VLM_RESPONSE_CACHE_TTL", "86400"))  # секунд, 0 = бессрочно
+# Путь к sqlite-файлу дискового уровня; пусто = только память
+RESPONSE_CACHE_DB = os.getenv("VLM_RESPONSE_CACHE_DB", "")
+RESPONSE_CACHE_DISK_SIZE = int(os.getenv("VLM_RESPONSE_CACHE_DISK_SIZE", "100000"))
+
+# --- Пул воркеров инференса ---
+# Количество потоков-воркеров, разделяющих одну копию весов и общую task_queue
+NUM_WORKERS = max(1, int(os.getenv("VLM_NUM_WORKERS", "1")))
+# Потоков torch на воркер; 0 = поровну делим доступные ядра
+THREADS_PER_WORKER = int(os.getenv("VLM_THREADS_PER_WORKER", "0"))
+# Закреплять каждого воркера за своим набором ядер (только CPU, Linux)
+PIN_WORKER_CORES = os.getenv("VLM_PIN_WORKER_CORES", "1") == "1"
+
+# --- Очередь допуска (приоритеты, сброс нагрузки) ---
+# Максимум задач в очереди; при переполнении API отвечает 429 + Retry-After
+QUEUE_MAX_DEPTH = int(os.getenv("VLM_QUEUE_MAX_DEPTH", "64"))
+# Начальная оценка времени обработки одной задачи (сек), пока нет статистики
+DEFAULT_SERVICE_TIME = float(os.getenv("VLM_DEFAULT_SERVICE_TIME", "5"))
+
+# --- Передача картинок в очередь ---
+# Загрузки до этого размера передаются воркеру в памяти, крупнее — через файл в uploads/
+SPOOL_THRESHOLD_BYTES = int(os.getenv("VLM_SPOOL_THRESHOLD_MB", "8")) * 1024 * 1024
+# Через сколько секунд «забытые» файлы в uploads/ удаляются
+SPOOL_MAX_AGE = float(os.getenv("VLM_SPOOL_MAX_AGE", "600"))
+
+# --- Распределённая очередь задач ---
+# local — очередь и модель в этом процессе; tcp — здесь только API/UI, задачи уходят брокеру
+# (python -m app.transport broker), модель крутится на отдельных узлах (python -m app.transport worker)
+TRANSPORT = os.getenv("VLM_TRANSPORT", "local").lower()
+if TRANSPORT not in ("local", "tcp"):
+    raise ValueError(f"VLM_TRANSPORT must be 'local' or 'tcp', got {TRANSPORT!r}")
+TASK_BROKER_URL = os.getenv("VLM_TASK_BROKER_URL", "tcp://127.0.0.1:7070")
+# Общий секрет брокера, фронтендов и воркеров: без него брокер не слушает ничего, кроме loopback
+TASK_BROKER_TOKEN = os.getenv("VLM_TASK_BROKER_TOKEN", "")
+# Сколько ждать ответа брокера на постановку задачи; дольше — 429 клиенту
+TRANSPORT_TIMEOUT_S = float(os.getenv("VLM_TRANSPORT_TIMEOUT_S", "5"))
+# Сколько задач брокер держит выданными одному воркер-узлу (0 — 2 x воркеры x размер батча)
+WORKER_PREFETCH = int(os.getenv("VLM_WORKER_PREFETCH", "0"))
+
+# --- Фоновые задания (/ptt/jobs) ---
+# sqlite-файл с заданиями и их картинками; переживает перезапуск сервера. Пусто (по умолчанию) — /ptt/jobs выключен
+JOBS_DB = os.getenv("VLM_JOBS_DB", "")
+# Сколько картинок можно прислать одним заданием
+JOBS_MAX_ITEMS = int(os.getenv("VLM_JOBS_MAX_ITEMS", "256"))
+# Сколько элементов заданий одновременно стоит в очереди допуска (0 — 2 x воркеры x размер батча)
+JOBS_MAX_INFLIGHT = int(os.getenv("VLM_JOBS_MAX_INFLIGHT", "0"))
+# Сколько раз элемент запускается заново, если сервер упал во время его обработки
+JOBS_MAX_ATTEMPTS = max(1, int(os.getenv("VLM_JOBS_MAX_ATTEMPTS", "3")))
+# Сколько хранятся завершённые задания (сек)
+JOBS_TTL_S = float(os.getenv("VLM_JOBS_TTL_S", str(7 * 24 * 3600)))
+# Попыток доставить webhook о завершении задания
+JOBS_WEBHOOK_RETRIES = max(1, int(os.getenv("VLM_JOBS_WEBHOOK_RETRIES", "5")))
+
+# --- Предобработка картинок ---
+# Потоки, которые читают, декодируют и режут картинки до того, как задача попадёт к модели (0 — прямо в воркере)
+PREPROCESS_THREADS = int(os.getenv("VLM_PREPROCESS_THREADS", "2"))
+# Сколько подготовленных задач может ждать модель (0 — 2 x воркеры x размер батча)
+PREPROCESS_QUEUE_SIZE = int(os.getenv("VLM_PREPROCESS_QUEUE_SIZE", "0"))
+
+# --- Квантование на CPU ---
+# "none" (fp32) | "bf16" | "int8-dynamic" | "int8-weight-only" (нужен torchao)
+QUANT = os.getenv("VLM_QUANT", "none").lower()
+# Квантовать ли также vision tower (по умолчанию только языковую модель)
+QUANT_VISION = os.getenv("VLM_QUANT_VISION", "0") == "1"
+
+# --- Движок инференса ---
+# "eager" | "compiled" (torch.compile: vision encoder по пачкам фиксированного размера + декодер)
+ENGINE = os.getenv("VLM_ENGINE", "eager").lower()
+# Размеры пачек картинок для скомпилированного vision encoder: каждая компилируется один раз
+COMPILE_IMAGE_BUCKETS = sorted({max(1, int(x)) for x in os.getenv("VLM_COMPILE_IMAGE_BUCKETS", "1,4,8").split(",") if x.strip()})
+# Режим torch.compile: "default" | "reduce-overhead" | "max-autotune"
+COMPILE_MODE = os.getenv("VLM_COMPILE_MODE", "default")
+# Компилировать ли языковую модель (0 — только vision encoder)
+COMPILE_DECODER = os.getenv("VLM_COMPILE_DECODER", "1") == "1"
+# Статический KV-кэш: шаг декодирования компилируется с фиксированными формами, один граф на (батч, корзину).
+# Нужен для CUDA graphs (VLM_COMPILE_MODE=reduce-overhead); на CPU медленнее динамического — по умолчанию выкл
+COMPILE_STATIC_CACHE = os.getenv("VLM_COMPILE_STATIC_CACHE", "0") == "1"
+# Длины статического кэша (промпт + новые токены); более длинные запросы идут с динамическим кэшем
+COMPILE_CACHE_BUCKETS = sorted({max(1, int(x)) for x in os.getenv("VLM_COMPILE_CACHE_BUCKETS", "1024,2048,4096").split(",") if x.strip()})
+# Скомпилированные ядра: при повторном старте берутся отсюда, а не компилируются заново
+COMPILE_CACHE_DIR = Path(os.getenv("VLM_COMPILE_CACHE_DIR", str(MODEL_CACHE_DIR / "compile")))
+
+# --- Запуск ---
+# Gradio UI на /ui; 0 — только API, gradio даже не импортируется
+ENABLE_UI = os.getenv("VLM_ENABLE_UI", "1") == "1"
+# Сколько запросов UI одновременно ждут модель (0 — 2 x воркеры x размер батча); остальные ждут в очереди Gradio
+UI_CONCURRENCY = int(os.getenv("VLM_UI_CONCURRENCY", "0"))
+# Длина очереди Gradio; сверх неё UI сразу отвечает «очередь заполнена» (0 — без ограничения)
+UI_QUEUE_SIZE = int(os.getenv("VLM_UI_QUEUE_SIZE", "64"))
+# Как часто UI обновляет позицию в очереди и ETA (сек)
+UI_PROGRESS_INTERVAL_S = float(os.getenv("VLM_UI_PROGRESS_INTERVAL_S", "1.0"))
+# Прогрев модели на демо-картинке до того, как /ready станет 200
+WARMUP = os.getenv("VLM_WARMUP", "1") == "1"
+# Снапшот весов в safetensors в целевом dtype: при первом старте пишется, дальше грузится через mmap
+USE_SNAPSHOT = os.getenv("VLM_SNAPSHOT", "0") == "1"
+SNAPSHOT_DIR = Path(os.getenv("VLM_SNAPSHOT_DIR", str(MODEL_CACHE_DIR / "snapshots")))
+
+# --- Трассировка ---
+# 1 — отдавать разбивку задачи по стадиям в заголовке Server-Timing (и в событии done у SSE)
+TIMING_HEADER = os.getenv("VLM_TIMING_HEADER", "0") == "1"
+
+# --- Видео ---
+# Как выбирать кадры: "uniform" (равномерно по ролику), "fps" (не чаще VLM_VIDEO_FPS), "scene" (при смене сцены)
+VIDEO_SAMPLING = os.getenv("VLM_VIDEO_SAMPLING", "fps").lower()
+# Максимум кадров, которые уходят в модель
+VIDEO_MAX_FRAMES = int(os.getenv("VLM_VIDEO_MAX_FRAMES", "32"))
+VIDEO_FPS = float(os.getenv("VLM_VIDEO_FPS", "1.0"))
+# Сторона кадра при декодировании (0 — max_image_size процессора)
+VIDEO_MAX_SIDE = int(os.getenv("VLM_VIDEO_MAX_SIDE", "0"))
+# Средняя разница миниатюр (0..1), после которой кадр считается новой сценой
+VIDEO_SCENE_THRESHOLD = float(os.getenv("VLM_VIDEO_SCENE_THRESHOLD", "0.12"))
+# Кадры, отличающиеся от предыдущего меньше этого порога, выбрасываются как дубликаты (0 — выключено)
+VIDEO_DEDUPE_THRESHOLD = float(os.getenv("VLM_VIDEO_DEDUPE_THRESHOLD", "0.02"))
+# Ограничения на ролик: длительность (сек) и размер загрузки (МБ)
+VIDEO_MAX_DURATION = float(os.getenv("VLM_VIDEO_MAX_DURATION", "600"))
+VIDEO_MAX_BYTES = int(os.getenv("VLM_VIDEO_MAX_MB", "200")) * 1024 * 1024
+# Сколько кадров прогонять через vision encoder за один вызов
+VIDEO_ENCODE_BATCH = int(os.getenv("VLM_VIDEO_ENCODE_BATCH", "8"))
@@ -0,0 +1,371 @@
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Tuple
+
+import torch
+from torch import nn
+from transformers import GenerationConfig, StaticCache
+
+from . import config
+
+logger = logging.getLogger(__name__)
+
+ENGINES = ("eager", "compiled")
+
+
+def validate_engine(name: str) -> str:
+    name = (name or "eager").lower()
+    if name not in ENGINES:
+        raise ValueError(f"Invalid VLM_ENGINE={name!r}. Use one of: {', '.join(ENGINES)}")
+    return name
+
+
+def compile_cache_dir(device: torch.device) -> Path:
+    # Артефакты inductor зависят от версии torch и устройства — держим их раздельно
+    return config.COMPILE_CACHE_DIR / f"torch-{torch.__version__}-{device.type}"
+
+
+def pick_bucket(buckets: List[int], remaining: int) -> int:
+    # Самая большая пачка, которая заполнится целиком; хвост — в наименьшую подходящую
+    full = [size for size in buckets if size <= remaining]
+    if full:
+        return full[-1]
+    return next(size for size in buckets if size >= remaining)
+
+
+class EagerEngine:
+    # Вызовы модели, через которые идёт инференс: признаки картинок, generate() и один проход forward
+    name = "eager"
+
+    def __init__(self, model: nn.Module, device: torch.device) -> None:
+        self.model = model
+        self.device = device
+
+    def image_features(self, pixel_values: torch.Tensor, pixel_attention_mask: torch.Tensor | None) -> torch.Tensor:
+        features = self.model.model.get_image_features(pixel_values, pixel_attention_mask)
+        # В новых версиях transformers возвращается ModelOutput
+        return getattr(features, "pooler_output", features)
+
+    def generate(self, **kwargs: Any) -> torch.Tensor:
+        return self.model.generate(**kwargs)
+
+    def forward(self, **kwargs: Any) -> Any:
+        return self.model(**kwargs)
+
+    def warmup(self) -> None:
+        pass
+
+    def describe(self) -> Dict[str, Any]:
+        return {"engine": self.name}
+
+
+class CompiledEngine(EagerEngine):
+    # torch.compile: vision encoder + connector на пачках фиксированного размера (VLM_COMPILE_IMAGE_BUCKETS),
+    # поэтому каждая форма компилируется один раз на процесс; декодер — с динамическими формами
+    # (длина промпта и KV-кэша меняется на каждом шаге) либо, с VLM_COMPILE_STATIC_CACHE=1, шаг декодирования
+    # над статическим кэшем длины из VLM_COMPILE_CACHE_BUCKETS. Скомпилированное ложится в VLM_COMPILE_CACHE_DIR,
+    # и следующие запуски берут его с диска.
+    name = "compiled"
+
+    def __init__(self, model: nn.Module, device: torch.device) -> None:
+        super().__init__(model, device)
+        self.cache_dir = compile_cache_dir(device)
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            # Импорт transformers уже прописывает в окружение кэш inductor по умолчанию (/tmp/torchinductor_<user>),
+            # а inductor перечитывает переменную при каждой компиляции — поэтому перезаписываем
+            os.environ["TORCHINDUCTOR_CACHE_DIR"] = str(self.cache_dir / "inductor")
+            os.environ["TRITON_CACHE_DIR"] = str(self.cache_dir / "triton")
+        except OSError as e:
+            logger.warning(f"[Engine] Compile cache dir {self.cache_dir} is not writable, compiling from scratch: {e}")
+
+        vision = model.config.vision_config
+        self.image_size = vision.image_size
+        self.patch_size = vision.patch_size
+        self.buckets = config.COMPILE_IMAGE_BUCKETS
+        # Под каждую пачку своя форма, плюс запас на перекомпиляцию декодера и графы статического кэша
+        graphs = len(self.buckets) + 8 + config.BATCH_MAX_SIZE * len(config.COMPILE_CACHE_BUCKETS)
+        torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, graphs)
+        self._vision: Callable[..., torch.Tensor] | None = torch.compile(
+            self._encode_images, dynamic=False, mode=config.COMPILE_MODE
+        )
+        self._lock = threading.Lock()
+        # Первую компиляцию каждой формы делает один поток: трассировка dynamo не потокобезопасна,
+        # а воркеры без прогрева приходят с одной и той же формой одновременно
+        self._compile_lock = threading.Lock()
+        self.compiled_shapes: set = set()
+        self.decoder_shapes: set = set()
+        self.decoder_compiled = False
+        self.static_cache = False
+        self.cache_buckets = config.COMPILE_CACHE_BUCKETS
+        self.static_shapes: set = set()
+        # (батч, длина) -> свободные статические кэши: новый объект кэша dynamo проверяет заново, а память под него
+        # на длинных корзинах заметна, поэтому кэши переиспользуются
+        self._static_pool: Dict[Tuple[int, int], List[Any]] = {}
+        if config.COMPILE_DECODER:
+            self._compile_decoder()
+            self.static_cache = config.COMPILE_STATIC_CACHE and bool(self.cache_buckets)
+
+    def _compile_decoder(self) -> None:
+        # Подменяем forward языковой модели: generate(), префикс-кэш и спекулятивная проверка
+        # идут через него. Если компиляция не удалась, запрос досчитывается eager-версией
+        text_model = self.model.model.text_model
+        eager_forward = text_model.forward
+        compiled_forward = torch.compile(eager_forward, dynamic=True, mode=config.COMPILE_MODE)
+        static_forward = torch.compile(eager_forward, dynamic=False, mode=config.COMPILE_MODE)
+
+        def run(*args: Any, **kwargs: Any) -> Any:
+            try:
+                return compiled_forward(*args, **kwargs)
+            except Exception as e:
+                logger.warning(f"[Engine] Compiled decoder failed, falling back to eager: {e}")
+                text_model.forward = eager_forward
+                self.decoder_compiled = False
+                return eager_forward(*args, **kwargs)
+
+        def run_static(*args: Any, **kwargs: Any) -> Any:
+            if not self.static_cache:
+                # Уже упал: текущие запросы досчитываются eager-версией, новые идут с динамическим кэшем
+                return eager_forward(*args, **kwargs)
+            try:
+                return static_forward(*args, **kwargs)
+            except Exception as e:
+                logger.warning(f"[Engine] Static-cache decoder failed, falling back to the dynamic cache: {e}")
+                self.static_cache = False
+                return eager_forward(*args, **kwargs)
+
+        def forward(*args: Any, **kwargs: Any) -> Any:
+            cache = kwargs.get("past_key_values")
+            if isinstance(cache, StaticCache):
+                inputs = kwargs.get("inputs_embeds")
+                if inputs is None:
+                    inputs = kwargs.get("input_ids")
+                if inputs is None or inputs.shape[1] > 1:
+                    # Prefill над статическим кэшем — eager: длина промпта у каждого запроса своя
+                    return eager_forward(*args, **kwargs)
+                key = (inputs.shape[0], cache.max_cache_len)
+                if key in self.static_shapes:
+                    return run_static(*args, **kwargs)
+                with self._compile_lock:
+                    started = time.perf_counter()
+                    outputs = run_static(*args, **kwargs)
+                    if key not in self.static_shapes and self.static_cache:
+                        self.static_shapes.add(key)
+                        logger.info(
+                            f"[Engine] Static-cache decoder ready for batch={key[0]}, length={key[1]} "
+                            f"in {time.perf_counter() - started:.1f}s"
+                        )
+                return outputs
+
+            key = self._decoder_shape(kwargs)
+            if key in self.decoder_shapes:
+                return run(*args, **kwargs)
+            with self._compile_lock:
+                outputs = run(*args, **kwargs)
+                self.decoder_shapes.add(key)
+            return outputs
+
+        text_model.forward = forward
+        self.decoder_compiled = True
+
+    @staticmethod
+    def _decoder_shape(kwargs: Dict[str, Any]) -> Any:
+        # С dynamic=True dynamo всё равно специализирует размеры 0 и 1: батч из одного запроса
+        # и шаг декодирования (один токен) — отдельные графы, остальные размеры их не перекомпилируют
+        inputs = kwargs.get("inputs_embeds")
+        if inputs is None:
+            inputs = kwargs.get("input_ids")
+        if inputs is None:
+            return None
+        return min(inputs.shape[0], 2), min(inputs.shape[1], 2)
+
+    def _static_length(self, kwargs: Dict[str, Any]) -> int | None:
+        # Статический кэш — только для обычного generate: префикс-кэш приходит со своим DynamicCache
+        if not self.static_cache or kwargs.get("past_key_values") is not None or "input_ids" not in kwargs:
+            return None
+        needed = kwargs["input_ids"].shape[1] + (kwargs.get("max_new_tokens") or config.MAX_NEW_TOKENS)
+        return next((length for length in self.cache_buckets if length >= needed), None)
+
+    def _take_cache(self, batch: int, length: int) -> Any:
+        with self._lock:
+            free = self._static_pool.get((batch, length))
+            if free:
+                return free.pop()
+        return StaticCache(
+            config=self.model.config.text_config,
+            max_batch_size=batch,
+            max_cache_len=length,
+            device=self.device,
+            dtype=next(self.model.parameters()).dtype,
+        )
+
+    def _return_cache(self, cache: Any, batch: int, length: int) -> None:
+        cache.reset()
+        with self._lock:
+            self._static_pool.setdefault((batch, length), []).append(cache)
+
+    def generate(self, **kwargs: Any) -> torch.Tensor:
+        length = self._static_length(kwargs)
+        if length is None:
+            return super().generate(**kwargs)
+        return self._generate_static(length, **kwargs)
+
+    @torch.inference_mode()
+    def _generate_static(self, length: int, **kwargs: Any) -> torch.Tensor:
+        # Кэши пула переиспользуются между запросами: тензоры, созданные под inference_mode,
+        # менять на месте можно только под ним же
+        batch = kwargs["input_ids"].shape[0]
+        try:
+            cache = self._take_cache(batch, length)
+        except Exception as e:
+            # Например, другая сигнатура StaticCache в этой версии transformers
+            logger.warning(f"[Engine] Can't allocate a static KV cache, using the dynamic one: {e}")
+            self.static_cache = False
+            return super().generate(**kwargs)
+        if hasattr(GenerationConfig(), "disable_compile"):
+            # Шаг декодирования компилируем сами; своя автокомпиляция transformers (на CUDA) его бы задвоила
+            kwargs["disable_compile"] = True
+        try:
+            return self.model.generate(past_key_values=cache, **kwargs)
+        finally:
+            self._return_cache(cache, batch, length)
+
+    def _encode_images(self, pixel_values: torch.Tensor, patch_attention_mask: torch.Tensor) -> torch.Tensor:
+        inner = self.model.model
+        hidden = inner.vision_model(pixel_values=pixel_values, patch_attention_mask=patch_attention_mask)
+        return inner.connector(hidden.last_hidden_state)
+
+    def image_features(self, pixel_values: torch.Tensor, pixel_attention_mask: torch.Tensor | None) -> torch.Tensor:
+        height, width = pixel_values.shape[-2:]
+        if self._vision is None or height > self.image_size or width > self.image_size:
+            return super().image_features(pixel_values, pixel_attention_mask)
+
+        # То же, что get_image_features: выбрасываем пустые картинки-заглушки батча процессора
+        images = pixel_values.reshape(-1, *pixel_values.shape[2:])
+        real = images.flatten(1).ne(0).any(dim=1)
+        if not bool(real.any()):
+            real[0] = True
+        images = images[real]
+        if pixel_attention_mask is None:
+            mask = torch.ones((images.shape[0], height, width), dtype=torch.bool, device=images.device)
+        else:
+            mask = pixel_attention_mask.reshape(-1, height, width)[real].bool()
+
+        # Дополняем до квадрата image_size: так делает и процессор, паддинг закрыт маской
+        pad_h, pad_w = self.image_size - height, self.image_size - width
+        if pad_h or pad_w:
+            images = torch.nn.functional.pad(images, (0, pad_w, 0, pad_h))
+            mask = torch.nn.functional.pad(mask, (0, pad_w, 0, pad_h))
+        patches = mask.unfold(1, self.patch_size, self.patch_size).unfold(2, self.patch_size, self.patch_size)
+        patch_mask = patches.sum(dim=(-1, -2)) > 0
+
+        outputs = []
+        start = 0
+        while start < images.shape[0]:
+            size = pick_bucket(self.buckets, images.shape[0] - start)
+            chunk = images[start:start + size]
+            chunk_mask = patch_mask[start:start + size]
+            count = chunk.shape[0]
+            if count < size:
+                # Хвост добиваем копией последней картинки, а не нулями: без полностью замаскированных строк
+                chunk = torch.cat([chunk, chunk[-1:].expand(size - count, *chunk.shape[1:])])
+                chunk_mask = torch.cat([chunk_mask, chunk_mask[-1:].expand(size - count, *chunk_mask.shape[1:])])
+            outputs.append(self._run_vision(chunk, chunk_mask)[:count])
+            start += count
+        return torch.cat(outputs)
+
+    def _run_vision(self, images: torch.Tensor, patch_mask: torch.Tensor) -> torch.Tensor:
+        key = tuple(images.shape)
+        if key in self.compiled_shapes:
+            return self._call_vision(images, patch_mask)
+        with self._compile_lock:
+            # Пока ждали блокировку, эту форму мог скомпилировать другой поток
+            fresh = key not in self.compiled_shapes
+            started = time.perf_counter()
+            features = self._call_vision(images, patch_mask)
+            if fresh and self._vision is not None:
+                with self._lock:
+                    self.compiled_shapes.add(key)
+                logger.info(f"[Engine] Vision encoder ready for {key[0]} image(s) in {time.perf_counter() - started:.1f}s")
+        return features
+
+    def _call_vision(self, images: torch.Tensor, patch_mask: torch.Tensor) -> torch.Tensor:
+        vision = self._vision
+        if vision is None:
+            return self._encode_images(images, patch_mask)
+        try:
+            return vision(images, patch_mask)
+        except Exception as e:
+            logger.warning(f"[Engine] Compiled vision encoder failed, falling back to eager: {e}")
+            self._vision = None
+            return self._encode_images(images, patch_mask)
+
+    @torch.inference_mode()
+    def warmup(self) -> None:
+        # Компилируем все размеры пачек заранее, чтобы первый запрос каждой формы не ждал компиляцию
+        started = time.perf_counter()
+        dtype = next(self.model.parameters()).dtype
+        for size in self.buckets:
+            images = torch.randn(size, 3, self.image_size, self.image_size, device=self.device, dtype=dtype)
+            side = self.image_size // self.patch_size
+            self._run_vision(images, torch.ones(size, side, side, dtype=torch.bool, device=self.device))
+            if self._vision is None:
+                break
+        logger.info(f"[Engine] Compiled vision buckets {self.buckets} in {time.perf_counter() - started:.1f}s ✅")
+        if self.decoder_compiled:
+            self._warmup_decoder()
+
+    def _warmup_decoder(self) -> None:
+        # Короткий generate без картинки: prefill и шаг декодирования, для одного запроса и для батча
+        started = time.perf_counter()
+        token_id = self.model.generation_config.bos_token_id or 0
+        pad_id = self.model.generation_config.pad_token_id
+        for batch in sorted({1, min(2, config.BATCH_MAX_SIZE)}):
+            input_ids = torch.full((batch, 8), token_id, dtype=torch.long, device=self.device)
+            self.model.generate(
+                input_ids=input_ids,
+                attention_mask=torch.ones_like(input_ids),
+                max_new_tokens=2,
+                min_new_tokens=2,
+                do_sample=False,
+                pad_token_id=token_id if pad_id is None else pad_id,
+            )
+            if not self.decoder_compiled:
+                break
+            # Шаг декодирования над статическим кэшем — под каждую корзину
+            for length in self.cache_buckets:
+                if not self.static_cache:
+                    break
+                self._generate_static(
+                    length,
+                    input_ids=input_ids,
+                    attention_mask=torch.ones_like(input_ids),
+                    max_new_tokens=2,
+                    min_new_tokens=2,
+                    do_sample=False,
+                    pad_token_id=token_id if pad_id is None else pad_id,
+                )
+        logger.info(f"[Engine] Compiled decoder in {time.perf_counter() - started:.1f}s ✅")
+
+    def describe(self) -> Dict[str, Any]:
+        return {
+            "engine": self.name,
+            "buckets": self.buckets,
+            "compiled_shapes": sorted(shape[0] for shape in self.compiled_shapes),
+            "vision_compiled": self._vision is not None,
+            "decoder_compiled": self.decoder_compiled,
+            "static_cache": self.static_cache,
+            "cache_buckets": self.cache_buckets if self.static_cache else [],
+            "static_shapes": sorted(self.static_shapes),
+            "cache_dir": os.environ.get("TORCHINDUCTOR_CACHE_DIR"),
+        }
+
+
+def create_engine(name: str, model: nn.Module, device: torch.device) -> EagerEngine:
+    name = validate_engine(name)
+    if name == "compiled":
+        return CompiledEngine(model, device)
+    return EagerEngine(model, device)
@@ -0,0 +1,106 @@
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+import torch
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class CachedImage:
+    __slots__ = ("key", "features", "rows", "cols", "draft_features", "nbytes")
+
+    def __init__(
+        self,
+        key: str,
+        features: torch.Tensor,
+        rows: int,
+        cols: int,
+        draft_features: Optional[torch.Tensor] = None,
+    ) -> None:
+        # features: (num_patches, image_seq_len, hidden) — выход коннектора;
+        # draft_features — то же для черновой модели спекулятивного декодирования
+        self.key = key
+        self.features = features
+        self.rows = rows
+        self.cols = cols
+        self.draft_features = draft_features
+        self.nbytes = sum(
+            t.element_size() * t.nelement() for t in (features, draft_features) if t is not None
+        )
+
+
+class ImageFeatureCache:
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max(0, int(max_bytes))
+        self._entries: "OrderedDict[str, CachedImage]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        metrics.REGISTRY.gauge_callback(
+            "vlm_image_cache_bytes",
+            "Memory held by cached image features.",
+            lambda: self.current_bytes,
+        )
+        metrics.REGISTRY.gauge_callback(
+            "vlm_image_cache_entries",
+            "Number of images in the feature cache.",
+            lambda: len(self._entries),
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    @staticmethod
+    def make_key(image_bytes: bytes, namespace: str) -> str:
+        h = hashlib.sha256()
+        h.update(namespace.encode("utf-8"))
+        h.update(b"\0")
+        h.update(image_bytes)
+        return h.hexdigest()
+
+    def get(self, key: str) -> Optional[CachedImage]:
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+            else:
+                self._entries.move_to_end(key)
+                self.hits += 1
+        metrics.IMAGE_CACHE_REQUESTS.inc(result="miss" if entry is None else "hit")
+        return entry
+
+    def put(self, key: str, entry: CachedImage) -> None:
+        if not self.enabled or entry.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.current_bytes -= old.nbytes
+            self._entries[key] = entry
+            self.current_bytes += entry.nbytes
+            while self.current_bytes > self.max_bytes and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self.current_bytes -= evicted.nbytes
+                self.evictions += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
@@ -1,18 +1,55 @@
 import os
+import json
+import time
 import queue
 import threading
 import logging
 from pathlib import Path
-from typing import Dict, Any
+from typing import Dict, Any, List, Tuple
 
 import torch
-from transformers import AutoProcessor, AutoModelForImageTextToText
-from PIL import Image
+from transformers import (
+    AutoProcessor,
+    AutoModelForImageTextToText,
+    DynamicCache,
+    LogitsProcessorList,
+    StoppingCriteriaList,
+    TextStreamer,
+)
+from transformers.models.smolvlm.processing_smolvlm import get_image_prompt_string
 
 from . import config
+from . import metrics
+from .affinity import pin_current_thread, plan_core_sets
+from .engine import create_engine, validate_engine
+from .image_cache import CachedImage, ImageFeatureCache
+from .payload import cleanup_task, task_image
+from .preprocess import PreparedImage, Preprocessor, prepare_document, prepare_image
+from .quantization import load_dtype, quantize_model, validate_mode
+from .snapshot import save_snapshot, snapshot_exists, snapshot_path
+from .speculative import SpeculativeDecoder, draft_mismatch
+from .stopping import EarlyStopper, StopPolicy, policy_for
+from .prefix_cache import PrefixCache, PrefixEntry
+from .tracing import GenerationTimer, observe_generation
+from .tiling import PreparedDocument, merge_texts, tiling_mode
+from .video import PreparedVideo, prepare_video, video_prompt
 
 logger = logging.getLogger(__name__)
 
+# Как часто простаивающий воркер проверяет, не пора ли остановиться, сек
+_STOP_POLL_S = 0.5
+
+
+class BrokerStreamer(TextStreamer):
+    def __init__(self, tokenizer, result_queue: "queue.Queue[Dict[str, Any]]", task_id: Any) -> None:
+        super().__init__(tokenizer, skip_prompt=True, skip_special_tokens=True)
+        self.result_queue = result_queue
+        self.task_id = task_id
+
+    def on_finalized_text(self, text: str, stream_end: bool = False) -> None:
+        if text:
+            self.result_queue.put({"id": self.task_id, "delta": text})
+
 
 class InferenceWorker:
     def __init__(
@@ -20,15 +57,30 @@ class InferenceWorker:
         task_queue: "queue.Queue[Dict[str, Any]]",
         result_queue: "queue.Queue[Dict[str, Any]]",
         model_id: str | None = None,
+        batch_max_size: int | None = None,
+        batch_max_wait_ms: float | None = None,
+        image_cache: ImageFeatureCache | None = None,
+        prefix_cache: PrefixCache | None = None,
+        quant: str | None = None,
+        draft_model_id: str | None = None,
+        engine: str | None = None,
     ) -> None:
         self.task_queue = task_queue
         self.result_queue = result_queue
         self.model_id = model_id or config.MODEL_ID
+        self.batch_max_size = max(1, batch_max_size or config.BATCH_MAX_SIZE)
+        self.batch_max_wait = (
+            batch_max_wait_ms if batch_max_wait_ms is not None else config.BATCH_MAX_WAIT_MS
+        ) / 1000.0
 
-        self.device = self._resolve_device(config.DEVICE_MODE)
-        self.dtype = torch.bfloat16 if self.device.type == "cuda" else torch.float32
+        self.device = self.resolve_device(config.DEVICE_MODE)
+        self.quant = validate_mode(quant or config.QUANT)
+        self.dtype = load_dtype(self.quant, self.device)
+        self.engine_name = validate_engine(engine or config.ENGINE)
 
-        logger.info(f"[SmolVLM] Loading model {self.model_id} on device={self.device} ...")
+        logger.info(
+            f"[SmolVLM] Loading model {self.model_id} on device={self.device} (dtype={self.dtype}, quant={self.quant}) ..."
+        )
 
         local_files_only = os.getenv("HF_LOCAL_ONLY", "0") == "1"
 
@@ -37,20 +89,81 @@ class InferenceWorker:
         except Exception as e:
             logger.warning(f"[SmolVLM] Failed to create MODEL_CACHE_DIR {config.MODEL_CACHE_DIR}: {e}")
 
-        self.processor = AutoProcessor.from_pretrained(
-            self.model_id,
-            local_files_only=local_files_only,
+        self.model, self.processor = self._load_model(self.model_id, local_files_only)
+        # Батчи паддим слева, чтобы сгенерированные токены шли сразу за промптом
+        self.processor.tokenizer.padding_side = "left"
+        logger.info("[SmolVLM] Model loaded ✅")
+        # Через движок идут все вызовы основной модели; черновая остаётся eager
+        self.engine = create_engine(self.engine_name, self.model, self.device)
+        logger.info(f"[SmolVLM] Engine: {self.engine.name}")
+
+        # Черновая модель для спекулятивного декодирования ("" — выключено)
+        self.speculative: SpeculativeDecoder | None = None
+        self.draft_model_id = config.DRAFT_MODEL_ID if draft_model_id is None else draft_model_id
+        if self.draft_model_id:
+            self.speculative = self._load_draft(self.draft_model_id, local_files_only)
+
+        # Быстрый токенизатор нельзя безопасно дёргать из нескольких потоков с padding
+        self._tokenizer_lock = threading.Lock()
+        self.threads: List[threading.Thread] = []
+        self._stopping = threading.Event()
+        # Откуда воркеры берут задачи: сама task_queue или очередь подготовленных задач
+        self._input = self.task_queue
+        self.preprocessor: Preprocessor | None = None
+
+        self.image_cache = image_cache or ImageFeatureCache(config.IMAGE_CACHE_MB * 1024 * 1024)
+        self._cache_namespace = self._image_cache_namespace()
+        self.prefix_cache = prefix_cache or PrefixCache(config.PREFIX_CACHE_MB * 1024 * 1024)
+
+    def _load_model(self, model_id: str, local_files_only: bool) -> Tuple[Any, Any]:
+        snapshot = snapshot_path(model_id, self.dtype) if config.USE_SNAPSHOT else None
+        from_snapshot = snapshot is not None and snapshot_exists(snapshot)
+        # Снапшот — safetensors уже в нужном dtype: грузится через mmap без конвертации
+        source = str(snapshot) if from_snapshot else model_id
+        if from_snapshot:
+            logger.info(f"[SmolVLM] Using snapshot {snapshot}")
+
+        processor = AutoProcessor.from_pretrained(
+            source,
+            local_files_only=local_files_only or from_snapshot,
         )
-        self.model = AutoModelForImageTextToText.from_pretrained(
-            self.model_id,
+        model = AutoModelForImageTextToText.from_pretrained(
+            source,
             torch_dtype=self.dtype,
             _attn_implementation="sdpa",
-            local_files_only=local_files_only,
+            low_cpu_mem_usage=True,
+            local_files_only=local_files_only or from_snapshot,
         ).to(self.device)
 
-        logger.info("[SmolVLM] Model loaded ✅")
+        if snapshot is not None and not from_snapshot:
+            save_snapshot(model, processor, snapshot)
+        quantize_model(model, self.quant, self.device, include_vision=config.QUANT_VISION)
+        return model, processor
 
-    def _resolve_device(self, mode: str) -> torch.device:
+    def _load_draft(self, model_id: str, local_files_only: bool) -> SpeculativeDecoder | None:
+        logger.info(f"[Speculative] Loading draft model {model_id} ...")
+        try:
+            draft, draft_processor = self._load_model(model_id, local_files_only)
+        except Exception as e:
+            logger.warning(f"[Speculative] Failed to load draft model {model_id}, speculative decoding is off: {e}")
+            return None
+        mismatch = draft_mismatch(self.processor, draft_processor)
+        if mismatch is not None:
+            logger.warning(f"[Speculative] Draft {model_id} does not match {self.model_id} ({mismatch}), speculative decoding is off")
+            return None
+        logger.info(
+            f"[Speculative] Draft model loaded ✅ (tokens per step={config.SPEC_NUM_TOKENS}, adaptive={config.SPEC_ADAPTIVE})"
+        )
+        return SpeculativeDecoder(
+            self.model,
+            draft,
+            self.processor.tokenizer.convert_tokens_to_ids(self.processor.image_token),
+            config.SPEC_NUM_TOKENS,
+            config.SPEC_ADAPTIVE,
+        )
+
+    @staticmethod
+    def resolve_device(mode: str) -> torch.device:
         mode = (mode or "auto").lower()
         if mode == "cpu":
             return torch.device("cpu")
@@ -64,55 +177,403 @@ class InferenceWorker:
             return torch.device("cuda")
         return torch.device("cpu")
 
-    def _build_messages(self, image: Image.Image, prompt: str) -> list[Dict[str, Any]]:
-        return [
-            {
-                "role": "user",
-                "content": [
-                    {"type": "image", "image": image},
-                    {"type": "text", "text": prompt},
-                ],
-            }
-        ]
-
-    def analyze_image(self, image_path: str, prompt: str, mode: str = "chat") -> str:
+    def _build_messages(self, prompt: str, mode: str = "chat") -> list[Dict[str, Any]]:
+        if mode == "ocr":
+            # Инструкция идёт до картинки, чтобы быть общим префиксом всех OCR-запросов
+            content = [
+                {"type": "text", "text": f"{config.OCR_SYSTEM_PROMPT}\n\nImage:"},
+                {"type": "image"},
+            ]
+        else:
+            content = [
+                {"type": "image"},
+                {"type": "text", "text": prompt},
+            ]
+        return [{"role": "user", "content": content}]
+
+    def _image_cache_namespace(self) -> str:
+        image_processor = self.processor.image_processor
+        settings = {
+            key: getattr(image_processor, key, None)
+            for key in ("size", "max_image_size", "do_image_splitting", "do_resize", "resample", "do_normalize")
+        }
+        settings["image_seq_len"] = self.processor.image_seq_len
+        settings["dtype"] = str(self.dtype)
+        settings["quant"] = self.quant
+        settings["quant_vision"] = config.QUANT_VISION
+        # С черновиком в записи кэша лежат и его признаки
+        settings["draft"] = self.draft_model_id if self.speculative is not None else None
+        return f"{self.model_id}|{json.dumps(settings, sort_keys=True, default=str)}"
+
+    @torch.inference_mode()
+    def _encode_image(self, source: bytes | str | PreparedImage) -> CachedImage:
+        # source — байты картинки, путь к файлу или уже подготовленный PreparedImage
+        prepared = source if isinstance(source, PreparedImage) else prepare_image(self, source)
+        if prepared.cached is not None:
+            return prepared.cached
+
+        pixel_values = prepared.pixel_values.to(self.device, dtype=self.dtype)
+        pixel_attention_mask = prepared.pixel_attention_mask
+        if pixel_attention_mask is not None:
+            pixel_attention_mask = pixel_attention_mask.to(self.device)
+
+        features = self.engine.image_features(pixel_values, pixel_attention_mask)
+        draft_features = None
+        if self.speculative is not None:
+            draft_features = self.speculative.draft.model.get_image_features(pixel_values, pixel_attention_mask)
+            draft_features = getattr(draft_features, "pooler_output", draft_features).detach()
+
+        entry = CachedImage(
+            key=prepared.key,
+            features=features.detach(),
+            rows=prepared.rows,
+            cols=prepared.cols,
+            draft_features=draft_features,
+        )
+        self.image_cache.put(prepared.key, entry)
+        return entry
+
+    def _image_prompt(self, image: CachedImage) -> str:
+        processor = self.processor
+        return get_image_prompt_string(
+            image.rows,
+            image.cols,
+            processor.image_seq_len,
+            fake_token_around_image=processor.fake_image_token,
+            image_token=processor.image_token,
+            global_image_token=processor.global_image_token,
+        )
+
+    def _render_prompt(self, prompt: str, mode: str, image: CachedImage) -> Tuple[str, str, bool]:
+        text = self.processor.apply_chat_template(
+            self._build_messages(prompt, mode),
+            add_generation_prompt=True,
+            tokenize=False,
+        )
+        head, tail = text.split(self.processor.image_token, 1)
+        image_block = self._image_prompt(image)
+        # (префикс, остаток, входит ли картинка в префикс)
         if mode == "ocr":
-            final_prompt = f"{config.OCR_SYSTEM_PROMPT}\n\nImage:"
+            return head, image_block + tail, False
+        return head + image_block, tail, True
+
+    def analyze_image(
+        self,
+        image_path: bytes | str | PreparedImage,
+        prompt: str,
+        mode: str = "chat",
+        streamer: TextStreamer | None = None,
+        max_new_tokens: int | None = None,
+    ) -> str:
+        return self.analyze_batch([(image_path, prompt, mode)], streamer=streamer, budgets=[max_new_tokens])[0]
+
+    def analyze_batch(
+        self,
+        items: List[tuple],
+        streamer: TextStreamer | None = None,
+        timings: List[Dict[str, Any]] | None = None,
+        budgets: List[int | None] | None = None,
+    ) -> List[str]:
+        # timings — по записи на задачу, сюда дописываются длительности стадий и число токенов;
+        # budgets — max_new_tokens из запроса (None = по режиму)
+        if timings is None:
+            timings = [{} for _ in items]
+        if budgets is None:
+            budgets = [None] * len(items)
+
+        prepared = []
+        for (image_source, prompt, mode), timing in zip(items, timings):
+            started = time.perf_counter()
+            image = self._encode_image(image_source)
+            timing["image_s"] = time.perf_counter() - started
+            prepared.append((image, *self._render_prompt(prompt, mode, image)))
+
+        timer = GenerationTimer()
+        stopper = self._stopper([policy_for(mode, budget) for (_, _, mode), budget in zip(items, budgets)])
+        gen_kwargs = self._gen_kwargs(streamer, timer, stopper)
+
+        if len(prepared) == 1 and self._can_speculate(prepared[0][0]):
+            generated_ids = self._generate_speculative(*prepared[0], streamer, timer, stopper, timings[0])
+            input_lengths = [generated_ids.shape[1] - timer.steps]
+        elif len(prepared) == 1 and self.prefix_cache.enabled:
+            generated_ids = self._generate_with_prefix(*prepared[0], **gen_kwargs)
+            input_lengths = [generated_ids.shape[1] - timer.steps]
         else:
-            final_prompt = prompt
+            generated_ids, input_lengths = self._generate_padded(
+                [prefix + suffix for _, prefix, suffix, _ in prepared],
+                torch.cat([image.features for image, *_ in prepared], dim=0),
+                gen_kwargs,
+            )
+
+        return self._finish(generated_ids, input_lengths, timer, stopper, [mode for _, _, mode in items], timings)
 
-        image = Image.open(image_path).convert("RGB")
+    def analyze_document(
+        self,
+        source: bytes | str | PreparedImage | PreparedDocument,
+        timing: Dict[str, Any] | None = None,
+        max_new_tokens: int | None = None,
+        tiling: str = "on",
+    ) -> str:
+        # OCR страницы по полосам: полосы идут пачками по OCR_TILE_BATCH в analyze_batch,
+        # тексты склеиваются сверху вниз без повторов на перекрытиях
+        timing = {} if timing is None else timing
+        if not isinstance(source, (PreparedImage, PreparedDocument)):
+            started = time.perf_counter()
+            source = prepare_document(self, source, tiling)
+            timing["preprocess_s"] = timing.get("preprocess_s", 0.0) + time.perf_counter() - started
+        if isinstance(source, PreparedImage):
+            return self.analyze_batch([(source, "", "ocr")], timings=[timing], budgets=[max_new_tokens])[0]
+
+        texts: List[str] = []
+        tile_timings: List[Dict[str, Any]] = []
+        step = config.OCR_TILE_BATCH
+        for start in range(0, len(source.tiles), step):
+            chunk = source.tiles[start:start + step]
+            chunk_timings: List[Dict[str, Any]] = [{} for _ in chunk]
+            texts += self.analyze_batch(
+                [(tile, "", "ocr") for tile in chunk],
+                timings=chunk_timings,
+                budgets=[max_new_tokens] * len(chunk),
+            )
+            # prefill/decode у пачки общие — считаем их один раз
+            timing["prefill_s"] = timing.get("prefill_s", 0.0) + chunk_timings[0]["prefill_s"]
+            timing["decode_s"] = timing.get("decode_s", 0.0) + chunk_timings[0]["decode_s"]
+            tile_timings += chunk_timings
 
-        messages = self._build_messages(image, final_prompt)
+        for key in ("image_s", "input_tokens", "output_tokens", "used_tokens"):
+            timing[key] = sum(t.get(key, 0) for t in tile_timings)
+        reasons = [t.get("stop_reason") for t in tile_timings]
+        # Если хоть одна полоса упёрлась в бюджет, текст страницы может быть неполным
+        timing["stop_reason"] = "budget" if "budget" in reasons else reasons[-1]
+        timing["tiles"] = len(source.tiles)
+        return merge_texts(texts, source.overlaps)
+
+    @torch.inference_mode()
+    def analyze_video(
+        self,
+        source: bytes | str | PreparedVideo,
+        prompt: str,
+        streamer: TextStreamer | None = None,
+        timing: Dict[str, Any] | None = None,
+        sampling: str | None = None,
+        max_frames: int | None = None,
+        max_new_tokens: int | None = None,
+    ) -> str:
+        timing = {} if timing is None else timing
+        started = time.perf_counter()
+        video = source if isinstance(source, PreparedVideo) else prepare_video(self, source, sampling, max_frames)
+        features = self._encode_frames(video)
+        timing["image_s"] = time.perf_counter() - started
+        timing["frames"] = video.num_frames
 
-        inputs = self.processor.apply_chat_template(
-            messages,
+        text = self.processor.apply_chat_template(
+            self._build_messages(prompt, "chat"),
             add_generation_prompt=True,
-            tokenize=True,
-            return_dict=True,
-            return_tensors="pt",
-        ).to(self.device, dtype=self.dtype)
+            tokenize=False,
+        )
+        text = text.replace(self.processor.image_token, video_prompt(self, video), 1)
+
+        timer = GenerationTimer()
+        stopper = self._stopper([policy_for("video", max_new_tokens)])
+        generated_ids, input_lengths = self._generate_padded(
+            [text], features, self._gen_kwargs(streamer, timer, stopper)
+        )
+        return self._finish(generated_ids, input_lengths, timer, stopper, ["video"], [timing])[0]
 
-        generated_ids = self.model.generate(
-            **inputs,
+    def _encode_frames(self, video: PreparedVideo) -> torch.Tensor:
+        # Кадры кодируются пачками: один проход vision encoder на VIDEO_ENCODE_BATCH кадров
+        pixel_values = video.pixel_values
+        mask = video.pixel_attention_mask
+        step = max(1, config.VIDEO_ENCODE_BATCH)
+        chunks = []
+        for start in range(0, pixel_values.shape[1], step):
+            chunk = pixel_values[:, start:start + step].to(self.device, dtype=self.dtype)
+            chunk_mask = mask[:, start:start + step].to(self.device) if mask is not None else None
+            chunks.append(self.engine.image_features(chunk, chunk_mask))
+        return torch.cat(chunks, dim=0)
+
+    def _stopper(self, policies: List[StopPolicy]) -> EarlyStopper:
+        eos = self.model.generation_config.eos_token_id
+        eos_ids = eos if isinstance(eos, (list, tuple)) else [eos]
+        return EarlyStopper(self.processor.tokenizer, policies, eos_ids)
+
+    def _gen_kwargs(
+        self, streamer: TextStreamer | None, timer: GenerationTimer, stopper: EarlyStopper
+    ) -> Dict[str, Any]:
+        # max_new_tokens — наибольший бюджет в батче, свои бюджеты строк держит stopper
+        return dict(
             do_sample=config.GENERATION_TEMPERATURE > 0.0,
             temperature=config.GENERATION_TEMPERATURE if config.GENERATION_TEMPERATURE > 0.0 else None,
-            max_new_tokens=config.MAX_NEW_TOKENS,
+            max_new_tokens=stopper.max_budget,
+            streamer=streamer,
+            logits_processor=LogitsProcessorList([timer]),
+            stopping_criteria=StoppingCriteriaList([stopper]),
         )
 
-        generated_texts = self.processor.batch_decode(
-            generated_ids, skip_special_tokens=True
+    def _generate_padded(
+        self, texts: List[str], features: torch.Tensor, gen_kwargs: Dict[str, Any]
+    ) -> Tuple[torch.Tensor, List[int]]:
+        with self._tokenizer_lock:
+            inputs = self.processor.tokenizer(
+                texts,
+                return_tensors="pt",
+                padding=len(texts) > 1,
+                add_special_tokens=False,
+            ).to(self.device)
+
+        generated_ids = self.engine.generate(
+            input_ids=inputs["input_ids"],
+            attention_mask=inputs["attention_mask"],
+            image_hidden_states=features,
+            **gen_kwargs,
         )
-        text = generated_texts[0].strip()
+        return generated_ids, inputs["attention_mask"].sum(dim=1).tolist()
 
-        for marker in ("Assistant:", "assistant:"):
-            if marker in text:
-                text = text.split(marker, 1)[-1].strip()
+    def _finish(
+        self,
+        generated_ids: torch.Tensor,
+        input_lengths: List[int],
+        timer: GenerationTimer,
+        stopper: EarlyStopper,
+        modes: List[str],
+        timings: List[Dict[str, Any]],
+    ) -> List[str]:
+        prefill_s, decode_s = timer.split(time.perf_counter())
+        # Декодируем только новые токены: промпт в ответ не попадает и не требует обрезки
+        new_tokens = generated_ids[:, generated_ids.shape[1] - timer.steps:]
+        output_lengths = self._count_new_tokens(new_tokens)
+        finished = stopper.finalize(new_tokens)
+        results = [text for text, _ in finished]
+        with self._tokenizer_lock:
+            used_lengths = [len(ids) for ids in self.processor.tokenizer(results, add_special_tokens=False)["input_ids"]]
+
+        for timing, n_in, n_out, n_used, (_, reason) in zip(
+            timings, input_lengths, output_lengths, used_lengths, finished
+        ):
+            timing.update(
+                prefill_s=prefill_s,
+                decode_s=decode_s,
+                input_tokens=int(n_in),
+                output_tokens=int(n_out),
+                used_tokens=min(int(n_used), int(n_out)),
+                stop_reason=reason,
+            )
+        observe_generation(modes, timings)
+        return results
 
-        return text
+    def _count_new_tokens(self, new_tokens: torch.Tensor) -> List[int]:
+        # После EOS строки батча добиваются pad-токенами — их не считаем
+        pad_id = self.model.generation_config.pad_token_id
+        if pad_id is None:
+            return [new_tokens.shape[1]] * new_tokens.shape[0]
+        return (new_tokens != pad_id).sum(dim=1).tolist()
+
+    @torch.no_grad()
+    def _prefill_prefix(self, prefix_ids: List[int], features: torch.Tensor | None) -> PrefixEntry:
+        input_ids = torch.tensor([prefix_ids], device=self.device)
+        outputs = self.engine.forward(
+            input_ids=input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            image_hidden_states=features,
+            past_key_values=DynamicCache(),
+            use_cache=True,
+        )
+        return PrefixEntry(outputs.past_key_values, len(prefix_ids))
+
+    def _tokenize_parts(self, prefix: str, suffix: str) -> Tuple[List[int], List[int]]:
+        tokenizer = self.processor.tokenizer
+        with self._tokenizer_lock:
+            prefix_ids = tokenizer(prefix, add_special_tokens=False)["input_ids"]
+            suffix_ids = tokenizer(suffix, add_special_tokens=False)["input_ids"]
+        return prefix_ids, suffix_ids
+
+    def _prefix_entry(self, prefix_ids: List[int], image: CachedImage, prefix_has_image: bool) -> PrefixEntry:
+        # Без картинки ключ привязан к модели: один кэш может обслуживать несколько моделей
+        key = PrefixCache.make_key(prefix_ids, image.key if prefix_has_image else self._cache_namespace)
+        entry = self.prefix_cache.get(key)
+        if entry is None:
+            entry = self._prefill_prefix(prefix_ids, image.features if prefix_has_image else None)
+            self.prefix_cache.put(key, entry)
+        else:
+            metrics.PREFILL_TOKENS_SAVED.inc(entry.length)
+        return entry
+
+    def _generate_with_prefix(
+        self,
+        image: CachedImage,
+        prefix: str,
+        suffix: str,
+        prefix_has_image: bool,
+        **gen_kwargs: Any,
+    ) -> torch.Tensor:
+        prefix_ids, suffix_ids = self._tokenize_parts(prefix, suffix)
+        entry = self._prefix_entry(prefix_ids, image, prefix_has_image)
+
+        input_ids = torch.tensor([prefix_ids + suffix_ids], device=self.device)
+        return self.engine.generate(
+            input_ids=input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            image_hidden_states=image.features,
+            past_key_values=PrefixCache.fork(entry),
+            **gen_kwargs,
+        )
+
+    def _can_speculate(self, image: CachedImage) -> bool:
+        # Только жадный декод: при сэмплировании нужна проверка по вероятностям, а не по argmax
+        return (
+            self.speculative is not None
+            and config.GENERATION_TEMPERATURE <= 0.0
+            and image.draft_features is not None
+        )
+
+    def _generate_speculative(
+        self,
+        image: CachedImage,
+        prefix: str,
+        suffix: str,
+        prefix_has_image: bool,
+        streamer: TextStreamer | None,
+        timer: GenerationTimer,
+        stopper: EarlyStopper,
+        timing: Dict[str, Any],
+    ) -> torch.Tensor:
+        prefix_ids, suffix_ids = self._tokenize_parts(prefix, suffix)
+        entry = self._prefix_entry(prefix_ids, image, prefix_has_image) if self.prefix_cache.enabled else None
+
+        generated_ids, counts = self.speculative.generate(
+            torch.tensor([prefix_ids + suffix_ids], device=self.device),
+            image.features,
+            image.draft_features,
+            stopper,
+            timer,
+            streamer=streamer,
+            cache=PrefixCache.fork(entry) if entry is not None else None,
+            cached_length=entry.length if entry is not None else 0,
+        )
+        timing.update(counts)
+        return generated_ids
+
+    def start(
+        self,
+        warmup: bool = True,
+        num_workers: int | None = None,
+        threads_per_worker: int | None = None,
+        pin_cores: bool | None = None,
+    ) -> None:
+        num_workers = max(1, num_workers or config.NUM_WORKERS)
+        threads_per_worker = config.THREADS_PER_WORKER if threads_per_worker is None else threads_per_worker
+        pin_cores = config.PIN_WORKER_CORES if pin_cores is None else pin_cores
+
+        core_sets = plan_core_sets(num_workers, threads_per_worker)
+        if self.device.type == "cpu":
+            # set_num_threads глобальный: у каждого воркера своя команда OpenMP такого размера
+            torch.set_num_threads(len(core_sets[0]))
 
-    def start(self, warmup: bool = True) -> None:
         if warmup:
+            try:
+                self.engine.warmup()
+            except Exception as e:
+                logger.warning(f"[InferenceWorker] Engine warmup failed (not critical): {e}")
             try:
                 demo_path = config.DEMO_IMAGE
                 if isinstance(demo_path, (str, Path)):
@@ -126,30 +587,230 @@ class InferenceWorker:
             except Exception as e:
                 logger.warning(f"[InferenceWorker] Warmup failed (not critical): {e}")
 
-        thread = threading.Thread(target=self._loop, daemon=True)
-        thread.start()
-        logger.info("[InferenceWorker] Worker thread started ✅")
+        if config.PREPROCESS_THREADS > 0:
+            self.preprocessor = Preprocessor(
+                self,
+                source=self.task_queue,
+                num_threads=config.PREPROCESS_THREADS,
+                max_prepared=config.PREPROCESS_QUEUE_SIZE or num_workers * self.batch_max_size * 2,
+            )
+            self._input = self.preprocessor
+
+        for idx, cores in enumerate(core_sets):
+            thread = threading.Thread(
+                target=self._worker_main,
+                args=(idx, cores if pin_cores and self.device.type == "cpu" else None),
+                name=f"InferenceWorker-{idx}",
+                daemon=True,
+            )
+            thread.start()
+            self.threads.append(thread)
+        logger.info(
+            f"[InferenceWorker] {num_workers} worker thread(s) started ✅ "
+            f"(torch threads per worker={torch.get_num_threads()}, pinned={bool(pin_cores)})"
+        )
+
+    def begin_stop(self) -> None:
+        # Больше не берём задачи из очереди; вызывается под блокировкой роутера, до отсоединения модели
+        self._stopping.set()
+        if self.preprocessor is not None:
+            self.preprocessor.begin_stop()
+
+    def stop(self, timeout: float = 10.0) -> List[Dict[str, Any]]:
+        # Воркеры дорабатывают текущий батч и выходят; после этого на веса не остаётся ссылок из потоков.
+        # Возвращает задачи, которые предобработчик взял из очереди, но модель уже не обработает
+        self.begin_stop()
+        for thread in self.threads:
+            thread.join(timeout)
+        self.threads.clear()
+        leftover = self.preprocessor.stop() if self.preprocessor is not None else []
+        logger.info(f"[InferenceWorker] {self.model_id} stopped")
+        return leftover
+
+    def _worker_main(self, idx: int, cores: List[int] | None) -> None:
+        if cores is not None and pin_current_thread(cores):
+            logger.info(f"[InferenceWorker-{idx}] Pinned to cores {cores}")
+        self._loop()
+
+    @staticmethod
+    def _task_source(task: Dict[str, Any]) -> bytes | str | PreparedImage | PreparedVideo | PreparedDocument:
+        if "prepare_error" in task:
+            raise task["prepare_error"]
+        prepared = task.get("prepared")
+        return prepared if prepared is not None else task_image(task)
+
+    def _collect_batch(self) -> List[Dict[str, Any]]:
+        # Первую задачу ждём короткими интервалами, чтобы заметить stop()
+        first = None
+        while first is None:
+            if self._stopping.is_set():
+                return []
+            try:
+                first = self._input.get(timeout=_STOP_POLL_S)
+            except queue.Empty:
+                continue
+        batch = [first]
+        deadline = time.monotonic() + self.batch_max_wait
+        while len(batch) < self.batch_max_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._input.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run_batch(self, batch: List[Dict[str, Any]]) -> None:
+        # Стриминг токенов работает только для batch size 1, видео и OCR по полосам тоже идут поштучно.
+        # Время обслуживания записываем по частям: иначе долгое видео или документ размазывались бы
+        # по всем задачам батча и завышали оценку ожидания для чата
+        single = [task for task in batch if task.get("stream") or task.get("mode") == "video" or self._is_tiled(task)]
+        for task in single:
+            started = time.perf_counter()
+            self._run_single(task)
+            self._record_service([task], time.perf_counter() - started)
+        batch = [task for task in batch if task not in single]
+        if not batch:
+            return
+        started = time.perf_counter()
+        try:
+            self._run_batched(batch)
+        finally:
+            self._record_service(batch, time.perf_counter() - started)
+
+    def _run_batched(self, batch: List[Dict[str, Any]]) -> None:
+        try:
+            # Ошибка предобработки тоже здесь: поштучные задачи батча уже отвечены
+            items = [
+                (self._task_source(task), task.get("prompt", ""), task.get("mode", "chat"))
+                for task in batch
+            ]
+            results = self.analyze_batch(
+                items,
+                timings=[task.setdefault("timing", {}) for task in batch],
+                budgets=[task.get("max_new_tokens") for task in batch],
+            )
+        except Exception as e:
+            if len(batch) == 1:
+                logger.exception("[InferenceWorker] Error while processing task")
+                self._publish(batch[0], error=str(e))
+                return
+            # Одна битая картинка не должна валить весь батч: повторяем поштучно
+            logger.exception("[InferenceWorker] Batch failed, retrying tasks one by one")
+            for task in batch:
+                self._run_single(task)
+            return
+
+        for task, result_text in zip(batch, results):
+            self._publish(task, result=result_text)
+
+    @staticmethod
+    def _is_tiled(task: Dict[str, Any]) -> bool:
+        return task.get("mode") == "ocr" and tiling_mode(task.get("tiling")) != "off"
+
+    def _run_single(self, task: Dict[str, Any]) -> None:
+        streamer = None
+        if task.get("stream"):
+            streamer = BrokerStreamer(self.processor.tokenizer, self.result_queue, task.get("id"))
+        try:
+            if task.get("mode") == "video":
+                result_text = self.analyze_video(
+                    self._task_source(task),
+                    task.get("prompt", ""),
+                    streamer=streamer,
+                    timing=task.setdefault("timing", {}),
+                    sampling=task.get("sampling"),
+                    max_frames=task.get("max_frames"),
+                    max_new_tokens=task.get("max_new_tokens"),
+                )
+            elif self._is_tiled(task):
+                result_text = self.analyze_document(
+                    self._task_source(task),
+                    timing=task.setdefault("timing", {}),
+                    max_new_tokens=task.get("max_new_tokens"),
+                    tiling=tiling_mode(task.get("tiling")),
+                )
+            else:
+                result_text = self.analyze_batch(
+                    [(self._task_source(task), task.get("prompt", ""), task.get("mode", "chat"))],
+                    streamer=streamer,
+                    timings=[task.setdefault("timing", {})],
+                    budgets=[task.get("max_new_tokens")],
+                )[0]
+            self._publish(task, result=result_text)
+        except Exception as e:
+            logger.exception("[InferenceWorker] Error while processing task")
+            self._publish(task, error=str(e))
+
+    def _publish(self, task: Dict[str, Any], **payload: Any) -> None:
+        timing = task.setdefault("timing", {})
+        enqueued_at = task.get("enqueued_at")
+        if enqueued_at is not None:
+            timing["total_s"] = max(0.0, time.time() - enqueued_at)
+        # sent_at — для метрики задержки доставки в брокере
+        self.result_queue.put({"id": task.get("id"), **payload, "timing": dict(timing), "sent_at": time.time()})
+
+    def _drop_abandoned(self, batch: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        # Воркер на отдельном узле потерял соединение: брокер уже вернул эти задачи в очередь
+        abandoned = getattr(self.task_queue, "abandoned", None)
+        if abandoned is None:
+            return batch
+        kept = []
+        for task in batch:
+            if abandoned(task):
+                logger.info(f"[InferenceWorker] Dropped task_id={task.get('id')}: its broker connection is gone")
+                cleanup_task(task)
+                self.task_queue.task_done()
+            else:
+                kept.append(task)
+        return kept
+
+    def _record_service(self, batch: List[Dict[str, Any]], elapsed: float) -> None:
+        record = getattr(self.task_queue, "record_service", None)
+        if record is None:
+            return
+        per_task = elapsed / len(batch)
+        for task in batch:
+            record(task.get("mode", "chat"), per_task)
 
     def _loop(self) -> None:
-        logger.info("[InferenceWorker] Waiting for tasks...")
+        logger.info(
+            f"[{threading.current_thread().name}] Waiting for tasks "
+            f"(batch_max_size={self.batch_max_size}, batch_max_wait={self.batch_max_wait * 1000:.0f}ms)..."
+        )
         while True:
-            task: Dict[str, Any] = self.task_queue.get()
+            batch = self._collect_batch()
+            if not batch:
+                return
+            batch = self._drop_abandoned(batch)
+            if not batch:
+                continue
+            picked_at = time.time()
             try:
-                task_id = task.get("id")
-                image_path = task["image_path"]
-                prompt = task.get("prompt", "")
-                mode = task.get("mode", "chat")
-
-                logger.info(f"[InferenceWorker] Processing task_id={task_id}, mode={mode}")
-                result_text = self.analyze_image(image_path, prompt, mode=mode)
+                metrics.BATCH_SIZE.observe(len(batch))
+                for task in batch:
+                    timing = task.setdefault("timing", {})
+                    enqueued_at = task.get("enqueued_at")
+                    if enqueued_at is not None:
+                        # Время предобработки считается отдельно, в очереди — только ожидание
+                        waited = max(0.0, picked_at - enqueued_at - timing.get("preprocess_s", 0.0))
+                        timing["queue_s"] = waited
+                        metrics.QUEUE_WAIT_SECONDS.observe(
+                            waited, mode=task.get("mode", "chat"), source=task.get("source", "api")
+                        )
 
-                self.result_queue.put(
-                    {"id": task_id, "result": result_text}
+                logger.info(
+                    "[InferenceWorker] Processing batch of %d: %s",
+                    len(batch),
+                    ", ".join(f"{t.get('id')}/{t.get('mode', 'chat')}" for t in batch),
                 )
+                self._run_batch(batch)
             except Exception as e:
-                logger.exception("[InferenceWorker] Error while processing task")
-                self.result_queue.put(
-                    {"id": task.get("id"), "error": str(e)}
-                )
+                logger.exception("[InferenceWorker] Error while processing batch")
+                for task in batch:
+                    self._publish(task, error=str(e))
             finally:
-                self.task_queue.task_done()
+                for task in batch:
+                    cleanup_task(task)
+                    self.task_queue.task_done()
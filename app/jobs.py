@@ -0,0 +1,466 @@
+import json
+import logging
+import math
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import requests
+
+from . import config
+from . import metrics
+from .result_broker import new_task_id
+from .router import UnknownModelError
+from .scheduler import PRIORITY_BACKGROUND, QueueFullError
+
+logger = logging.getLogger(__name__)
+
+# Элемент задания: queued -> running -> done | error | cancelled
+# Поля задачи, которые хранятся вместе с картинкой и нужны, чтобы поставить её в очередь заново
+_TASK_FIELDS = ("prompt", "mode", "tiling", "max_new_tokens", "model")
+# Как часто удалять старые задания
+_PURGE_INTERVAL_S = 60.0
+_WEBHOOK_TIMEOUT_S = 10.0
+
+
+class JobStore:
+    # Задания и их картинки в sqlite (WAL): запись — добавление в журнал, после падения
+    # база остаётся целой, а незавершённые элементы можно поставить в очередь заново
+    def __init__(self, path: Path) -> None:
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id TEXT PRIMARY KEY, status TEXT NOT NULL, created REAL NOT NULL, finished REAL, "
+            "webhook TEXT, webhook_status TEXT)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS items ("
+            "job_id TEXT NOT NULL, idx INTEGER NOT NULL, task TEXT NOT NULL, image BLOB, "
+            "status TEXT NOT NULL, task_id INTEGER, attempts INTEGER NOT NULL DEFAULT 0, "
+            "result TEXT, error TEXT, usage TEXT, updated REAL NOT NULL, PRIMARY KEY (job_id, idx))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS items_status ON items(status)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_finished ON jobs(finished)")
+
+    def add(self, job_id: str, items: List[Tuple[Dict[str, Any], bytes]], webhook: str | None) -> None:
+        # Одна транзакция на всё задание: сотня картинок — один fsync
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.execute(
+                    "INSERT INTO jobs(id, status, created, webhook) VALUES (?, 'queued', ?, ?)",
+                    (job_id, now, webhook),
+                )
+                self._conn.executemany(
+                    "INSERT INTO items(job_id, idx, task, image, status, updated) VALUES (?, ?, ?, ?, 'queued', ?)",
+                    [(job_id, idx, json.dumps(task), image, now) for idx, (task, image) in enumerate(items)],
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def recover(self) -> int:
+        # Элементы, которые обрабатывались, когда сервер остановился, снова ждут очереди
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE items SET status = 'queued', task_id = NULL, updated = ? WHERE status = 'running'",
+                (time.time(),),
+            )
+            return cursor.rowcount
+
+    def next_queued(self, limit: int) -> List[Tuple[str, int, Dict[str, Any], bytes, int]]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT job_id, idx, task, image, attempts FROM items WHERE status = 'queued' "
+                "ORDER BY rowid LIMIT ?",
+                (limit,),
+            ).fetchall()
+        return [(job_id, idx, json.loads(task), image, attempts) for job_id, idx, task, image, attempts in rows]
+
+    def mark_running(self, job_id: str, idx: int, task_id: int) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "UPDATE items SET status = 'running', task_id = ?, attempts = attempts + 1, updated = ? "
+                "WHERE job_id = ? AND idx = ?",
+                (task_id, now, job_id, idx),
+            )
+            self._conn.execute("UPDATE jobs SET status = 'running' WHERE id = ? AND status = 'queued'", (job_id,))
+
+    def mark_queued(self, job_id: str, idx: int, count_attempt: bool = False) -> None:
+        # Очередь допуска отказала — попытка не считается; неожиданная ошибка — считается,
+        # чтобы элемент, который ломает постановку в очередь, не крутился вечно
+        with self._lock:
+            self._conn.execute(
+                "UPDATE items SET status = 'queued', task_id = NULL, attempts = attempts - ?, updated = ? "
+                "WHERE job_id = ? AND idx = ? AND status = 'running'",
+                (0 if count_attempt else 1, time.time(), job_id, idx),
+            )
+
+    def finish(
+        self,
+        job_id: str,
+        idx: int,
+        status: str,
+        result: str | None = None,
+        error: str | None = None,
+        usage: Dict[str, Any] | None = None,
+    ) -> Optional[str]:
+        # Возвращает итоговый статус задания, если это был его последний элемент
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                job = self._conn.execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()
+                if job is None:
+                    self._conn.execute("COMMIT")
+                    return None
+                if job[0] == "cancelled" and status == "error":
+                    status = "cancelled"
+                # Картинка больше не нужна — база не растёт на уже обработанных заданиях
+                cursor = self._conn.execute(
+                    "UPDATE items SET status = ?, result = ?, error = ?, usage = ?, image = NULL, updated = ? "
+                    "WHERE job_id = ? AND idx = ? AND status IN ('queued', 'running')",
+                    (status, result, error, json.dumps(usage) if usage else None, now, job_id, idx),
+                )
+                # Элемент уже закрыт (отменён вместе с заданием) — поздний результат ничего не меняет
+                final = self._close_if_finished(job_id, job[0], now) if cursor.rowcount else None
+                self._conn.execute("COMMIT")
+                return final
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def _close_if_finished(self, job_id: str, status: str, now: float) -> Optional[str]:
+        left = self._conn.execute(
+            "SELECT COUNT(*) FROM items WHERE job_id = ? AND status IN ('queued', 'running')", (job_id,)
+        ).fetchone()[0]
+        if left:
+            return None
+        final = "cancelled" if status == "cancelled" else "done"
+        self._conn.execute("UPDATE jobs SET status = ?, finished = ? WHERE id = ?", (final, now, job_id))
+        return final
+
+    def cancel(self, job_id: str) -> Optional[Tuple[Optional[str], List[int]]]:
+        # None — задания нет. Иначе: итоговый статус (если задание закрылось) и id задач,
+        # которые уже стоят в очереди допуска или считаются. Ждущие элементы отменяются сразу
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                job = self._conn.execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()
+                if job is None:
+                    self._conn.execute("COMMIT")
+                    return None
+                if job[0] == "done":
+                    self._conn.execute("COMMIT")
+                    return None, []
+                self._conn.execute("UPDATE jobs SET status = 'cancelled' WHERE id = ?", (job_id,))
+                self._conn.execute(
+                    "UPDATE items SET status = 'cancelled', image = NULL, updated = ? "
+                    "WHERE job_id = ? AND status = 'queued'",
+                    (now, job_id),
+                )
+                running = [
+                    row[0]
+                    for row in self._conn.execute(
+                        "SELECT task_id FROM items WHERE job_id = ? AND status = 'running'", (job_id,)
+                    )
+                ]
+                final = self._close_if_finished(job_id, "cancelled", now) if job[0] != "cancelled" else None
+                self._conn.execute("COMMIT")
+                return final, running
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            job = self._conn.execute(
+                "SELECT status, created, finished, webhook, webhook_status FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+            if job is None:
+                return None
+            rows = self._conn.execute(
+                "SELECT idx, status, attempts, result, error, usage FROM items WHERE job_id = ? ORDER BY idx",
+                (job_id,),
+            ).fetchall()
+        status, created, finished, webhook, webhook_status = job
+        items = []
+        counts = {"queued": 0, "running": 0, "done": 0, "error": 0, "cancelled": 0}
+        for idx, item_status, attempts, result, error, usage in rows:
+            counts[item_status] = counts.get(item_status, 0) + 1
+            item: Dict[str, Any] = {"index": idx, "status": item_status, "attempts": attempts}
+            if result is not None:
+                item["result"] = result
+            if error is not None:
+                item["error"] = error
+            if usage:
+                item["usage"] = json.loads(usage)
+            items.append(item)
+        job_info: Dict[str, Any] = {
+            "id": job_id,
+            "status": status,
+            "created": created,
+            "finished": finished,
+            "total": len(items),
+            **counts,
+            "items": items,
+        }
+        if webhook:
+            job_info["webhook"] = {"url": webhook, "status": webhook_status or "pending"}
+        return job_info
+
+    def pending_webhooks(self) -> List[str]:
+        with self._lock:
+            return [
+                row[0]
+                for row in self._conn.execute(
+                    "SELECT id FROM jobs WHERE finished IS NOT NULL AND webhook IS NOT NULL AND webhook_status IS NULL"
+                )
+            ]
+
+    def set_webhook_status(self, job_id: str, status: str) -> None:
+        with self._lock:
+            self._conn.execute("UPDATE jobs SET webhook_status = ? WHERE id = ?", (status, job_id))
+
+    def purge(self, older_than: float) -> int:
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                old = [
+                    row[0]
+                    for row in self._conn.execute(
+                        "SELECT id FROM jobs WHERE finished IS NOT NULL AND finished < ?", (older_than,)
+                    )
+                ]
+                self._conn.executemany("DELETE FROM items WHERE job_id = ?", [(job_id,) for job_id in old])
+                self._conn.executemany("DELETE FROM jobs WHERE id = ?", [(job_id,) for job_id in old])
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return len(old)
+
+    def backlog(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM items WHERE status = 'queued'").fetchone()[0]
+
+
+class JobManager:
+    # Переносит элементы заданий из JobStore в очередь допуска понемногу (не больше max_inflight
+    # за раз, с низшим приоритетом), записывает результаты и шлёт webhook о завершении задания
+    def __init__(
+        self,
+        task_queue,
+        result_broker,
+        response_cache=None,
+        store: JobStore | None = None,
+        max_inflight: int | None = None,
+    ) -> None:
+        self.task_queue = task_queue
+        self.result_broker = result_broker
+        self.response_cache = response_cache
+        self.store = store or JobStore(Path(config.JOBS_DB))
+        self.max_inflight = max(
+            1, max_inflight or config.JOBS_MAX_INFLIGHT or 2 * config.NUM_WORKERS * config.BATCH_MAX_SIZE
+        )
+        # task_id -> (id задания, номер элемента)
+        self._inflight: Dict[int, Tuple[str, int]] = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._webhooks: "queue.Queue[str]" = queue.Queue()
+
+        metrics.REGISTRY.gauge_callback(
+            "vlm_jobs_backlog",
+            "Job items stored on disk and not yet handed to the admission queue.",
+            self.store.backlog,
+        )
+
+    def start(self) -> None:
+        replayed = self.store.recover()
+        if replayed:
+            metrics.JOB_REPLAYED.inc(replayed)
+        for job_id in self.store.pending_webhooks():
+            self._webhooks.put(job_id)
+        threading.Thread(target=self._feed_loop, name="JobFeeder", daemon=True).start()
+        threading.Thread(target=self._webhook_loop, name="JobWebhooks", daemon=True).start()
+        logger.info(
+            f"[JobManager] Started ✅ (db={self.store.path}, in flight={self.max_inflight}, replayed={replayed})"
+        )
+
+    def submit(self, items: List[Tuple[Dict[str, Any], bytes]], webhook: str | None = None) -> str:
+        job_id = uuid.uuid4().hex
+        tasks = [({key: task.get(key) for key in _TASK_FIELDS}, image) for task, image in items]
+        self.store.add(job_id, tasks, webhook)
+        self._wakeup.set()
+        return job_id
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        return self.store.get(job_id)
+
+    def cancel(self, job_id: str) -> bool:
+        cancelled = self.store.cancel(job_id)
+        if cancelled is None:
+            return False
+        final, running = cancelled
+        cancel = getattr(self.task_queue, "cancel", None)
+        for task_id in running:
+            # Ещё в очереди — ошибка об отмене придёт через брокер; уже считается — досчитается
+            if cancel is not None and task_id is not None:
+                cancel(task_id)
+        if final is not None:
+            self._job_finished(job_id)
+        return True
+
+    def _feed_loop(self) -> None:
+        next_purge = 0.0
+        while True:
+            if time.monotonic() >= next_purge:
+                try:
+                    purged = self.store.purge(time.time() - config.JOBS_TTL_S)
+                    if purged:
+                        logger.info(f"[JobManager] Purged {purged} finished job(s)")
+                except Exception:
+                    logger.exception("[JobManager] Purge failed")
+                next_purge = time.monotonic() + _PURGE_INTERVAL_S
+
+            with self._lock:
+                free = self.max_inflight - len(self._inflight)
+            try:
+                rows = self.store.next_queued(free) if free > 0 else []
+            except Exception:
+                logger.exception("[JobManager] Failed to read queued items")
+                rows = []
+            if not rows:
+                self._wakeup.wait(1.0)
+                self._wakeup.clear()
+                continue
+            for job_id, idx, task, image, attempts in rows:
+                retry_after = self._feed(job_id, idx, task, image, attempts)
+                if retry_after is not None:
+                    # Очередь допуска полна — ждём, а не крутимся; интерактивные запросы важнее
+                    time.sleep(min(max(retry_after, 0.5), 5.0))
+                    break
+
+    def _feed(self, job_id: str, idx: int, stored: Dict[str, Any], image: bytes, attempts: int) -> Optional[float]:
+        if attempts >= config.JOBS_MAX_ATTEMPTS:
+            # Элемент, на котором сервер падал раз за разом, больше не запускаем
+            self._finish(job_id, idx, "error", error=f"Gave up after {attempts} attempts.")
+            return None
+
+        task_id = new_task_id()
+        task = {
+            "id": task_id,
+            "image_bytes": image,
+            **stored,
+            "source": "jobs",
+            "priority": PRIORITY_BACKGROUND,
+            "enqueued_at": time.time(),
+            # Задание не ограничено VLM_INFERENCE_TIMEOUT: ждёт в очереди сколько нужно
+            "deadline": None,
+        }
+        with self._lock:
+            self._inflight[task_id] = (job_id, idx)
+        # Без срока: элемент может ждать в очереди дольше VLM_BROKER_TTL_S, и ошибка «expired» стала бы окончательной
+        self.result_broker.register_callback(task_id, self._on_result, ttl=math.inf)
+        try:
+            self.store.mark_running(job_id, idx, task_id)
+            if self.response_cache is not None:
+                cached = self.response_cache.submit(self.task_queue, task, image)
+            else:
+                cached = None
+                self.task_queue.put(task)
+        except QueueFullError as e:
+            self._forget(task_id)
+            self.store.mark_queued(job_id, idx)
+            return e.retry_after
+        except UnknownModelError as e:
+            self._forget(task_id)
+            self._finish(job_id, idx, "error", error=str(e))
+            return None
+        except Exception:
+            # Любая другая ошибка (удалённая очередь недоступна, сбой диска) не должна останавливать поток:
+            # элемент вернётся в очередь, а после VLM_JOBS_MAX_ATTEMPTS попыток получит ошибку
+            logger.exception(f"[JobManager] Failed to queue {job_id}[{idx}]")
+            self._forget(task_id)
+            try:
+                self.store.mark_queued(job_id, idx, count_attempt=True)
+            except Exception:
+                logger.exception(f"[JobManager] Failed to requeue {job_id}[{idx}]")
+            return 1.0
+
+        if cached is not None:
+            self._forget(task_id)
+            self._finish(job_id, idx, "done", result=cached, outcome="cached")
+        return None
+
+    def _forget(self, task_id: int) -> None:
+        with self._lock:
+            self._inflight.pop(task_id, None)
+        self.result_broker.discard(task_id)
+
+    def _on_result(self, message: Dict[str, Any]) -> None:
+        with self._lock:
+            entry = self._inflight.pop(message.get("id"), None)
+        if entry is None:
+            return
+        job_id, idx = entry
+        timing = message.get("timing") or {}
+        usage = {
+            key: timing[key]
+            for key in ("input_tokens", "output_tokens", "used_tokens", "stop_reason", "tiles")
+            if key in timing
+        }
+        if "error" in message:
+            self._finish(job_id, idx, "error", error=message["error"])
+        else:
+            self._finish(job_id, idx, "done", result=message.get("result", ""), usage=usage)
+        self._wakeup.set()
+
+    def _finish(self, job_id: str, idx: int, status: str, outcome: str | None = None, **fields: Any) -> None:
+        try:
+            final = self.store.finish(job_id, idx, status, **fields)
+        except Exception:
+            logger.exception(f"[JobManager] Failed to store the result of {job_id}[{idx}]")
+            return
+        metrics.JOB_ITEMS.inc(status=outcome or status)
+        if final is not None:
+            self._job_finished(job_id)
+
+    def _job_finished(self, job_id: str) -> None:
+        logger.info(f"[JobManager] Job {job_id} finished")
+        self._webhooks.put(job_id)
+
+    def _webhook_loop(self) -> None:
+        while True:
+            job_id = self._webhooks.get()
+            job = self.store.get(job_id)
+            if job is None or "webhook" not in job or job["webhook"]["status"] != "pending":
+                continue
+            url = job.pop("webhook")["url"]
+            status = "failed"
+            for attempt in range(config.JOBS_WEBHOOK_RETRIES):
+                try:
+                    response = requests.post(url, json=job, timeout=_WEBHOOK_TIMEOUT_S)
+                    if response.status_code < 400:
+                        status = "delivered"
+                        break
+                    error = f"HTTP {response.status_code}"
+                except requests.RequestException as e:
+                    error = str(e)
+                logger.warning(f"[JobManager] Webhook for job {job_id} failed ({error}), attempt {attempt + 1}")
+                time.sleep(min(2 ** attempt, 30))
+            metrics.JOB_WEBHOOKS.inc(outcome=status)
+            self.store.set_webhook_status(job_id, status)
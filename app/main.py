@@ -1,16 +1,21 @@
+import asyncio
 import logging
-import queue
+import threading
 from typing import Any, Dict
 
 from fastapi import FastAPI
-from fastapi.responses import PlainTextResponse, RedirectResponse
-from gradio.routes import mount_gradio_app
+from fastapi.responses import JSONResponse, PlainTextResponse, RedirectResponse
 
 from . import config
-from .inference import InferenceWorker
+from . import metrics
 from .result_broker import ResultBroker
+from .response_cache import ResponseCache
+from .router import ModelRouter
+from .payload import cleanup_task
 from .api_handler import ApiHandler
-from .ui import GradioUI
+from .startup import StartupState
+
+logger = logging.getLogger(__name__)
 
 
 def create_app() -> FastAPI:
@@ -19,34 +24,92 @@ def create_app() -> FastAPI:
         format="[%(asctime)s] [%(levelname)s] %(name)s: %(message)s",
     )
 
-    task_queue: "queue.Queue[Dict[str, Any]]" = queue.Queue()
-
+    startup = StartupState()
     broker = ResultBroker()
 
-    worker = InferenceWorker(
-        task_queue=task_queue,
-        result_queue=broker.incoming,
-        model_id=config.MODEL_ID,
-    )
-    worker.start(warmup=True)
-
-    ui_builder = GradioUI(task_queue=task_queue, result_broker=broker)
-    demo = ui_builder.build()
+    def report_drop(task: Dict[str, Any], reason: str) -> None:
+        cleanup_task(task)
+        broker.incoming.put({"id": task.get("id"), "error": f"Task was {reason} before processing."})
+
+    if config.TRANSPORT == "tcp":
+        # Модель на отдельных воркер-узлах: задачи уходят брокеру, результаты приходят в broker.incoming
+        from .transport import RemoteTaskQueue
+
+        task_queue = RemoteTaskQueue(result_queue=broker.incoming)
+    else:
+        # Своя очередь допуска у каждой модели; task_queue выбирает модель и кладёт задачу в её очередь
+        task_queue = ModelRouter(result_queue=broker.incoming, on_drop=report_drop)
+    response_cache = ResponseCache(broker)
+
+    job_manager = None
+    if config.JOBS_DB:
+        # Задания на диске: незавершённые после прошлого запуска сразу снова встают в очередь
+        from .jobs import JobManager
+
+        try:
+            job_manager = JobManager(task_queue, broker, response_cache)
+            job_manager.start()
+        except Exception as e:
+            logger.warning(f"[Jobs] /ptt/jobs disabled, can't open {config.JOBS_DB}: {e}")
+            job_manager = None
+
+    def load_model() -> None:
+        # Задачи, пришедшие до готовности, просто ждут в очереди; трафик держит /ready.
+        # Остальные модели из VLM_MODELS грузятся при первом запросе к ним.
+        try:
+            task_queue.load(config.MODEL_SIZE, warmup=config.WARMUP, phase=startup.phase)
+            startup.mark_ready()
+        except Exception as e:
+            startup.mark_failed(e)
+
+    # Загрузка модели идёт параллельно со сборкой UI и FastAPI
+    threading.Thread(target=load_model, name="ModelLoader", daemon=True).start()
 
     app = FastAPI(title="SmolVLM2 Demo — UI + API")
 
     @app.get("/", response_class=RedirectResponse)
     async def root_redirect():
-        return "/ui"
+        return "/ui" if config.ENABLE_UI else "/ptt/docs"
 
     @app.get("/health", response_class=PlainTextResponse)
     async def health():
+        # Liveness: процесс жив, даже если модель ещё грузится
         return "ok"
 
-    mount_gradio_app(app, demo, path="/ui")
-
-    api = ApiHandler(task_queue=task_queue, result_broker=broker)
-    app.mount("/ptt", api.app)
+    @app.get("/ready")
+    async def ready():
+        state = startup.snapshot()
+        state["models"] = await asyncio.to_thread(task_queue.snapshot)
+        # Фронтенд с VLM_TRANSPORT=tcp готов, только пока соединение с брокером живо, а не с первого подключения
+        connected = getattr(task_queue, "is_connected", None)
+        if connected is not None and not connected():
+            state["ready"] = False
+            state["task_broker"] = "disconnected"
+        return JSONResponse(state, status_code=200 if state["ready"] else 503)
+
+    @app.get("/metrics", response_class=PlainTextResponse)
+    async def metrics_endpoint():
+        return PlainTextResponse(
+            metrics.REGISTRY.render(),
+            media_type="text/plain; version=0.0.4",
+        )
+
+    with startup.phase("api_build"):
+        api = ApiHandler(
+            task_queue=task_queue, result_broker=broker, response_cache=response_cache, job_manager=job_manager
+        )
+        app.mount("/ptt", api.app)
+
+    if config.ENABLE_UI:
+        # Gradio импортируется только когда UI нужен: API-only поды стартуют без него
+        with startup.phase("ui_build"):
+            from gradio.routes import mount_gradio_app
+
+            from .ui import GradioUI
+
+            ui_builder = GradioUI(task_queue=task_queue, result_broker=broker, response_cache=response_cache)
+            demo = ui_builder.build()
+            mount_gradio_app(app, demo, path="/ui")
 
     return app
 
@@ -0,0 +1,372 @@
+import math
+import threading
+from typing import Callable, Dict, Iterable, List, Tuple
+
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+def _label_key(labels: Dict[str, object]) -> LabelKey:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(key: LabelKey, extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    body = ",".join(f'{k}="{v}"' for k, v in pairs)
+    return "{" + body + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str) -> None:
+        self.name = name
+        self.documentation = documentation
+        self._values: Dict[LabelKey, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels: object) -> None:
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels: object) -> float:
+        with self._lock:
+            return self._values.get(_label_key(labels), 0.0)
+
+    def render(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} counter",
+        ]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.append(f"{self.name}{_format_labels(key)} {_format_value(value)}")
+        return lines
+
+
+class CallbackGauge:
+    def __init__(self, name: str, documentation: str, callback: Callable[[], float]) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+
+    def render(self) -> List[str]:
+        try:
+            value = float(self.callback())
+        except Exception:
+            return []
+        return [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} gauge",
+            f"{self.name} {_format_value(value)}",
+        ]
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, buckets: Iterable[float]) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.buckets: List[float] = sorted(float(b) for b in buckets) + [math.inf]
+        self._series: Dict[LabelKey, Dict[str, object]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: object) -> None:
+        key = _label_key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+                self._series[key] = series
+            counts = series["counts"]
+            for i, upper in enumerate(self.buckets):
+                if value <= upper:
+                    counts[i] += 1
+                    break
+            series["sum"] += value
+            series["count"] += 1
+
+    def snapshot(self) -> Dict[LabelKey, Dict[str, object]]:
+        with self._lock:
+            return {
+                key: {"counts": list(s["counts"]), "sum": s["sum"], "count": s["count"]}
+                for key, s in self._series.items()
+            }
+
+    def render(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} histogram",
+        ]
+        for key, series in sorted(self.snapshot().items()):
+            cumulative = 0
+            for upper, count in zip(self.buckets, series["counts"]):
+                cumulative += count
+                le = (("le", _format_value(upper)),)
+                lines.append(f"{self.name}_bucket{_format_labels(key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {_format_value(series['sum'])}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {series['count']}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self) -> None:
+        self._metrics: Dict[str, object] = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def histogram(self, name: str, documentation: str, buckets: Iterable[float]) -> Histogram:
+        return self._register(Histogram(name, documentation, buckets))
+
+    def counter(self, name: str, documentation: str) -> Counter:
+        return self._register(Counter(name, documentation))
+
+    def gauge_callback(self, name: str, documentation: str, callback: Callable[[], float]) -> CallbackGauge:
+        gauge = CallbackGauge(name, documentation, callback)
+        with self._lock:
+            # Колбэк перерегистрируется, если объект-источник пересоздан
+            self._metrics[name] = gauge
+        return gauge
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines: List[str] = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+BATCH_SIZE = REGISTRY.histogram(
+    "vlm_batch_size",
+    "Number of tasks served by a single generate() call.",
+    buckets=(1, 2, 3, 4, 6, 8, 12, 16, 32),
+)
+
+QUEUE_WAIT_SECONDS = REGISTRY.histogram(
+    "vlm_queue_wait_seconds",
+    "Time a task spent in task_queue before the worker picked it up, by mode and source.",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120),
+)
+
+IMAGE_CACHE_REQUESTS = REGISTRY.counter(
+    "vlm_image_cache_requests_total",
+    "Image feature cache lookups by result (hit/miss).",
+)
+
+PREFIX_CACHE_REQUESTS = REGISTRY.counter(
+    "vlm_prefix_cache_requests_total",
+    "Prefix KV-cache lookups by result (hit/miss).",
+)
+
+PREFILL_TOKENS_SAVED = REGISTRY.counter(
+    "vlm_prefill_tokens_saved_total",
+    "Prompt tokens whose prefill was skipped thanks to the prefix KV-cache.",
+)
+
+RESPONSE_CACHE_REQUESTS = REGISTRY.counter(
+    "vlm_response_cache_requests_total",
+    "Response cache lookups by result (hit/miss/coalesced/promoted) and tier.",
+)
+
+QUEUE_REJECTED = REGISTRY.counter(
+    "vlm_queue_rejected_total",
+    "Tasks rejected at admission (queue full or estimated wait too long).",
+)
+
+QUEUE_DROPPED = REGISTRY.counter(
+    "vlm_queue_dropped_total",
+    "Queued tasks dropped before inference (cancelled or expired).",
+)
+
+IMAGE_READ_SECONDS = REGISTRY.histogram(
+    "vlm_image_read_seconds",
+    "Time to get the raw image bytes in the worker, by source (memory/disk).",
+    buckets=(0.00001, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1),
+)
+
+IMAGE_DECODE_SECONDS = REGISTRY.histogram(
+    "vlm_image_decode_seconds",
+    "Time to decode and convert an image to RGB (image cache misses only).",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+)
+
+UPLOAD_SPOOL_SECONDS = REGISTRY.histogram(
+    "vlm_upload_spool_seconds",
+    "Time spent writing large uploads to the spool directory.",
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5),
+)
+
+PREPROCESS_SECONDS = REGISTRY.histogram(
+    "vlm_preprocess_seconds",
+    "Time to read, decode and split an image into patches off the model thread, by mode.",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+)
+
+# --- Стадии генерации (по режимам) ---
+_STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+IMAGE_ENCODE_SECONDS = REGISTRY.histogram(
+    "vlm_image_encode_seconds",
+    "Time to get image features on the model thread (vision encoder, or a cache hit), by mode.",
+    buckets=_STAGE_BUCKETS,
+)
+
+PREFILL_SECONDS = REGISTRY.histogram(
+    "vlm_prefill_seconds",
+    "Time from the start of generate() to the first new token, by mode.",
+    buckets=_STAGE_BUCKETS,
+)
+
+DECODE_SECONDS = REGISTRY.histogram(
+    "vlm_decode_seconds",
+    "Time from the first to the last new token, by mode.",
+    buckets=_STAGE_BUCKETS,
+)
+
+INPUT_TOKENS = REGISTRY.counter(
+    "vlm_input_tokens_total",
+    "Prompt tokens fed to the model (including image tokens), by mode.",
+)
+
+OUTPUT_TOKENS = REGISTRY.counter(
+    "vlm_output_tokens_total",
+    "Tokens generated by the model, by mode.",
+)
+
+USED_TOKENS = REGISTRY.counter(
+    "vlm_output_tokens_used_total",
+    "Generated tokens that ended up in the answer (after stop strings / loop trimming), by mode.",
+)
+
+GENERATION_STOPS = REGISTRY.counter(
+    "vlm_generation_stops_total",
+    "Why generation ended, by mode and reason (eos/budget/stop_string/loop/end_of_answer).",
+)
+
+DECODE_TOKENS_PER_SECOND = REGISTRY.histogram(
+    "vlm_decode_tokens_per_second",
+    "Decode speed of a single task, by mode.",
+    buckets=(1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200, 300),
+)
+
+# --- Несколько моделей ---
+MODEL_ROUTES = REGISTRY.counter(
+    "vlm_model_routes_total",
+    "Tasks sent to each model, by reason (requested/mode/slo).",
+)
+
+MODEL_LOADS = REGISTRY.counter(
+    "vlm_model_loads_total",
+    "Times a model's weights were loaded, by model.",
+)
+
+MODEL_LOAD_SECONDS = REGISTRY.histogram(
+    "vlm_model_load_seconds",
+    "Time to load a model and start its workers, by model.",
+    buckets=(1, 2.5, 5, 10, 20, 30, 60, 120, 300),
+)
+
+MODEL_EVICTIONS = REGISTRY.counter(
+    "vlm_model_evictions_total",
+    "Models unloaded from memory, by model and reason (memory/idle).",
+)
+
+# --- Спекулятивное декодирование ---
+DRAFT_TOKENS = REGISTRY.counter(
+    "vlm_draft_tokens_total",
+    "Tokens proposed by the draft model, by mode.",
+)
+
+DRAFT_ACCEPTED_TOKENS = REGISTRY.counter(
+    "vlm_draft_accepted_tokens_total",
+    "Draft tokens confirmed by the target model, by mode.",
+)
+
+DRAFT_ACCEPTANCE = REGISTRY.histogram(
+    "vlm_draft_acceptance_ratio",
+    "Share of draft tokens accepted per task, by mode.",
+    buckets=(0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 0.95, 1),
+)
+
+BROKER_DELIVERY_SECONDS = REGISTRY.histogram(
+    "vlm_broker_delivery_seconds",
+    "Time from the worker publishing a final result to the broker handing it to the waiter.",
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1),
+)
+
+BROKER_REAPED = REGISTRY.counter(
+    "vlm_broker_reaped_total",
+    "Broker entries removed after VLM_BROKER_TTL_S, by kind (waiters/pending/tombstones).",
+)
+
+BROKER_DROPPED = REGISTRY.counter(
+    "vlm_broker_dropped_total",
+    "Messages dropped by the broker because nobody waits for them any more, by reason.",
+)
+
+# --- Запросы по точкам входа ---
+REQUESTS = REGISTRY.counter(
+    "vlm_requests_total",
+    "Finished requests by mode, entry point (api/ui) and outcome (ok/cached/error/timeout/rejected).",
+)
+
+REQUEST_SECONDS = REGISTRY.histogram(
+    "vlm_request_seconds",
+    "End-to-end request latency by mode and entry point.",
+    buckets=_STAGE_BUCKETS,
+)
+
+# --- Видео ---
+VIDEO_SAMPLE_SECONDS = REGISTRY.histogram(
+    "vlm_video_sample_seconds",
+    "Time to decode a clip and pick its frames.",
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+
+VIDEO_FRAMES = REGISTRY.histogram(
+    "vlm_video_frames",
+    "Frames sent to the model per video after sampling and deduplication.",
+    buckets=(1, 2, 4, 8, 12, 16, 24, 32, 48, 64),
+)
+
+# --- OCR документов ---
+OCR_TILES = REGISTRY.histogram(
+    "vlm_ocr_tiles",
+    "Strips a tiled OCR page was split into (blank strips excluded).",
+    buckets=(1, 2, 3, 4, 6, 8, 12, 16),
+)
+
+# --- Фоновые задания ---
+JOB_ITEMS = REGISTRY.counter(
+    "vlm_job_items_total",
+    "Finished /ptt/jobs items by outcome (done/error/cancelled/cached).",
+)
+
+JOB_REPLAYED = REGISTRY.counter(
+    "vlm_job_replayed_total",
+    "Job items that were in flight when the server stopped and were queued again on startup.",
+)
+
+JOB_WEBHOOKS = REGISTRY.counter(
+    "vlm_job_webhooks_total",
+    "Job completion webhooks by outcome (delivered/failed).",
+)
@@ -0,0 +1,81 @@
+import logging
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Any, Dict
+
+from . import config
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# Свои файлы в uploads/ узнаём по префиксу: каталог могут делить несколько процессов и чужие файлы
+SPOOL_PREFIX = "vlm-spool-"
+
+
+def build_image_payload(raw: bytes, filename: str | None, spool_dir: Path) -> Dict[str, Any]:
+    # Небольшие картинки едут через очередь прямо в памяти,
+    # крупные — во временный файл, который удалит воркер.
+    if len(raw) <= config.SPOOL_THRESHOLD_BYTES:
+        return {"image_bytes": raw}
+
+    suffix = Path(filename or "").suffix or ".png"
+    path = Path(spool_dir) / f"{SPOOL_PREFIX}{uuid.uuid4().hex}{suffix}"
+    started = time.perf_counter()
+    path.write_bytes(raw)
+    metrics.UPLOAD_SPOOL_SECONDS.observe(time.perf_counter() - started)
+    return {"image_path": str(path), "cleanup": True}
+
+
+def task_image(task: Dict[str, Any]) -> bytes | str:
+    image_bytes = task.get("image_bytes")
+    if image_bytes is not None:
+        return image_bytes
+    return task["image_path"]
+
+
+def read_task_image(task: Dict[str, Any]) -> bytes:
+    image = task_image(task)
+    if isinstance(image, (bytes, bytearray)):
+        return bytes(image)
+    return Path(image).read_bytes()
+
+
+def cleanup_task(task: Dict[str, Any]) -> None:
+    if not task.get("cleanup") or not task.get("image_path"):
+        return
+    try:
+        Path(task["image_path"]).unlink(missing_ok=True)
+    except OSError as e:
+        logger.warning(f"[Payload] Failed to remove spooled file {task['image_path']}: {e}")
+
+
+def sweep_spool_dir(spool_dir: Path, max_age: float) -> int:
+    # Подчищает файлы, которые не дошли до воркера (отказ, дубликат, падение)
+    removed = 0
+    cutoff = time.time() - max_age
+    for path in Path(spool_dir).glob(f"{SPOOL_PREFIX}*"):
+        try:
+            if path.is_file() and path.stat().st_mtime < cutoff:
+                path.unlink()
+                removed += 1
+        except OSError:
+            continue
+    if removed:
+        logger.info(f"[Payload] Removed {removed} stale spooled file(s) from {spool_dir}")
+    return removed
+
+
+def start_spool_sweeper(spool_dir: Path, max_age: float, interval: float = 60.0) -> threading.Thread:
+    def loop() -> None:
+        while True:
+            try:
+                sweep_spool_dir(spool_dir, max_age)
+            except Exception:
+                logger.exception("[Payload] Spool sweep failed")
+            time.sleep(interval)
+
+    thread = threading.Thread(target=loop, name="SpoolSweeper", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,97 @@
+import copy
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Sequence
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def cache_nbytes(past_key_values: Any) -> int:
+    layers = getattr(past_key_values, "layers", None)
+    if layers is not None:
+        tensors = [t for layer in layers for t in (layer.keys, layer.values) if t is not None]
+    else:
+        tensors = list(past_key_values.key_cache) + list(past_key_values.value_cache)
+    return sum(t.element_size() * t.nelement() for t in tensors)
+
+
+class PrefixEntry:
+    __slots__ = ("past_key_values", "length", "nbytes")
+
+    def __init__(self, past_key_values: Any, length: int) -> None:
+        self.past_key_values = past_key_values
+        self.length = length
+        self.nbytes = cache_nbytes(past_key_values)
+
+
+class PrefixCache:
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max(0, int(max_bytes))
+        self._entries: "OrderedDict[str, PrefixEntry]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+        metrics.REGISTRY.gauge_callback(
+            "vlm_prefix_cache_bytes",
+            "Memory held by cached prefix past_key_values.",
+            lambda: self.current_bytes,
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    @staticmethod
+    def make_key(token_ids: Sequence[int], image_key: str | None = None) -> str:
+        h = hashlib.sha256()
+        h.update((image_key or "").encode("utf-8"))
+        h.update(b"\0")
+        h.update(",".join(str(t) for t in token_ids).encode("ascii"))
+        return h.hexdigest()
+
+    def get(self, key: str) -> Optional[PrefixEntry]:
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+            else:
+                self._entries.move_to_end(key)
+                self.hits += 1
+        metrics.PREFIX_CACHE_REQUESTS.inc(result="miss" if entry is None else "hit")
+        return entry
+
+    def put(self, key: str, entry: PrefixEntry) -> None:
+        if not self.enabled or entry.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.current_bytes -= old.nbytes
+            self._entries[key] = entry
+            self.current_bytes += entry.nbytes
+            while self.current_bytes > self.max_bytes and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self.current_bytes -= evicted.nbytes
+
+    @staticmethod
+    def fork(entry: PrefixEntry) -> Any:
+        # generate() дописывает в кэш новые токены, поэтому отдаём копию
+        return copy.deepcopy(entry.past_key_values)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
@@ -0,0 +1,205 @@
+import io
+import math
+import queue
+import logging
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List
+
+import torch
+from PIL import Image
+
+from . import config
+from . import metrics
+from .image_cache import CachedImage, ImageFeatureCache
+from .payload import task_image
+from .tiling import PreparedDocument, needs_tiling, plan_tiles, tiling_mode
+from .video import PreparedVideo, prepare_video
+
+logger = logging.getLogger(__name__)
+
+
+class PreparedImage:
+    __slots__ = ("key", "cached", "pixel_values", "pixel_attention_mask", "rows", "cols")
+
+    def __init__(
+        self,
+        key: str,
+        cached: CachedImage | None = None,
+        pixel_values: torch.Tensor | None = None,
+        pixel_attention_mask: torch.Tensor | None = None,
+        rows: int = 0,
+        cols: int = 0,
+    ) -> None:
+        self.key = key
+        self.cached = cached
+        self.pixel_values = pixel_values
+        self.pixel_attention_mask = pixel_attention_mask
+        self.rows = rows
+        self.cols = cols
+
+
+def read_image_bytes(source: bytes | str) -> bytes:
+    started = time.perf_counter()
+    if isinstance(source, (bytes, bytearray)):
+        raw = bytes(source)
+        origin = "memory"
+    else:
+        raw = Path(source).read_bytes()
+        origin = "disk"
+    metrics.IMAGE_READ_SECONDS.observe(time.perf_counter() - started, source=origin)
+    return raw
+
+
+def decode_image(raw: bytes, longest_edge: int | None = None) -> Image.Image:
+    started = time.perf_counter()
+    image = Image.open(io.BytesIO(raw))
+    if longest_edge and image.format == "JPEG":
+        # JPEG умеет декодироваться сразу в 1/2, 1/4, 1/8 разрешения;
+        # просим размер не меньше того, до которого процессор всё равно уменьшит
+        width, height = image.size
+        scale = longest_edge / max(width, height)
+        if scale < 1.0:
+            image.draft("RGB", (math.ceil(width * scale), math.ceil(height * scale)))
+    image = image.convert("RGB")
+    metrics.IMAGE_DECODE_SECONDS.observe(time.perf_counter() - started)
+    return image
+
+
+def processor_longest_edge(image_processor: Any) -> int | None:
+    size = getattr(image_processor, "size", None) or {}
+    edge = size.get("longest_edge") if isinstance(size, dict) else None
+    return int(edge) if edge else None
+
+
+def prepare_image(worker: Any, source: bytes | str) -> PreparedImage:
+    # Всё, что не требует модели: чтение, хеш, поиск в кэше, декодирование, нарезка на патчи
+    raw = read_image_bytes(source)
+    key = ImageFeatureCache.make_key(raw, worker._cache_namespace)
+    cached = worker.image_cache.get(key)
+    if cached is not None:
+        return PreparedImage(key, cached=cached)
+
+    image_processor = worker.processor.image_processor
+    image = decode_image(raw, processor_longest_edge(image_processor))
+    return _process_image(image_processor, key, image)
+
+
+def _process_image(image_processor: Any, key: str, image: Image.Image) -> PreparedImage:
+    image_inputs = image_processor([[image]], return_row_col_info=True, return_tensors="pt")
+    return PreparedImage(
+        key,
+        pixel_values=image_inputs["pixel_values"],
+        pixel_attention_mask=image_inputs.get("pixel_attention_mask"),
+        rows=int(image_inputs["rows"][0][0]),
+        cols=int(image_inputs["cols"][0][0]),
+    )
+
+
+def prepare_document(worker: Any, source: bytes | str, tiling: str) -> PreparedImage | PreparedDocument:
+    # Страница режется на полосы, только если иначе процессор сильно её уменьшит;
+    # размер берётся из заголовка, без декодирования
+    raw = read_image_bytes(source)
+    image_processor = worker.processor.image_processor
+    longest_edge = processor_longest_edge(image_processor)
+    with Image.open(io.BytesIO(raw)) as header:
+        size = header.size
+    if not needs_tiling(size, longest_edge, tiling):
+        return prepare_image(worker, raw)
+
+    image = decode_image(raw)
+    boxes, overlaps = plan_tiles(image, longest_edge, config.OCR_TILE_OVERLAP, config.OCR_MAX_TILES)
+    tiles = []
+    for box in boxes:
+        # У каждой полосы своя запись в кэше признаков: повторная страница не кодируется заново
+        key = ImageFeatureCache.make_key(raw, f"{worker._cache_namespace}|tile={box}")
+        cached = worker.image_cache.get(key)
+        if cached is not None:
+            tiles.append(PreparedImage(key, cached=cached))
+        else:
+            tiles.append(_process_image(image_processor, key, image.crop(box)))
+    metrics.OCR_TILES.observe(len(tiles))
+    return PreparedDocument(tiles, boxes, overlaps, size)
+
+
+def prepare_task(worker: Any, task: Dict[str, Any]) -> PreparedImage | PreparedVideo | PreparedDocument:
+    if task.get("mode") == "video":
+        return prepare_video(worker, task_image(task), task.get("sampling"), task.get("max_frames"))
+    if task.get("mode") == "ocr" and tiling_mode(task.get("tiling")) != "off":
+        return prepare_document(worker, task_image(task), tiling_mode(task.get("tiling")))
+    return prepare_image(worker, task_image(task))
+
+
+class Preprocessor:
+    def __init__(self, worker: Any, source: Any, num_threads: int, max_prepared: int) -> None:
+        self.worker = worker
+        self.source = source
+        self.prepared: "queue.Queue[Dict[str, Any]]" = queue.Queue(maxsize=max(1, max_prepared))
+        self.threads: List[threading.Thread] = []
+        self._stopping = threading.Event()
+        self._leftover: List[Dict[str, Any]] = []
+        for idx in range(max(1, num_threads)):
+            thread = threading.Thread(target=self._loop, name=f"Preprocessor-{idx}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+        metrics.REGISTRY.gauge_callback(
+            "vlm_prepared_queue_depth",
+            "Preprocessed tasks waiting for the model worker.",
+            self.prepared.qsize,
+        )
+        logger.info(
+            f"[Preprocessor] {len(self.threads)} thread(s) started ✅ (prepared queue size={self.prepared.maxsize})"
+        )
+
+    def get(self, block: bool = True, timeout: float | None = None) -> Dict[str, Any]:
+        return self.prepared.get(block=block, timeout=timeout)
+
+    def begin_stop(self) -> None:
+        # Новые задачи из source больше не берём; уже взятые окажутся в prepared или в _leftover
+        self._stopping.set()
+
+    def stop(self) -> List[Dict[str, Any]]:
+        # Возвращает задачи, которые взяты из source, но модели уже не достанутся
+        self.begin_stop()
+        for thread in self.threads:
+            # Подготовка одной задачи конечна, а без join задача, взятая в последний момент, потерялась бы
+            thread.join()
+        leftover = list(self._leftover)
+        self._leftover.clear()
+        while True:
+            try:
+                leftover.append(self.prepared.get_nowait())
+            except queue.Empty:
+                return leftover
+
+    def _loop(self) -> None:
+        while not self._stopping.is_set():
+            try:
+                task = self.source.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if self._stopping.is_set():
+                # Взяли уже после остановки: задачу вернёт в очередь тот, кто нас останавливает
+                self._leftover.append(task)
+                return
+            started = time.perf_counter()
+            try:
+                task["prepared"] = prepare_task(self.worker, task)
+            except Exception as e:
+                logger.exception("[Preprocessor] Failed to prepare task")
+                task["prepare_error"] = e
+            elapsed = time.perf_counter() - started
+            task.setdefault("timing", {})["preprocess_s"] = elapsed
+            metrics.PREPROCESS_SECONDS.observe(elapsed, mode=task.get("mode", "chat"))
+            # Блокируется, если модель не успевает: естественное обратное давление.
+            # После остановки воркеры модели prepared уже не читают — не ждём их вечно
+            while True:
+                try:
+                    self.prepared.put(task, timeout=0.5)
+                    break
+                except queue.Full:
+                    if self._stopping.is_set():
+                        self._leftover.append(task)
+                        return
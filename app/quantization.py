@@ -0,0 +1,61 @@
+import logging
+from typing import List
+
+import torch
+from torch import nn
+
+logger = logging.getLogger(__name__)
+
+QUANT_MODES = ("none", "bf16", "int8-dynamic", "int8-weight-only")
+
+
+def validate_mode(mode: str) -> str:
+    mode = (mode or "none").lower()
+    if mode not in QUANT_MODES:
+        raise ValueError(f"Invalid VLM_QUANT={mode!r}. Use one of: {', '.join(QUANT_MODES)}")
+    return mode
+
+
+def load_dtype(mode: str, device: torch.device) -> torch.dtype:
+    # На GPU всегда bf16; на CPU — bf16 только если его попросили явно.
+    # int8-режимы квантуют fp32-веса: динамическое квантование в torch ожидает float32.
+    if device.type == "cuda" or mode == "bf16":
+        return torch.bfloat16
+    return torch.float32
+
+
+def _targets(model: nn.Module, include_vision: bool) -> List[nn.Module]:
+    # Квантуем линейные слои языковой модели; lm_head оставляем как есть —
+    # он может быть связан с эмбеддингами, а на качество влияет сильнее всего.
+    inner = model.model
+    targets = [inner.text_model]
+    if include_vision:
+        targets.append(inner.vision_model)
+    return targets
+
+
+def _int8_weight_only(module: nn.Module) -> None:
+    try:
+        from torchao.quantization import int8_weight_only, quantize_
+    except ImportError as e:
+        raise RuntimeError("VLM_QUANT=int8-weight-only requires torchao (pip install torchao)") from e
+    quantize_(module, int8_weight_only())
+
+
+def quantize_model(model: nn.Module, mode: str, device: torch.device, include_vision: bool = False) -> nn.Module:
+    mode = validate_mode(mode)
+    if mode in ("none", "bf16"):
+        return model
+    if device.type != "cpu":
+        logger.warning(f"[Quant] VLM_QUANT={mode} is CPU-only, keeping {device.type} weights as is")
+        return model
+
+    for module in _targets(model, include_vision):
+        if mode == "int8-dynamic":
+            torch.ao.quantization.quantize_dynamic(module, {nn.Linear}, dtype=torch.qint8, inplace=True)
+        else:
+            _int8_weight_only(module)
+
+    scope = "text + vision" if include_vision else "text"
+    logger.info(f"[Quant] Applied {mode} to {scope} linear layers ✅")
+    return model
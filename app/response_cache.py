@@ -0,0 +1,372 @@
+import functools
+import hashlib
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from . import config
+from . import metrics
+from .scheduler import PRIORITY_BATCH
+from .stopping import token_budget
+from .tiling import tiling_mode
+
+logger = logging.getLogger(__name__)
+
+
+@functools.lru_cache(maxsize=None)
+def model_revision(model_id: str) -> str:
+    # Коммит весов на Hub (или время изменения локальной модели): дисковый кэш переживает
+    # обновление модели, и ответы старых весов отдаваться не должны
+    local = Path(model_id) / "config.json"
+    if local.exists():
+        return f"local:{local.stat().st_mtime_ns}"
+    try:
+        from huggingface_hub import try_to_load_from_cache
+
+        path = try_to_load_from_cache(model_id, "config.json")
+    except Exception:
+        return ""
+    return Path(path).parent.name if isinstance(path, str) else ""
+
+
+def _runtime_fields(model_id: str) -> Dict[str, Any]:
+    # Настройки, которые меняют ответ при той же модели: квантование, движок, черновик
+    fields: Dict[str, Any] = {
+        "revision": model_revision(model_id),
+        "quant": config.QUANT,
+        "quant_vision": config.QUANT_VISION,
+        "engine": config.ENGINE,
+    }
+    # Черновик для самой себя не загружается (см. router)
+    if config.DRAFT_MODEL_ID and config.DRAFT_MODEL_ID != model_id:
+        fields["draft"] = {
+            "model": config.DRAFT_MODEL_ID,
+            "revision": model_revision(config.DRAFT_MODEL_ID),
+            "num_tokens": config.SPEC_NUM_TOKENS,
+            "adaptive": config.SPEC_ADAPTIVE,
+        }
+    return fields
+
+
+class DiskResponseStore:
+    def __init__(self, path: Path, ttl: float, max_entries: int) -> None:
+        self.path = Path(path)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses(accessed)")
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, created FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            value, created = row
+            if self.ttl > 0 and now - created > self.ttl:
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                return None
+            self._conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            return value
+
+    def put(self, key: str, value: str) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses(key, value, created, accessed) VALUES (?, ?, ?, ?)",
+                (key, value, now, now),
+            )
+            if self.ttl > 0:
+                self._conn.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl,))
+            if self.max_entries > 0:
+                self._conn.execute(
+                    "DELETE FROM responses WHERE key IN ("
+                    "SELECT key FROM responses ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,),
+                )
+
+
+class ResponseCache:
+    def __init__(
+        self,
+        result_broker,
+        max_entries: int | None = None,
+        ttl: float | None = None,
+        disk_path: str | None = None,
+        disk_max_entries: int | None = None,
+    ) -> None:
+        self.result_broker = result_broker
+        self.max_entries = config.RESPONSE_CACHE_SIZE if max_entries is None else max_entries
+        self.ttl = config.RESPONSE_CACHE_TTL if ttl is None else ttl
+        self._memory: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        # (key, приоритет) -> (id задачи-лидера, время старта, задачи, ждущие тот же ответ, очередь лидера).
+        # Разные приоритеты не объединяем: иначе интерактивный запрос ждал бы фоновое задание в конце очереди
+        self._inflight: Dict[Tuple[str, Any], Tuple[Any, float, List[Dict[str, Any]], Any]] = {}
+        self._task_keys: Dict[Any, Tuple[str, Any]] = {}
+
+        disk_path = config.RESPONSE_CACHE_DB if disk_path is None else disk_path
+        self.disk: DiskResponseStore | None = None
+        if disk_path:
+            try:
+                self.disk = DiskResponseStore(
+                    Path(disk_path),
+                    ttl=self.ttl,
+                    max_entries=(
+                        config.RESPONSE_CACHE_DISK_SIZE if disk_max_entries is None else disk_max_entries
+                    ),
+                )
+            except Exception as e:
+                logger.warning(f"[ResponseCache] Disk tier disabled, can't open {disk_path}: {e}")
+
+        # Запись на диск и постановка нового лидера в очередь (для удалённой очереди — сетевой вызов)
+        # идут в своём потоке: _on_result вызывается из единственного потока доставки брокера
+        self._background: "queue.Queue[Callable[[], None]]" = queue.Queue()
+        threading.Thread(target=self._background_loop, name="ResponseCache", daemon=True).start()
+
+        result_broker.add_listener(self._on_result)
+        logger.info(
+            f"[ResponseCache] enabled={self.enabled} memory={self.max_entries} "
+            f"disk={'on' if self.disk else 'off'} ttl={self.ttl}s"
+        )
+
+    @property
+    def enabled(self) -> bool:
+        # Кэшировать можно только детерминированную (greedy) генерацию
+        return config.GENERATION_TEMPERATURE <= 0.0 and (self.max_entries > 0 or self.disk is not None)
+
+    @staticmethod
+    def make_key(
+        image_bytes: bytes,
+        prompt: str,
+        mode: str,
+        model_id: str | None = None,
+        max_new_tokens: int | None = None,
+        options: Dict[str, Any] | None = None,
+    ) -> str:
+        h = hashlib.sha256()
+        model_id = model_id or config.MODEL_ID
+        fields: Dict[str, Any] = {
+            "model": model_id,
+            **_runtime_fields(model_id),
+            "mode": mode,
+            "prompt": prompt if mode != "ocr" else "",
+            "max_new_tokens": max_new_tokens or config.MAX_NEW_TOKENS,
+        }
+        if options:
+            # Параметры, которые меняют ответ при тех же байтах (например, выборка кадров видео)
+            fields["options"] = options
+        header = json.dumps(fields, sort_keys=True)
+        h.update(header.encode("utf-8"))
+        h.update(b"\0")
+        h.update(image_bytes)
+        return h.hexdigest()
+
+    def submit(self, task_queue, task: Dict[str, Any], image_bytes: bytes) -> Optional[str]:
+        # Возвращает готовый ответ из кэша либо ставит задачу в очередь
+        # (если такой же запрос уже выполняется — присоединяет к нему).
+        if not self.enabled:
+            task_queue.put(task)
+            return None
+
+        options = None
+        if task.get("mode") == "video":
+            options = {
+                "sampling": task.get("sampling") or config.VIDEO_SAMPLING,
+                "max_frames": min(task.get("max_frames") or config.VIDEO_MAX_FRAMES, config.VIDEO_MAX_FRAMES),
+            }
+        elif task.get("mode") == "ocr":
+            tiling = tiling_mode(task.get("tiling"))
+            # auto и on режут одинаково большие страницы, но маленькие — по-разному
+            options = {"tiling": tiling} if tiling != "off" else None
+        mode = task.get("mode", "chat")
+        # Модель выбирается до поиска в кэше: у 256M и 500M разные ответы
+        route = getattr(task_queue, "route", None)
+        if route is not None:
+            route(task)
+        key = self.make_key(
+            image_bytes,
+            task.get("prompt", ""),
+            mode,
+            model_id=task.get("model_id"),
+            max_new_tokens=token_budget(mode, task.get("max_new_tokens")),
+            options=options,
+        )
+        cached = self.lookup(key)
+        if cached is not None:
+            return cached
+
+        if task.get("stream"):
+            self.track(key, task["id"])
+        elif self.join(key, task, task_queue):
+            return None
+
+        try:
+            task_queue.put(task)
+        except Exception:
+            # Очередь отказала (перегрузка) — не оставляем «вечного» лидера
+            self.abandon(key, task["id"])
+            raise
+        return None
+
+    def abandon(self, key: str, task_id: Any) -> None:
+        with self._lock:
+            slot = self._task_keys.pop(task_id, None)
+            if slot is None or slot[0] != key:
+                return
+            inflight = self._inflight.get(slot)
+            if inflight is not None and inflight[0] == task_id and not inflight[2]:
+                del self._inflight[slot]
+
+    def lookup(self, key: str) -> Optional[str]:
+        if not self.enabled:
+            return None
+        now = time.time()
+        with self._lock:
+            item = self._memory.get(key)
+            if item is not None:
+                stored_at, value = item
+                if self.ttl > 0 and now - stored_at > self.ttl:
+                    del self._memory[key]
+                else:
+                    self._memory.move_to_end(key)
+                    metrics.RESPONSE_CACHE_REQUESTS.inc(result="hit", tier="memory")
+                    return value
+
+        if self.disk is not None:
+            value = self.disk.get(key)
+            if value is not None:
+                self._remember(key, value)
+                metrics.RESPONSE_CACHE_REQUESTS.inc(result="hit", tier="disk")
+                return value
+
+        metrics.RESPONSE_CACHE_REQUESTS.inc(result="miss", tier="none")
+        return None
+
+    def join(self, key: str, task: Dict[str, Any], task_queue: Any = None) -> bool:
+        # True — такой же запрос уже считается, задача получит его ответ;
+        # False — задача становится лидером и должна попасть в task_queue.
+        # Задача последователя хранится целиком: если лидер упадёт, её поставят в очередь вместо него
+        if not self.enabled:
+            return False
+        now = time.time()
+        slot = (key, task.get("priority", PRIORITY_BATCH))
+        with self._lock:
+            inflight = self._inflight.get(slot)
+            if inflight is not None and now - inflight[1] <= config.INFERENCE_TIMEOUT:
+                inflight[2].append(task)
+                metrics.RESPONSE_CACHE_REQUESTS.inc(result="coalesced", tier="inflight")
+                return True
+            if inflight is not None:
+                self._task_keys.pop(inflight[0], None)
+            self._inflight[slot] = (task["id"], now, [], task_queue)
+            self._task_keys[task["id"]] = slot
+            return False
+
+    def track(self, key: str, task_id: Any) -> None:
+        # Запомнить ответ задачи, не объединяя с ней другие запросы (стриминг)
+        if not self.enabled:
+            return
+        with self._lock:
+            self._task_keys[task_id] = (key, None)
+
+    def _remember(self, key: str, value: str) -> None:
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._memory[key] = (time.time(), value)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+
+    def _background_loop(self) -> None:
+        while True:
+            job = self._background.get()
+            try:
+                job()
+            except Exception:
+                logger.exception("[ResponseCache] Background job failed")
+            finally:
+                self._background.task_done()
+
+    def _on_result(self, message: Dict[str, Any]) -> None:
+        if "delta" in message:
+            return
+        task_id = message.get("id")
+        leader = None
+        with self._lock:
+            slot = self._task_keys.pop(task_id, None)
+            if slot is None:
+                return
+            key = slot[0]
+            inflight = self._inflight.get(slot)
+            followers: List[Dict[str, Any]] = []
+            task_queue = None
+            if inflight is not None and inflight[0] == task_id:
+                _, _, followers, task_queue = self._inflight.pop(slot)
+            if "error" in message and task_queue is not None:
+                # Ошибка лидера — его собственная (тайм-аут, клиент ушёл и задачу отменили, битый запуск):
+                # последователи ждут дальше, а в очередь вместо лидера встаёт первый из них.
+                # Тех, чей клиент уже ушёл, не поднимаем и не ждём
+                followers = [f for f in followers if not self.result_broker.discarded(f["id"])]
+                if followers:
+                    leader, followers = followers[0], followers[1:]
+                    self._inflight[slot] = (leader["id"], time.time(), followers, task_queue)
+                    self._task_keys[leader["id"]] = slot
+
+        if leader is not None:
+            self._background.put(lambda: self._promote(slot, leader, followers, message, task_queue))
+            return
+        if "error" not in message:
+            value = message.get("result", "")
+            self._remember(key, value)
+            if self.disk is not None:
+                self._background.put(lambda: self._store(key, value))
+
+        for follower in followers:
+            self.result_broker.incoming.put({**message, "id": follower["id"]})
+
+    def _store(self, key: str, value: str) -> None:
+        try:
+            self.disk.put(key, value)
+        except Exception as e:
+            logger.warning(f"[ResponseCache] Failed to write disk tier: {e}")
+
+    def _promote(
+        self,
+        slot: Tuple[str, Any],
+        leader: Dict[str, Any],
+        rest: List[Dict[str, Any]],
+        message: Dict[str, Any],
+        task_queue: Any,
+    ) -> None:
+        try:
+            task_queue.put(leader)
+        except Exception as e:
+            # Очередь не приняла нового лидера — ошибку получают все, кто его ждал
+            logger.warning(f"[ResponseCache] Can't requeue a follower of a failed request: {e}")
+            with self._lock:
+                self._task_keys.pop(leader["id"], None)
+                inflight = self._inflight.get(slot)
+                if inflight is not None and inflight[0] == leader["id"]:
+                    rest = self._inflight.pop(slot)[2]
+            for follower in (leader, *rest):
+                self.result_broker.incoming.put({**message, "id": follower["id"]})
+            return
+        metrics.RESPONSE_CACHE_REQUESTS.inc(result="promoted", tier="inflight")
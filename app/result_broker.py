@@ -1,46 +1,287 @@
+import asyncio
+import itertools
+import math
+import secrets
 import threading
 import queue
 import logging
-from typing import Dict, Any
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Any, List, Tuple
 
+from . import config
+from . import metrics
 
 logger = logging.getLogger(__name__)
 
+# id задачи: случайный префикс процесса + счётчик. Не пересекаются между API и UI
+# и почти наверняка между процессами; укладываются в 53 бита, чтобы JSON-клиенты читали их точно
+_ID_COUNTER_BITS = 32
+_ID_PREFIX = secrets.randbits(53 - _ID_COUNTER_BITS) << _ID_COUNTER_BITS
+_id_counter = itertools.count(1)
+
+# Как часто поток доставки проверяет просроченные записи
+_REAP_INTERVAL_S = 1.0
+
+
+def new_task_id() -> int:
+    # next() у itertools.count атомарен под GIL — блокировка не нужна
+    return _ID_PREFIX | (next(_id_counter) & ((1 << _ID_COUNTER_BITS) - 1))
+
+
+def is_final(message: Dict[str, Any]) -> bool:
+    return "delta" not in message
+
+
+class _FutureSink:
+    def __init__(self, loop: asyncio.AbstractEventLoop) -> None:
+        self.loop = loop
+        self.future: "asyncio.Future[Dict[str, Any]]" = loop.create_future()
+
+    def put(self, message: Dict[str, Any]) -> None:
+        try:
+            self.loop.call_soon_threadsafe(self._resolve, message)
+        except RuntimeError:
+            # Event loop уже закрыт — ждать результат некому
+            pass
+
+    def _resolve(self, message: Dict[str, Any]) -> None:
+        if not self.future.done():
+            self.future.set_result(message)
+
+
+class _AsyncQueueSink:
+    def __init__(self, loop: asyncio.AbstractEventLoop) -> None:
+        self.loop = loop
+        self.queue: "asyncio.Queue[Dict[str, Any]]" = asyncio.Queue()
+
+    def put(self, message: Dict[str, Any]) -> None:
+        try:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, message)
+        except RuntimeError:
+            pass
+
+
+class _CallbackSink:
+    def __init__(self, callback: Callable[[Dict[str, Any]], None]) -> None:
+        self.callback = callback
+
+    def put(self, message: Dict[str, Any]) -> None:
+        try:
+            self.callback(message)
+        except Exception:
+            logger.exception("[ResultBroker] Result callback failed")
+
+
+class _Shard:
+    # Часть состояния брокера со своей блокировкой. Во всех словарях порядок вставки
+    # совпадает с порядком истечения срока, поэтому просроченное всегда в начале
+    # (кроме бессрочных ожидающих — их reap пропускает).
+    __slots__ = ("lock", "waiters", "pending", "tombstones")
 
-class ResultBroker:
     def __init__(self) -> None:
+        self.lock = threading.Lock()
+        # task_id -> (получатель с методом put(), хочет ли он промежуточные сообщения, истекает в)
+        self.waiters: "OrderedDict[int, Tuple[Any, bool, float]]" = OrderedDict()
+        # task_id -> (истекает в, сообщения), пришедшие раньше ожидающего
+        self.pending: "OrderedDict[int, Tuple[float, List[Dict[str, Any]]]]" = OrderedDict()
+        # task_id -> истекает в: ожидающий ушёл, поздние сообщения выбрасываются
+        self.tombstones: "OrderedDict[int, float]" = OrderedDict()
+
+
+class ResultBroker:
+    def __init__(self, ttl_s: float | None = None, shards: int | None = None) -> None:
         self.incoming: "queue.Queue[Dict[str, Any]]" = queue.Queue()
-        self._waiters: Dict[int, "queue.Queue[Dict[str, Any]]"] = {}
-        self._pending: Dict[int, Dict[str, Any]] = {}
-        self._lock = threading.Lock()
+        # Получатель — queue.Queue для блокирующих вызовов или обёртка над asyncio.
+        # Регистрации из разных потоков и доставка расходятся по частям и не ждут друг друга.
+        self.ttl_s = config.BROKER_TTL_S if ttl_s is None else ttl_s
+        self._shards = [_Shard() for _ in range(max(1, shards or config.BROKER_SHARDS))]
+        self._listeners: List[Callable[[Dict[str, Any]], None]] = []
+        self._next_reap = time.monotonic() + _REAP_INTERVAL_S
 
-        self._thread = threading.Thread(target=self._loop, daemon=True)
+        metrics.REGISTRY.gauge_callback(
+            "vlm_broker_waiters",
+            "Callers registered in the result broker and still waiting.",
+            lambda: self.stats()["waiters"],
+        )
+        metrics.REGISTRY.gauge_callback(
+            "vlm_broker_pending",
+            "Results held by the broker until their caller registers.",
+            lambda: self.stats()["pending"],
+        )
+
+        self._thread = threading.Thread(target=self._loop, name="ResultBroker", daemon=True)
         self._thread.start()
-        logger.info("[ResultBroker] Started ✅")
+        logger.info(f"[ResultBroker] Started ✅ (shards={len(self._shards)}, ttl={self.ttl_s:.0f}s)")
+
+    def add_listener(self, callback: Callable[[Dict[str, Any]], None]) -> None:
+        self._listeners.append(callback)
+
+    def _shard(self, task_id: int) -> _Shard:
+        return self._shards[hash(task_id) % len(self._shards)]
+
+    def _attach(self, task_id: int, sink: Any, wants_stream: bool, ttl: float | None = None) -> None:
+        shard = self._shard(task_id)
+        with shard.lock:
+            shard.tombstones.pop(task_id, None)
+            _, pending = shard.pending.pop(task_id, (0.0, []))
+            if wants_stream:
+                for message in pending:
+                    sink.put(message)
+            final = next((m for m in pending if is_final(m)), None)
+            if final is not None:
+                if not wants_stream:
+                    sink.put(final)
+            else:
+                shard.waiters[task_id] = (sink, wants_stream, time.monotonic() + (self.ttl_s if ttl is None else ttl))
 
     def register(self, task_id: int) -> "queue.Queue[Dict[str, Any]]":
         q: "queue.Queue[Dict[str, Any]]" = queue.Queue(maxsize=1)
-        with self._lock:
-            if task_id in self._pending:
-                q.put(self._pending.pop(task_id))
-            else:
-                self._waiters[task_id] = q
+        self._attach(task_id, q, wants_stream=False)
         return q
 
+    def register_stream(self, task_id: int) -> "queue.Queue[Dict[str, Any]]":
+        q: "queue.Queue[Dict[str, Any]]" = queue.Queue()
+        self._attach(task_id, q, wants_stream=True)
+        return q
+
+    def register_async(self, task_id: int) -> "asyncio.Future[Dict[str, Any]]":
+        # Вызывать из event loop: future резолвится через call_soon_threadsafe,
+        # поэтому ожидание не занимает ни одного потока.
+        sink = _FutureSink(asyncio.get_running_loop())
+        self._attach(task_id, sink, wants_stream=False)
+        return sink.future
+
+    def register_stream_async(self, task_id: int) -> "asyncio.Queue[Dict[str, Any]]":
+        sink = _AsyncQueueSink(asyncio.get_running_loop())
+        self._attach(task_id, sink, wants_stream=True)
+        return sink.queue
+
+    def register_callback(
+        self, task_id: int, callback: Callable[[Dict[str, Any]], None], ttl: float | None = None
+    ) -> None:
+        # Финальное сообщение отдаётся в callback прямо из потока доставки — он должен быть быстрым.
+        # ttl=math.inf — ждать без срока (фоновые задания могут стоять в очереди часами)
+        self._attach(task_id, _CallbackSink(callback), wants_stream=False, ttl=ttl)
+
+    def discard(self, task_id: int) -> None:
+        # Ожидающий ушёл (тайм-аут, отключение клиента) — забываем его,
+        # а поздний результат по этой задаче выбросим, не складывая в pending
+        shard = self._shard(task_id)
+        with shard.lock:
+            shard.waiters.pop(task_id, None)
+            shard.pending.pop(task_id, None)
+            shard.tombstones[task_id] = time.monotonic() + self.ttl_s
+            shard.tombstones.move_to_end(task_id)
+
+    def discarded(self, task_id: int) -> bool:
+        # Ожидающий ушёл (discard или истёк срок) — результат этой задачи уже никто не заберёт
+        shard = self._shard(task_id)
+        with shard.lock:
+            return task_id in shard.tombstones
+
+    def stats(self) -> Dict[str, int]:
+        totals = {"waiters": 0, "pending": 0, "tombstones": 0}
+        for shard in self._shards:
+            totals["waiters"] += len(shard.waiters)
+            totals["pending"] += len(shard.pending)
+            totals["tombstones"] += len(shard.tombstones)
+        return totals
+
+    def _deliver(self, task_id: int, result: Dict[str, Any]) -> None:
+        final = is_final(result)
+        shard = self._shard(task_id)
+        with shard.lock:
+            entry = shard.waiters.get(task_id)
+            if entry is None:
+                if task_id in shard.tombstones:
+                    if final:
+                        del shard.tombstones[task_id]
+                    metrics.BROKER_DROPPED.inc(reason="discarded")
+                    return
+                if task_id not in shard.pending:
+                    shard.pending[task_id] = (time.monotonic() + self.ttl_s, [])
+                shard.pending[task_id][1].append(result)
+                return
+
+            waiter, wants_stream, _ = entry
+            if final:
+                del shard.waiters[task_id]
+            elif not wants_stream:
+                return
+        # put() вне блокировки: asyncio-обёртки и очереди не должны задерживать другие задачи части
+        waiter.put(result)
+        sent_at = result.get("sent_at")
+        if final and sent_at is not None:
+            metrics.BROKER_DELIVERY_SECONDS.observe(max(0.0, time.time() - sent_at))
+
+    def reap(self, now: float | None = None) -> Dict[str, int]:
+        # Удаляет просроченные записи; ожидающему, которого так никто и не дождался, отдаём ошибку
+        now = time.monotonic() if now is None else now
+        reaped = {"waiters": 0, "pending": 0, "tombstones": 0}
+        expired_waiters: List[Tuple[int, Any]] = []
+        for shard in self._shards:
+            with shard.lock:
+                expired = []
+                for task_id, (_, _, expires) in shard.waiters.items():
+                    if expires > now:
+                        # Бессрочные не задерживают проверку тех, кто зарегистрировался после них
+                        if expires == math.inf:
+                            continue
+                        break
+                    expired.append(task_id)
+                for task_id in expired:
+                    sink = shard.waiters.pop(task_id)[0]
+                    # Результат, если он всё-таки придёт, уже никому не нужен
+                    shard.tombstones[task_id] = now + self.ttl_s
+                    expired_waiters.append((task_id, sink))
+                while shard.pending:
+                    task_id, (expires, _) = next(iter(shard.pending.items()))
+                    if expires > now:
+                        break
+                    shard.pending.popitem(last=False)
+                    reaped["pending"] += 1
+                while shard.tombstones:
+                    task_id, expires = next(iter(shard.tombstones.items()))
+                    if expires > now:
+                        break
+                    shard.tombstones.popitem(last=False)
+                    reaped["tombstones"] += 1
+
+        for task_id, sink in expired_waiters:
+            sink.put({"id": task_id, "error": "Result expired in the broker."})
+        reaped["waiters"] = len(expired_waiters)
+        for kind, count in reaped.items():
+            if count:
+                metrics.BROKER_REAPED.inc(count, kind=kind)
+        return reaped
+
     def _loop(self) -> None:
         while True:
-            result = self.incoming.get()
             try:
-                task_id = result.get("id")
-                if task_id is None:
-                    logger.warning("[ResultBroker] Got result without 'id' key, ignoring")
-                    continue
-
-                with self._lock:
-                    waiter = self._waiters.pop(task_id, None)
-                    if waiter is not None:
-                        waiter.put(result)
-                    else:
-                        self._pending[task_id] = result
-            finally:
-                self.incoming.task_done()
+                result = self.incoming.get(timeout=_REAP_INTERVAL_S)
+            except queue.Empty:
+                result = None
+            if result is not None:
+                try:
+                    task_id = result.get("id")
+                    if task_id is None:
+                        logger.warning("[ResultBroker] Got result without 'id' key, ignoring")
+                        continue
+
+                    for listener in self._listeners:
+                        try:
+                            listener(result)
+                        except Exception:
+                            logger.exception("[ResultBroker] Listener failed")
+
+                    self._deliver(task_id, result)
+                finally:
+                    self.incoming.task_done()
+
+            if time.monotonic() >= self._next_reap:
+                try:
+                    self.reap()
+                except Exception:
+                    logger.exception("[ResultBroker] Reaping failed")
+                self._next_reap = time.monotonic() + _REAP_INTERVAL_S
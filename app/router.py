@@ -0,0 +1,382 @@
+import gc
+import itertools
+import logging
+import queue
+import threading
+import time
+from contextlib import nullcontext
+from typing import Any, Callable, ContextManager, Dict, List, Optional, Tuple
+
+import torch
+
+from . import config
+from . import metrics
+from .image_cache import ImageFeatureCache
+from .inference import InferenceWorker
+from .payload import cleanup_task
+from .prefix_cache import PrefixCache
+from .scheduler import PRIORITY_BATCH, QueueFullError, TaskScheduler
+
+logger = logging.getLogger(__name__)
+
+AUTO = "auto"
+
+
+class UnknownModelError(ValueError):
+    pass
+
+
+def served_models() -> Dict[str, str]:
+    # Имя размера -> id модели; для VLM_MODEL_SIZE действует VLM_MODEL_ID
+    return {
+        name: config.MODEL_ID if name == config.MODEL_SIZE else config.SMOLVLM2_MODELS[name]
+        for name in config.SERVED_MODELS
+    }
+
+
+def weight_bytes(worker: InferenceWorker) -> int:
+    # Параметры и буферы основной и черновой модели; упакованные int8-веса torch учитывает не все
+    models = [worker.model]
+    if worker.speculative is not None:
+        models.append(worker.speculative.draft)
+    return sum(
+        t.element_size() * t.nelement()
+        for model in models
+        for t in itertools.chain(model.parameters(), model.buffers())
+    )
+
+
+class ModelSlot:
+    def __init__(self, name: str, model_id: str, scheduler: TaskScheduler) -> None:
+        self.name = name
+        self.model_id = model_id
+        self.scheduler = scheduler
+        self.worker: InferenceWorker | None = None
+        # unloaded | loading | ready | failed
+        self.state = "unloaded"
+        self.error: str | None = None
+        # Размер весов и время загрузки с прошлого раза — для бюджета памяти и оценки ожидания
+        self.weight_bytes = 0
+        self.load_s: float | None = None
+        self.last_used = time.monotonic()
+
+
+class ModelRouter:
+    # Несколько моделей в одном процессе: у каждой своя TaskScheduler и свои воркеры.
+    # Снаружи выглядит как очередь задач (put/cancel/position), поэтому API и UI работают с ним как раньше.
+    def __init__(
+        self,
+        result_queue: "queue.Queue[Dict[str, Any]]",
+        on_drop: Callable[[Dict[str, Any], str], None] | None = None,
+        models: Dict[str, str] | None = None,
+        default: str | None = None,
+        route_by_mode: Dict[str, str] | None = None,
+        slo_s: float | None = None,
+        memory_budget_mb: int | None = None,
+        idle_unload_s: float | None = None,
+    ) -> None:
+        self.result_queue = result_queue
+        models = models or served_models()
+        self.default = default or config.MODEL_SIZE
+        self.route_by_mode = config.ROUTE_BY_MODE if route_by_mode is None else route_by_mode
+        self.slo_s = config.ROUTE_SLO_S if slo_s is None else slo_s
+        self.memory_budget = (config.MODEL_MEMORY_MB if memory_budget_mb is None else memory_budget_mb) * 1024 * 1024
+        self.idle_unload_s = config.MODEL_IDLE_UNLOAD_S if idle_unload_s is None else idle_unload_s
+
+        self.slots: Dict[str, ModelSlot] = {
+            name: ModelSlot(
+                name,
+                model_id,
+                TaskScheduler(max_depth=config.QUEUE_MAX_DEPTH, num_workers=config.NUM_WORKERS, on_drop=on_drop),
+            )
+            for name, model_id in models.items()
+        }
+        # Кэши общие: ключи картинок и префиксов содержат модель
+        self.image_cache = ImageFeatureCache(config.IMAGE_CACHE_MB * 1024 * 1024)
+        self.prefix_cache = PrefixCache(config.PREFIX_CACHE_MB * 1024 * 1024)
+        self._lock = threading.RLock()
+
+        # Каждая TaskScheduler регистрирует vlm_queue_depth на себя — заменяем суммой по моделям
+        metrics.REGISTRY.gauge_callback("vlm_queue_depth", "Tasks waiting in the admission queues of all models.", self.qsize)
+        metrics.REGISTRY.gauge_callback(
+            "vlm_models_loaded",
+            "Models whose weights are in memory.",
+            lambda: sum(slot.worker is not None for slot in self.slots.values()),
+        )
+        metrics.REGISTRY.gauge_callback(
+            "vlm_model_weights_bytes",
+            "Memory held by the weights of loaded models.",
+            self._loaded_bytes,
+        )
+
+        if self.idle_unload_s > 0 and len(self.slots) > 1:
+            threading.Thread(target=self._idle_loop, name="ModelRouter-idle", daemon=True).start()
+        logger.info(
+            f"[ModelRouter] models={', '.join(f'{n}={s.model_id}' for n, s in self.slots.items())} "
+            f"default={self.default} by_mode={self.route_by_mode or '-'} slo={self.slo_s or '-'}s "
+            f"memory_budget={config.MODEL_MEMORY_MB if memory_budget_mb is None else memory_budget_mb}MB"
+        )
+
+    @property
+    def models(self) -> List[str]:
+        return list(self.slots)
+
+    # --- выбор модели ---
+
+    def route(self, task: Dict[str, Any]) -> str:
+        # Проставляет в задачу model (имя) и model_id; повторный вызов ничего не меняет
+        if task.get("model_id"):
+            return task["model"]
+        requested = task.get("model") or AUTO
+        if requested == AUTO:
+            name, reason = self._auto(task)
+        elif requested in self.slots:
+            name, reason = requested, "requested"
+        else:
+            raise UnknownModelError(f"Unknown model {requested!r}, use one of: {', '.join([AUTO, *self.slots])}.")
+        task["model"] = name
+        task["model_id"] = self.slots[name].model_id
+        metrics.MODEL_ROUTES.inc(model=name, reason=reason)
+        return name
+
+    def expected_latency(self, slot: ModelSlot, task: Dict[str, Any]) -> float:
+        # Очередь перед задачей + её обработка + загрузка весов, если модель не в памяти
+        mode = task.get("mode", "chat")
+        latency = slot.scheduler.estimate_wait(task.get("priority", PRIORITY_BATCH)) + slot.scheduler.service_time(mode)
+        if slot.state != "ready":
+            latency += slot.load_s or 0.0
+        return latency
+
+    def _auto(self, task: Dict[str, Any]) -> Tuple[str, str]:
+        preferred = self.route_by_mode.get(task.get("mode", "chat"), self.default)
+        if self.slo_s <= 0 or len(self.slots) == 1:
+            return preferred, "mode"
+        expected = self.expected_latency(self.slots[preferred], task)
+        if expected <= self.slo_s:
+            return preferred, "mode"
+        # Предпочтительная модель не укладывается в SLO: берём загруженную, которая ответит раньше
+        candidates = [
+            (self.expected_latency(slot, task), slot.name)
+            for slot in self.slots.values()
+            if slot.name != preferred and slot.state == "ready"
+        ]
+        if candidates:
+            latency, name = min(candidates)
+            if latency < expected:
+                return name, "slo"
+        return preferred, "mode"
+
+    # --- интерфейс очереди ---
+
+    def put(self, task: Dict[str, Any], block: bool = True, timeout: float | None = None) -> None:
+        slot = self.slots[self.route(task)]
+        with self._lock:
+            slot.scheduler.put(task, block, timeout)
+            slot.last_used = time.monotonic()
+            if slot.worker is None and slot.state != "loading":
+                # Модель не в памяти: задача ждёт в своей очереди, пока веса грузятся
+                slot.state = "loading"
+                threading.Thread(target=self._load, args=(slot, False), name=f"ModelLoader-{slot.name}", daemon=True).start()
+
+    def put_nowait(self, task: Dict[str, Any]) -> None:
+        self.put(task, block=False)
+
+    def cancel(self, task_id: Any) -> bool:
+        return any(slot.scheduler.cancel(task_id) for slot in self.slots.values())
+
+    def position(self, task_id: Any) -> Optional[Dict[str, Any]]:
+        for slot in self.slots.values():
+            info = slot.scheduler.position(task_id)
+            if info is not None:
+                if slot.state != "ready":
+                    info["eta_s"] += slot.load_s or 0.0
+                return {**info, "model": slot.name, "model_state": slot.state}
+        return None
+
+    def qsize(self) -> int:
+        return sum(slot.scheduler.qsize() for slot in self.slots.values())
+
+    def empty(self) -> bool:
+        return self.qsize() == 0
+
+    # --- загрузка и выгрузка ---
+
+    def load(self, name: str, warmup: bool = False, phase: Callable[[str], ContextManager[Any]] | None = None) -> None:
+        # Синхронная загрузка (основная модель при старте); phase — StartupState.phase для /ready
+        slot = self.slots[name]
+        with self._lock:
+            if slot.worker is not None:
+                return
+            slot.state = "loading"
+        self._load(slot, warmup, phase)
+        if slot.state == "failed":
+            raise RuntimeError(slot.error)
+
+    def _create_worker(self, slot: ModelSlot) -> InferenceWorker:
+        # Черновик для самой себя не нужен (например, 256M при VLM_DRAFT_MODEL_SIZE=256M)
+        draft = config.DRAFT_MODEL_ID if config.DRAFT_MODEL_ID != slot.model_id else ""
+        return InferenceWorker(
+            task_queue=slot.scheduler,
+            result_queue=self.result_queue,
+            model_id=slot.model_id,
+            image_cache=self.image_cache,
+            prefix_cache=self.prefix_cache,
+            draft_model_id=draft,
+        )
+
+    def _load(
+        self, slot: ModelSlot, warmup: bool, phase: Callable[[str], ContextManager[Any]] | None = None
+    ) -> None:
+        phase = phase or (lambda name: nullcontext())
+        self._make_room(slot)
+        started = time.perf_counter()
+        try:
+            with phase("model_load"):
+                worker = self._create_worker(slot)
+            with phase("warmup"):
+                worker.start(warmup=warmup)
+        except Exception as e:
+            logger.exception(f"[ModelRouter] Failed to load {slot.name}")
+            with self._lock:
+                slot.state = "failed"
+                slot.error = f"{type(e).__name__}: {e}"
+            self._fail_queued(slot)
+            return
+
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            slot.worker = worker
+            slot.state = "ready"
+            slot.error = None
+            slot.load_s = elapsed
+            slot.weight_bytes = weight_bytes(worker)
+            slot.last_used = time.monotonic()
+        metrics.MODEL_LOADS.inc(model=slot.name)
+        metrics.MODEL_LOAD_SECONDS.observe(elapsed, model=slot.name)
+        logger.info(
+            f"[ModelRouter] {slot.name} loaded in {elapsed:.1f}s ✅ (weights={slot.weight_bytes / 2**20:.0f}MB)"
+        )
+        # Размер до первой загрузки неизвестен: проверяем бюджет ещё раз уже по факту
+        self._make_room(None)
+
+    def _fail_queued(self, slot: ModelSlot) -> None:
+        # Задачи, ждавшие эту модель, иначе висели бы до таймаута
+        while True:
+            try:
+                task = slot.scheduler.get_nowait()
+            except queue.Empty:
+                return
+            self.result_queue.put({"id": task.get("id"), "error": f"Model {slot.name} failed to load: {slot.error}"})
+            cleanup_task(task)
+            slot.scheduler.task_done()
+
+    def _loaded_bytes(self) -> int:
+        return sum(slot.weight_bytes for slot in self.slots.values() if slot.worker is not None)
+
+    def _make_room(self, incoming: ModelSlot | None) -> None:
+        # Выгружаем простаивающие модели (давно не использованные первыми), пока новая не влезет в бюджет
+        if self.memory_budget <= 0:
+            return
+        victims = []
+        with self._lock:
+            need = incoming.weight_bytes if incoming is not None else 0
+            loaded = self._loaded_bytes()
+            candidates = sorted(
+                (
+                    slot for slot in self.slots.values()
+                    if slot is not incoming and slot.worker is not None and slot.scheduler.idle()
+                ),
+                key=lambda slot: slot.last_used,
+            )
+            for slot in candidates:
+                if loaded + need <= self.memory_budget:
+                    break
+                loaded -= slot.weight_bytes
+                victims.append(self._detach(slot))
+            if loaded + need > self.memory_budget:
+                logger.warning(
+                    f"[ModelRouter] Weights need {(loaded + need) / 2**20:.0f}MB, over the "
+                    f"{self.memory_budget / 2**20:.0f}MB budget, and no idle model is left to unload"
+                )
+        self._release(victims, "memory")
+
+    def _detach(self, slot: ModelSlot) -> Tuple[ModelSlot, InferenceWorker]:
+        # Под self._lock: следующий put() в эту модель запустит загрузку заново.
+        # Старый воркер перестаёт брать задачи до того, как очередь достанется новому
+        worker = slot.worker
+        worker.begin_stop()
+        slot.worker = None
+        slot.state = "unloaded"
+        return slot, worker
+
+    def _release(self, victims: List[Tuple[ModelSlot, InferenceWorker]], reason: str) -> None:
+        # Остановка воркеров — вне блокировки; задачу, взятую в последний момент, воркер ещё доделает,
+        # а подготовленные, но не начатые задачи возвращаются в очередь
+        released = bool(victims)
+        while victims:
+            slot, worker = victims.pop()
+            leftover = worker.stop()
+            del worker
+            self._requeue(slot, leftover)
+            metrics.MODEL_EVICTIONS.inc(model=slot.name, reason=reason)
+            logger.info(f"[ModelRouter] {slot.name} unloaded ({reason})")
+        if released:
+            gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+
+    def _requeue(self, slot: ModelSlot, tasks: List[Dict[str, Any]]) -> None:
+        for task in tasks:
+            # Подготовлено выгруженной моделью: новый воркер подготовит заново
+            task.pop("prepared", None)
+            task.pop("prepare_error", None)
+            slot.scheduler.task_done()
+            try:
+                self.put(task)
+            except QueueFullError as e:
+                self.result_queue.put({"id": task.get("id"), "error": f"Model {slot.name} was unloaded and the queue is full: {e.reason}"})
+                cleanup_task(task)
+        if tasks:
+            logger.warning(f"[ModelRouter] {slot.name}: {len(tasks)} task(s) taken before unload requeued")
+
+    def unload(self, name: str, reason: str = "manual") -> bool:
+        slot = self.slots[name]
+        with self._lock:
+            if slot.worker is None or not slot.scheduler.idle():
+                return False
+            victims = [self._detach(slot)]
+        self._release(victims, reason)
+        return True
+
+    def _idle_loop(self) -> None:
+        interval = max(1.0, min(30.0, self.idle_unload_s / 2))
+        while True:
+            time.sleep(interval)
+            now = time.monotonic()
+            for slot in self.slots.values():
+                if slot.name == self.default or slot.worker is None:
+                    continue
+                if not slot.scheduler.idle():
+                    # Время простоя отсчитываем от конца последней задачи, а не от её прихода
+                    slot.last_used = now
+                elif now - slot.last_used > self.idle_unload_s:
+                    self.unload(slot.name, reason="idle")
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        now = time.monotonic()
+        with self._lock:
+            return [
+                {
+                    "name": slot.name,
+                    "model_id": slot.model_id,
+                    "default": slot.name == self.default,
+                    "state": slot.state,
+                    "error": slot.error,
+                    "queued": slot.scheduler.qsize(),
+                    "weights_mb": round(slot.weight_bytes / 2**20, 1) if slot.weight_bytes else None,
+                    "load_s": round(slot.load_s, 2) if slot.load_s is not None else None,
+                    "idle_s": round(now - slot.last_used, 1),
+                    "engine": slot.worker.engine.describe() if slot.worker is not None else None,
+                }
+                for slot in self.slots.values()
+            ]
@@ -0,0 +1,219 @@
+import heapq
+import itertools
+import logging
+import math
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from . import config
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# Меньше — важнее
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 10
+# Фоновые задания /ptt/jobs: уступают всем, кто держит соединение и ждёт ответ
+PRIORITY_BACKGROUND = 20
+
+
+class QueueFullError(Exception):
+    def __init__(self, retry_after: float, reason: str) -> None:
+        super().__init__(reason)
+        self.retry_after = retry_after
+        self.reason = reason
+
+    @property
+    def retry_after_header(self) -> str:
+        return str(max(1, math.ceil(self.retry_after)))
+
+
+class TaskScheduler:
+    def __init__(
+        self,
+        max_depth: int | None = None,
+        num_workers: int | None = None,
+        max_wait: float | None = None,
+        on_drop: Callable[[Dict[str, Any], str], None] | None = None,
+    ) -> None:
+        self.max_depth = config.QUEUE_MAX_DEPTH if max_depth is None else max_depth
+        self.num_workers = max(1, num_workers or config.NUM_WORKERS)
+        self.max_wait = config.INFERENCE_TIMEOUT if max_wait is None else max_wait
+        self.on_drop = on_drop
+
+        self._heap: List[List[Any]] = []
+        self._entries: Dict[Any, List[Any]] = {}
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._all_done = threading.Condition(self._lock)
+        self._unfinished = 0
+        self._running = 0
+
+        # EWMA времени обслуживания одной задачи по режимам, секунды
+        self._service_time: Dict[str, float] = {}
+        self._alpha = 0.2
+
+        metrics.REGISTRY.gauge_callback(
+            "vlm_queue_depth",
+            "Tasks waiting in the admission queue.",
+            self.qsize,
+        )
+
+    # --- оценки ---
+
+    def service_time(self, mode: str) -> float:
+        return self._service_time.get(mode, config.DEFAULT_SERVICE_TIME)
+
+    def record_service(self, mode: str, seconds: float) -> None:
+        with self._lock:
+            prev = self._service_time.get(mode)
+            self._service_time[mode] = seconds if prev is None else (
+                self._alpha * seconds + (1 - self._alpha) * prev
+            )
+
+    def _ordered(self) -> List[List[Any]]:
+        return sorted(e for e in self._heap if e[2] is not None)
+
+    def _wait_for(self, ahead: List[List[Any]]) -> float:
+        work = sum(self.service_time(e[2].get("mode", "chat")) for e in ahead)
+        return work / self.num_workers
+
+    def estimate_wait(self, priority: int = PRIORITY_BATCH) -> float:
+        with self._lock:
+            ahead = [e for e in self._heap if e[2] is not None and e[0] <= priority]
+            return self._wait_for(ahead)
+
+    def position(self, task_id: Any) -> Optional[Dict[str, float]]:
+        with self._lock:
+            entry = self._entries.get(task_id)
+            if entry is None:
+                return None
+            ordered = self._ordered()
+            index = ordered.index(entry)
+            ahead = ordered[:index]
+            eta = self._wait_for(ahead) + self.service_time(entry[2].get("mode", "chat"))
+            return {"position": index, "eta_s": eta}
+
+    # --- интерфейс queue.Queue ---
+
+    def put(self, task: Dict[str, Any], block: bool = True, timeout: float | None = None) -> None:
+        priority = task.get("priority", PRIORITY_BATCH)
+        now = time.time()
+        task.setdefault("enqueued_at", now)
+        task.setdefault("deadline", task["enqueued_at"] + config.INFERENCE_TIMEOUT)
+
+        with self._lock:
+            ahead = [e for e in self._heap if e[2] is not None and e[0] <= priority]
+            # Лимит считаем по тем, кто пойдёт раньше: фоновые задания не занимают места интерактивных
+            depth = len(ahead)
+            wait = self._wait_for(ahead)
+            if self.max_depth > 0 and depth >= self.max_depth:
+                metrics.QUEUE_REJECTED.inc(reason="full", mode=task.get("mode", "chat"))
+                raise QueueFullError(wait, f"Queue is full ({depth} tasks waiting).")
+            if self.max_wait > 0 and wait > self.max_wait:
+                metrics.QUEUE_REJECTED.inc(reason="slow", mode=task.get("mode", "chat"))
+                raise QueueFullError(
+                    wait - self.max_wait, f"Estimated wait {wait:.0f}s exceeds {self.max_wait:.0f}s."
+                )
+
+            entry = [priority, next(self._seq), task]
+            self._entries[task.get("id")] = entry
+            heapq.heappush(self._heap, entry)
+            self._unfinished += 1
+            self._not_empty.notify()
+
+    def put_nowait(self, task: Dict[str, Any]) -> None:
+        self.put(task, block=False)
+
+    def get(self, block: bool = True, timeout: float | None = None) -> Dict[str, Any]:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        dropped = []
+        try:
+            with self._not_empty:
+                while True:
+                    task = self._pop_live(dropped)
+                    if task is not None:
+                        self._running += 1
+                        return task
+                    if not block:
+                        raise queue.Empty
+                    if deadline is None:
+                        self._not_empty.wait()
+                    else:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            raise queue.Empty
+                        self._not_empty.wait(remaining)
+        finally:
+            for task, reason in dropped:
+                self._report_drop(task, reason)
+
+    def get_nowait(self) -> Dict[str, Any]:
+        return self.get(block=False)
+
+    def _pop_live(self, dropped: List[Any]) -> Optional[Dict[str, Any]]:
+        now = time.time()
+        while self._heap:
+            entry = heapq.heappop(self._heap)
+            task = entry[2]
+            if task is None:
+                # Отменённая задача: task_done за неё уже учтён в cancel()
+                continue
+            self._entries.pop(task.get("id"), None)
+            if task.get("deadline") is not None and now > task["deadline"]:
+                self._finish_locked()
+                dropped.append((task, "expired"))
+                continue
+            return task
+        return None
+
+    def task_done(self) -> None:
+        with self._lock:
+            self._running = max(0, self._running - 1)
+            self._finish_locked()
+
+    def _finish_locked(self) -> None:
+        self._unfinished -= 1
+        if self._unfinished <= 0:
+            self._unfinished = 0
+            self._all_done.notify_all()
+
+    def join(self) -> None:
+        with self._all_done:
+            while self._unfinished:
+                self._all_done.wait()
+
+    def qsize(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+    def empty(self) -> bool:
+        return self.qsize() == 0
+
+    def idle(self) -> bool:
+        # Ни ожидающих, ни выполняющихся задач
+        with self._lock:
+            return self._unfinished == 0
+
+    def cancel(self, task_id: Any) -> bool:
+        with self._lock:
+            entry = self._entries.pop(task_id, None)
+            if entry is None:
+                return False
+            task = entry[2]
+            entry[2] = None
+            self._finish_locked()
+        self._report_drop(task, "cancelled")
+        return True
+
+    def _report_drop(self, task: Dict[str, Any], reason: str) -> None:
+        metrics.QUEUE_DROPPED.inc(reason=reason, mode=task.get("mode", "chat"))
+        logger.info(f"[TaskScheduler] Dropped task_id={task.get('id')} ({reason})")
+        if self.on_drop is not None:
+            try:
+                self.on_drop(task, reason)
+            except Exception:
+                logger.exception("[TaskScheduler] on_drop callback failed")
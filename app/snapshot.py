@@ -0,0 +1,83 @@
+import argparse
+import logging
+import re
+import shutil
+import tempfile
+import time
+from pathlib import Path
+from typing import Any
+
+import torch
+
+from . import config
+
+logger = logging.getLogger(__name__)
+
+
+def snapshot_path(model_id: str, dtype: torch.dtype) -> Path:
+    # Один снапшот на пару (модель, dtype); int8-квантование быстрое и делается поверх него при загрузке
+    slug = re.sub(r"[^A-Za-z0-9._-]+", "--", model_id)
+    return config.SNAPSHOT_DIR / f"{slug}-{str(dtype).replace('torch.', '')}"
+
+
+def snapshot_exists(path: Path) -> bool:
+    return (path / "config.json").exists() and any(path.glob("*.safetensors"))
+
+
+def save_snapshot(model: Any, processor: Any, path: Path) -> bool:
+    # Пишем во временный каталог и переименовываем: соседние поды не увидят полуготовый снапшот.
+    # Каталог у каждого процесса свой — несколько подов на общем томе пишут параллельно, не мешая друг другу
+    started = time.perf_counter()
+    tmp: Path | None = None
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = Path(tempfile.mkdtemp(prefix=f".{path.name}.", suffix=".tmp", dir=path.parent))
+        model.save_pretrained(tmp, safe_serialization=True)
+        processor.save_pretrained(tmp)
+        if path.exists() and not snapshot_exists(path):
+            # Недописанный снапшот старой версии; целый не трогаем — из него, возможно, уже грузятся
+            shutil.rmtree(path, ignore_errors=True)
+        try:
+            tmp.rename(path)
+        except OSError:
+            if not snapshot_exists(path):
+                raise
+            # Другой под успел раньше: снапшот тот же, наш не нужен
+            shutil.rmtree(tmp, ignore_errors=True)
+            logger.info(f"[Snapshot] {path} was written by another process, keeping it")
+            return True
+    except Exception as e:
+        logger.warning(f"[Snapshot] Failed to write snapshot {path}: {e}")
+        if tmp is not None:
+            shutil.rmtree(tmp, ignore_errors=True)
+        return False
+    logger.info(f"[Snapshot] Saved {path} in {time.perf_counter() - started:.1f}s ✅")
+    return True
+
+
+def main(argv: list[str] | None = None) -> None:
+    # Сборка снапшота заранее, например на этапе docker build: python -m app.snapshot
+    parser = argparse.ArgumentParser(description="Pre-build the safetensors model snapshot used for fast startup")
+    parser.add_argument("--model-id", default=config.MODEL_ID)
+    parser.add_argument("--dtype", choices=("float32", "bfloat16"), default=None)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s] [%(levelname)s] %(name)s: %(message)s")
+
+    from transformers import AutoModelForImageTextToText, AutoProcessor
+
+    from .inference import InferenceWorker
+    from .quantization import load_dtype, validate_mode
+
+    device = InferenceWorker.resolve_device(config.DEVICE_MODE)
+    dtype = getattr(torch, args.dtype) if args.dtype else load_dtype(validate_mode(config.QUANT), device)
+    path = snapshot_path(args.model_id, dtype)
+
+    processor = AutoProcessor.from_pretrained(args.model_id)
+    model = AutoModelForImageTextToText.from_pretrained(args.model_id, torch_dtype=dtype, low_cpu_mem_usage=True)
+    if not save_snapshot(model, processor, path):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
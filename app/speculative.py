@@ -0,0 +1,132 @@
+import logging
+from typing import Any, Dict, Tuple
+
+import torch
+from transformers import DynamicCache, TextStreamer
+
+from .stopping import EarlyStopper
+from .tracing import GenerationTimer
+
+logger = logging.getLogger(__name__)
+
+
+def draft_mismatch(target_processor: Any, draft_processor: Any) -> str | None:
+    # Черновик должен видеть ровно тот же промпт: общий словарь и столько же токенов на картинку
+    if target_processor.tokenizer.get_vocab() != draft_processor.tokenizer.get_vocab():
+        return "tokenizers differ"
+    if target_processor.image_seq_len != draft_processor.image_seq_len:
+        return f"image_seq_len differs ({target_processor.image_seq_len} vs {draft_processor.image_seq_len})"
+    return None
+
+
+class SpeculativeDecoder:
+    # Жадное спекулятивное декодирование для одной задачи: черновик предлагает k токенов,
+    # основная модель проверяет их одним forward и принимает совпавший префикс плюс свой токен.
+    # assistant_model из generate() не подходит: он отдаёт черновику image_hidden_states основной
+    # модели, а у 256M и 500M разная ширина скрытого состояния.
+    def __init__(self, target: Any, draft: Any, image_token_id: int, num_tokens: int, adaptive: bool) -> None:
+        self.target = target
+        self.draft = draft
+        self.image_token_id = image_token_id
+        self.num_tokens = max(1, num_tokens)
+        self.adaptive = adaptive
+
+    def _forward(
+        self,
+        model: Any,
+        tokens: torch.Tensor,
+        past_length: int,
+        cache: DynamicCache,
+        features: torch.Tensor | None,
+        logits_to_keep: int = 0,
+    ) -> torch.Tensor:
+        length = past_length + tokens.shape[1]
+        kwargs: Dict[str, Any] = {}
+        # Признаки картинки нужны, только пока в подаваемых токенах есть <image>
+        if features is not None and bool((tokens == self.image_token_id).any()):
+            kwargs["image_hidden_states"] = features
+        outputs = model(
+            input_ids=tokens,
+            attention_mask=torch.ones((1, length), dtype=torch.long, device=tokens.device),
+            cache_position=torch.arange(past_length, length, device=tokens.device),
+            past_key_values=cache,
+            use_cache=True,
+            logits_to_keep=logits_to_keep,
+            **kwargs,
+        )
+        return outputs.logits
+
+    @torch.inference_mode()
+    def generate(
+        self,
+        input_ids: torch.Tensor,
+        features: torch.Tensor,
+        draft_features: torch.Tensor,
+        stopper: EarlyStopper,
+        timer: GenerationTimer,
+        streamer: TextStreamer | None = None,
+        cache: DynamicCache | None = None,
+        cached_length: int = 0,
+    ) -> Tuple[torch.Tensor, Dict[str, int]]:
+        # cache/cached_length — KV основной модели для начала промпта (из префиксного кэша).
+        # Возвращает промпт + новые токены, как generate(), и счётчики черновика.
+        max_new_tokens = stopper.max_budget
+        cache = cache if cache is not None else DynamicCache()
+        draft_cache = DynamicCache()
+        prompt_length = input_ids.shape[1]
+        ids = input_ids
+        if streamer is not None:
+            streamer.put(input_ids.cpu())
+
+        logits = self._forward(self.target, ids[:, cached_length:], cached_length, cache, features, logits_to_keep=1)
+        pending = logits[:, -1:].argmax(dim=-1)
+        k = self.num_tokens
+        proposed = accepted = 0
+
+        while True:
+            # Токены, выбранные основной моделью, проходят через те же timer/stopper/streamer, что и в generate()
+            done = False
+            for token in pending[0]:
+                ids = torch.cat([ids, token.view(1, 1)], dim=1)
+                timer(ids, None)
+                if streamer is not None:
+                    streamer.put(token.view(1).cpu())
+                if bool(stopper(ids, None)[0]):
+                    done = True
+                    break
+            if done or ids.shape[1] - prompt_length >= max_new_tokens:
+                break
+
+            # Кэши содержат всё, кроме последнего токена; хвост после расхождения отрезаем
+            cache.crop(ids.shape[1] - 1)
+            if draft_cache.get_seq_length() > ids.shape[1] - 1:
+                draft_cache.crop(ids.shape[1] - 1)
+
+            # Последний токен всегда добавит основная модель, поэтому черновику — на один меньше остатка
+            steps = min(k, max_new_tokens - (ids.shape[1] - prompt_length) - 1)
+            drafted = []
+            draft_length = draft_cache.get_seq_length()
+            tokens = ids[:, draft_length:]
+            for _ in range(steps):
+                draft_logits = self._forward(
+                    self.draft, tokens, draft_length, draft_cache, draft_features, logits_to_keep=1
+                )
+                draft_length += tokens.shape[1]
+                tokens = draft_logits[:, -1:].argmax(dim=-1)
+                drafted.append(tokens)
+
+            candidate = torch.cat([ids[:, -1:], *drafted], dim=1)
+            verified = self._forward(self.target, candidate, ids.shape[1] - 1, cache, features).argmax(dim=-1)
+            matches = (verified[0, :steps] == candidate[0, 1:]).long()
+            n = int(matches.cumprod(dim=0).sum()) if steps else 0
+            pending = torch.cat([candidate[:, 1:n + 1], verified[:, n:n + 1]], dim=1)
+
+            proposed += steps
+            accepted += n
+            if self.adaptive and steps:
+                # Как в transformers: все приняты — предлагаем больше, иначе меньше
+                k = k + 2 if n == steps else max(1, k - 1)
+
+        if streamer is not None:
+            streamer.end()
+        return ids, {"draft_tokens": proposed, "accepted_tokens": accepted}
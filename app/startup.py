@@ -0,0 +1,58 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class StartupState:
+    def __init__(self) -> None:
+        self.started_at = time.perf_counter()
+        self.phases: Dict[str, float] = {}
+        self.error: str | None = None
+        self._ready = threading.Event()
+        self._lock = threading.Lock()
+
+        metrics.REGISTRY.gauge_callback(
+            "vlm_ready",
+            "1 once the model is loaded and warmed up.",
+            lambda: 1.0 if self.is_ready() else 0.0,
+        )
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        started = time.perf_counter()
+        logger.info(f"[Startup] {name} ...")
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                self.phases[name] = elapsed
+            logger.info(f"[Startup] {name} took {elapsed:.2f}s")
+
+    def mark_ready(self) -> None:
+        total = time.perf_counter() - self.started_at
+        with self._lock:
+            self.phases["total"] = total
+        self._ready.set()
+        logger.info(f"[Startup] Ready ✅ ({total:.2f}s since start)")
+
+    def mark_failed(self, error: BaseException) -> None:
+        self.error = f"{type(error).__name__}: {error}"
+        logger.error(f"[Startup] Failed: {self.error}")
+
+    def is_ready(self) -> bool:
+        return self._ready.is_set()
+
+    def wait(self, timeout: float | None = None) -> bool:
+        return self._ready.wait(timeout)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            phases = {name: round(seconds, 3) for name, seconds in self.phases.items()}
+        return {"ready": self.is_ready(), "error": self.error, "phases_s": phases}
@@ -0,0 +1,141 @@
+import math
+from typing import Any, List, Sequence, Tuple
+
+import torch
+from transformers import StoppingCriteria
+
+from . import config
+
+# Начало новой реплики: модель дописала ответ и принялась сочинять диалог дальше
+TURN_MARKERS = ("\nUser:", "\nAssistant:")
+SENTENCE_ENDS = (".", "!", "?", "\n")
+
+# Сколько последних токенов декодировать при поиске стоп-строк
+_TAIL_TOKENS = 8
+# Минимум повторов, чтобы считать хвост зацикливанием
+_LOOP_MIN_REPEATS = 3
+
+
+def token_budget(mode: str, requested: int | None = None) -> int:
+    # Читается при каждом вызове, чтобы бенчмарки могли подменять config на лету
+    by_mode = {
+        "chat": config.CHAT_MAX_NEW_TOKENS,
+        "ocr": config.OCR_MAX_NEW_TOKENS,
+        "video": config.VIDEO_MAX_NEW_TOKENS,
+    }
+    budget = requested or by_mode.get(mode) or config.MAX_NEW_TOKENS
+    return max(1, min(int(budget), config.MAX_NEW_TOKENS_LIMIT))
+
+
+class StopPolicy:
+    __slots__ = ("budget", "stop_strings", "detect_loops", "soft_budget")
+
+    def __init__(self, budget: int, stop_strings: Sequence[str], detect_loops: bool, soft_budget: int) -> None:
+        self.budget = budget
+        self.stop_strings = tuple(stop_strings)
+        self.detect_loops = detect_loops
+        self.soft_budget = soft_budget
+
+
+def policy_for(mode: str, requested: int | None = None) -> StopPolicy:
+    budget = token_budget(mode, requested)
+    extra = tuple(config.STOP_STRINGS)
+    detect_loops = config.LOOP_MAX_PERIOD > 0
+    if mode == "ocr":
+        # В OCR «User:» вполне может быть текстом на картинке
+        return StopPolicy(budget, extra, detect_loops, soft_budget=0)
+    soft = config.CHAT_SOFT_MAX_TOKENS if mode == "chat" else 0
+    # Явно запрошенный бюджет клиент выбрал сам — не обрезаем ответ раньше него
+    if requested or soft >= budget:
+        soft = 0
+    return StopPolicy(budget, TURN_MARKERS + extra, detect_loops, soft_budget=soft)
+
+
+def find_loop(tokens: List[int], max_period: int, min_span: int) -> int | None:
+    # Хвост вида (u u u ...) с периодом p: повторов не меньше 3 и не короче min_span токенов,
+    # чтобы строка из точек или тире в таблице не считалась петлёй слишком рано
+    for period in range(1, max_period + 1):
+        repeats = max(_LOOP_MIN_REPEATS, math.ceil(min_span / period))
+        span = period * repeats
+        if len(tokens) < span:
+            continue
+        unit = tokens[-period:]
+        if tokens[-span:] == unit * repeats:
+            return period
+    return None
+
+
+def loop_start(tokens: List[int], period: int) -> int:
+    # Откуда начинается повторяющийся хвост: идём назад, пока токены совпадают через период
+    start = len(tokens) - period
+    while start > 0 and tokens[start - 1] == tokens[start - 1 + period]:
+        start -= 1
+    return start
+
+
+def cut_at_stop(text: str, stop_strings: Sequence[str]) -> str:
+    positions = [text.find(s) for s in stop_strings if s and s in text]
+    return text[:min(positions)] if positions else text
+
+
+class EarlyStopper(StoppingCriteria):
+    # Один критерий на весь батч: у каждой строки свой бюджет и свои правила.
+    # generate() дописывает pad-токены строкам, для которых вернули True.
+    def __init__(self, tokenizer: Any, policies: List[StopPolicy], eos_token_ids: Sequence[int]) -> None:
+        self.tokenizer = tokenizer
+        self.policies = policies
+        self.eos_token_ids = {int(t) for t in eos_token_ids if t is not None}
+        self.reasons: List[str | None] = [None] * len(policies)
+        # Сколько новых токенов оставить в ответе (для петель); None — все
+        self.keep: List[int | None] = [None] * len(policies)
+        self._start: int | None = None
+
+    @property
+    def max_budget(self) -> int:
+        return max(policy.budget for policy in self.policies)
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs: Any) -> torch.BoolTensor:
+        if self._start is None:
+            # Первый вызов — сразу после первого нового токена; паддинг левый, так что граница общая
+            self._start = input_ids.shape[1] - 1
+        new_tokens = input_ids[:, self._start:].tolist()
+        done = [reason is not None for reason in self.reasons]
+        for i, (policy, tokens) in enumerate(zip(self.policies, new_tokens)):
+            if done[i]:
+                continue
+            reason = self._check(i, policy, tokens)
+            if reason is not None:
+                self.reasons[i] = reason
+                done[i] = True
+        return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
+    def _check(self, row: int, policy: StopPolicy, tokens: List[int]) -> str | None:
+        if tokens[-1] in self.eos_token_ids:
+            return "eos"
+        if policy.detect_loops:
+            period = find_loop(tokens, config.LOOP_MAX_PERIOD, config.LOOP_MIN_SPAN)
+            if period is not None:
+                self.keep[row] = loop_start(tokens, period) + period
+                return "loop"
+        if policy.stop_strings or policy.soft_budget:
+            tail = self.tokenizer.decode(tokens[-_TAIL_TOKENS:], skip_special_tokens=True)
+            if any(s in tail for s in policy.stop_strings):
+                return "stop_string"
+            if policy.soft_budget and len(tokens) >= policy.soft_budget and tail.rstrip(" ").endswith(SENTENCE_ENDS):
+                return "end_of_answer"
+        if len(tokens) >= policy.budget:
+            return "budget"
+        return None
+
+    def finalize(self, new_tokens: torch.Tensor) -> List[Tuple[str, str]]:
+        # Текст каждой строки без хвостов, которые не входят в ответ, и причина остановки
+        results = []
+        for i, policy in enumerate(self.policies):
+            tokens = new_tokens[i]
+            if self.keep[i] is not None:
+                tokens = tokens[:self.keep[i]]
+            text = self.tokenizer.decode(tokens, skip_special_tokens=True)
+            text = cut_at_stop(text, policy.stop_strings)
+            # Причина пуста, если generate() остановился сам (например, по max_new_tokens)
+            results.append((text.strip(), self.reasons[i] or "budget"))
+        return results
@@ -0,0 +1,182 @@
+import math
+from difflib import SequenceMatcher
+from typing import Any, List, Tuple
+
+import numpy as np
+from PIL import Image
+
+from . import config
+
+TILING_MODES = ("off", "auto", "on")
+
+Box = Tuple[int, int, int, int]
+
+# Профиль «чернил» считается на уменьшенной копии: построчная точность в пару пикселей не нужна
+_PROFILE_SIDE = 2048
+# Насколько пиксель должен отличаться от фона, чтобы считаться текстом
+_INK_DELTA = 48
+# Доля «чернильных» пикселей, ниже которой строка пустая (промежуток между строками текста)
+_BLANK_ROW = 0.002
+# Полоса с меньшей долей чернил не отправляется в модель
+_BLANK_TILE = 0.001
+# Поля вокруг найденного текста, в пикселях исходной картинки
+_MARGIN = 16
+
+# Сколько строк на стыке двух полос сравниваются при склейке
+_MAX_OVERLAP_LINES = 8
+_SIMILAR_LINE = 0.9
+# Крайние строки полосы могут быть обрезаны её краем — их сравниваем мягче,
+# но в среднем стык должен совпадать почти целиком: лишний повтор лучше потерянной строки
+_SIMILAR_EDGE_LINE = 0.75
+_SIMILAR_OVERLAP = 0.85
+
+
+class PreparedDocument:
+    __slots__ = ("tiles", "boxes", "overlaps", "size")
+
+    def __init__(self, tiles: List[Any], boxes: List[Box], overlaps: List[bool], size: Tuple[int, int]) -> None:
+        # tiles — PreparedImage по одному на полосу, сверху вниз;
+        # overlaps[i] — перекрываются ли полосы i и i + 1 (разрез прошёл по тексту)
+        self.tiles = tiles
+        self.boxes = boxes
+        self.overlaps = overlaps
+        self.size = size
+
+
+def tiling_mode(requested: str | None) -> str:
+    return (requested or config.OCR_TILING).lower()
+
+
+def needs_tiling(size: Tuple[int, int], longest_edge: int | None, mode: str) -> bool:
+    # auto: режем, только если процессор ужал бы страницу заметно сильнее, чем одну полосу
+    if mode == "off" or not longest_edge:
+        return False
+    if mode == "on":
+        return True
+    return longest_edge / max(size) < config.OCR_TILE_MIN_SCALE
+
+
+def _ink_mask(image: Image.Image) -> Tuple[np.ndarray, int]:
+    factor = max(1, math.ceil(max(image.size) / _PROFILE_SIDE))
+    gray = image.convert("L")
+    if factor > 1:
+        gray = gray.reduce(factor)
+    pixels = np.asarray(gray, dtype=np.int16)
+    # Фон — самый частый уровень яркости: работает и для тёмного текста на светлом, и наоборот
+    background = int(np.bincount(pixels.ravel(), minlength=256).argmax())
+    return np.abs(pixels - background) > _INK_DELTA, factor
+
+
+def _content_box(mask: np.ndarray, factor: int, size: Tuple[int, int]) -> Box | None:
+    rows = np.flatnonzero(mask.mean(axis=1) > _BLANK_ROW)
+    cols = np.flatnonzero(mask.mean(axis=0) > _BLANK_ROW)
+    if not len(rows) or not len(cols):
+        return None
+    width, height = size
+    return (
+        max(0, int(cols[0]) * factor - _MARGIN),
+        max(0, int(rows[0]) * factor - _MARGIN),
+        min(width, (int(cols[-1]) + 1) * factor + _MARGIN),
+        min(height, (int(rows[-1]) + 1) * factor + _MARGIN),
+    )
+
+
+def _snap_cut(row_ink: np.ndarray, factor: int, cut: int, window: int) -> Tuple[int, bool]:
+    # Ищем ближайшую к разрезу пустую строку; True — разрез прошёл по тексту и нужно перекрытие
+    lo = max(0, (cut - window) // factor)
+    hi = min(len(row_ink), (cut + window) // factor + 1)
+    blank = [row for row in range(lo, hi) if row_ink[row] <= _BLANK_ROW]
+    if not blank:
+        return cut, True
+    best = min(blank, key=lambda row: abs(row * factor - cut))
+    return best * factor, False
+
+
+def plan_tiles(image: Image.Image, longest_edge: int, overlap: float, max_tiles: int) -> Tuple[List[Box], List[bool]]:
+    # Полосы на всю ширину текста, сверху вниз: строка никогда не режется по горизонтали,
+    # а порядок чтения совпадает с порядком полос
+    mask, factor = _ink_mask(image)
+    box = _content_box(mask, factor, image.size)
+    if box is None:
+        return [(0, 0, *image.size)], []
+    left, top, right, bottom = box
+    width, height = right - left, bottom - top
+
+    # Высота полосы не меньше ширины: уже полосы процессор всё равно масштабирует по ширине
+    strip = max(width, longest_edge)
+    count = min(max_tiles, max(1, math.ceil(height / strip)))
+    if count == 1:
+        return [box], []
+
+    row_ink = mask.mean(axis=1)
+    pad = int(height / count * overlap / 2)
+    cuts, overlaps = [], []
+    for i in range(1, count):
+        cut, overlapped = _snap_cut(row_ink, factor, top + round(height * i / count), max(pad, factor))
+        cuts.append(cut)
+        overlaps.append(overlapped)
+
+    boxes = []
+    edges = [top, *cuts, bottom]
+    for i in range(count):
+        upper = edges[i] - (pad if i and overlaps[i - 1] else 0)
+        lower = edges[i + 1] + (pad if i < count - 1 and overlaps[i] else 0)
+        boxes.append((left, max(top, upper), right, min(bottom, lower)))
+
+    # Пустые полосы (большой промежуток посреди страницы) в модель не отправляем
+    keep = [
+        i for i, (_, upper, _, lower) in enumerate(boxes)
+        if mask[upper // factor:max(upper // factor + 1, lower // factor)].mean() >= _BLANK_TILE
+    ] or [0]
+    # Стык между оставшимися полосами перекрыт, только если они были соседями с перекрытием
+    kept_overlaps = [b == a + 1 and overlaps[a] for a, b in zip(keep, keep[1:])]
+    return [boxes[i] for i in keep], kept_overlaps
+
+
+def _normalize(line: str) -> str:
+    return " ".join(line.lower().split())
+
+
+def _line_similarity(a: str, b: str) -> float:
+    a, b = _normalize(a), _normalize(b)
+    if a == b:
+        return 1.0
+    # «Item 1» и «Item 2», суммы в таблице: строки с разными числами — разные строки
+    if not a or not b or _digits(a) != _digits(b):
+        return 0.0
+    return SequenceMatcher(None, a, b, autojunk=False).ratio()
+
+
+def _digits(line: str) -> str:
+    return "".join(ch for ch in line if ch.isdigit())
+
+
+def _overlap_lines(previous: List[str], lines: List[str]) -> int:
+    # Самый длинный хвост предыдущей полосы, совпадающий с началом следующей
+    for n in range(min(len(previous), len(lines), _MAX_OVERLAP_LINES), 0, -1):
+        scores = [_line_similarity(a, b) for a, b in zip(previous[-n:], lines[:n])]
+        if sum(scores) / n < _SIMILAR_OVERLAP:
+            continue
+        if all(
+            score >= (_SIMILAR_EDGE_LINE if i in (0, n - 1) else _SIMILAR_LINE)
+            for i, score in enumerate(scores)
+        ):
+            return n
+    return 0
+
+
+def merge_texts(texts: List[str], overlaps: List[bool]) -> str:
+    # Склейка в порядке полос; на перекрытых стыках повторённые строки остаются один раз,
+    # из двух прочтений берётся более длинное (у обрезанной краем строки оно обычно короче)
+    merged: List[str] = []
+    for i, text in enumerate(texts):
+        lines = [line.rstrip() for line in text.strip().splitlines()]
+        if not lines:
+            continue
+        n = _overlap_lines(merged, lines) if i and overlaps[i - 1] else 0
+        if n:
+            best = [max(a, b, key=len) for a, b in zip(merged[-n:], lines[:n])]
+            merged[-n:] = best
+            lines = lines[n:]
+        merged.extend(lines)
+    return "\n".join(merged)
@@ -0,0 +1,71 @@
+import time
+from typing import Any, Dict, List, Tuple
+
+import torch
+from transformers import LogitsProcessor
+
+from . import metrics
+
+# Стадии записи о задаче в порядке прохождения конвейера
+STAGES = ("queue_s", "preprocess_s", "image_s", "prefill_s", "decode_s", "total_s")
+
+
+class GenerationTimer(LogitsProcessor):
+    # Вызывается generate() один раз на шаг, сразу после forward:
+    # первый вызов отмечает конец prefill, число вызовов — число новых токенов.
+    def __init__(self) -> None:
+        self.started = time.perf_counter()
+        self.first_token_at: float | None = None
+        self.steps = 0
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+        self.steps += 1
+        return scores
+
+    def split(self, finished: float) -> Tuple[float, float]:
+        first = self.first_token_at if self.first_token_at is not None else finished
+        return first - self.started, finished - first
+
+
+def observe_generation(modes: List[str], timings: List[Dict[str, Any]]) -> None:
+    for mode, timing in zip(modes, timings):
+        metrics.IMAGE_ENCODE_SECONDS.observe(timing.get("image_s", 0.0), mode=mode)
+        metrics.PREFILL_SECONDS.observe(timing.get("prefill_s", 0.0), mode=mode)
+        metrics.DECODE_SECONDS.observe(timing.get("decode_s", 0.0), mode=mode)
+        metrics.INPUT_TOKENS.inc(timing.get("input_tokens", 0), mode=mode)
+        metrics.OUTPUT_TOKENS.inc(timing.get("output_tokens", 0), mode=mode)
+        metrics.USED_TOKENS.inc(timing.get("used_tokens", 0), mode=mode)
+        if "stop_reason" in timing:
+            metrics.GENERATION_STOPS.inc(mode=mode, reason=timing["stop_reason"])
+        if timing.get("draft_tokens"):
+            metrics.DRAFT_TOKENS.inc(timing["draft_tokens"], mode=mode)
+            metrics.DRAFT_ACCEPTED_TOKENS.inc(timing["accepted_tokens"], mode=mode)
+            metrics.DRAFT_ACCEPTANCE.observe(timing["accepted_tokens"] / timing["draft_tokens"], mode=mode)
+        decode_s = timing.get("decode_s", 0.0)
+        if decode_s > 0 and timing.get("output_tokens", 0) > 1:
+            # Первый токен появляется в конце prefill, поэтому в decode их на один меньше
+            metrics.DECODE_TOKENS_PER_SECOND.observe((timing["output_tokens"] - 1) / decode_s, mode=mode)
+
+
+def record_request(mode: str, source: str, outcome: str, started: float) -> None:
+    metrics.REQUESTS.inc(mode=mode, source=source, outcome=outcome)
+    metrics.REQUEST_SECONDS.observe(time.perf_counter() - started, mode=mode, source=source)
+
+
+def server_timing(timing: Dict[str, Any] | None) -> str:
+    # Формат заголовка Server-Timing: "queue;dur=12.3, prefill;dur=80.1", длительности в мс
+    if not timing:
+        return ""
+    parts = [
+        f"{stage[:-2]};dur={timing[stage] * 1000:.1f}"
+        for stage in STAGES
+        if isinstance(timing.get(stage), (int, float))
+    ]
+    for key in ("input_tokens", "output_tokens", "used_tokens", "draft_tokens", "accepted_tokens", "tiles"):
+        if key in timing:
+            parts.append(f'{key.replace("_", "-")};desc="{int(timing[key])}"')
+    if "stop_reason" in timing:
+        parts.append(f'stop;desc="{timing["stop_reason"]}"')
+    return ", ".join(parts)
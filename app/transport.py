@@ -0,0 +1,718 @@
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import queue
+import secrets
+import socket
+import struct
+import threading
+import time
+from contextlib import nullcontext
+from typing import Any, BinaryIO, Callable, ContextManager, Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+
+from . import config
+from . import metrics
+from .payload import cleanup_task, read_task_image
+from .result_broker import is_final
+from .router import AUTO, UnknownModelError, served_models
+from .scheduler import QueueFullError, TaskScheduler
+
+logger = logging.getLogger(__name__)
+
+# Очередь задач между узлами. Фронтенд (HTTP/UI) держит RemoteTaskQueue вместо ModelRouter,
+# воркер — RemoteWorkerQueue вместо TaskScheduler; между ними TaskBroker.
+# Интерфейс тот же, что у локальной очереди: put / cancel / position / qsize / snapshot / load
+# для фронтенда и get / task_done / record_service для воркера.
+
+# Кадр: длина JSON-заголовка и длина двоичного тела, затем они сами. Картинка едет телом как есть
+_PREFIX = struct.Struct("!II")
+_MAX_HEADER_BYTES = 16 * 1024 * 1024
+# Поля задачи, которые не едут в заголовке: картинка — телом кадра, путь к файлу на другом узле бесполезен
+_LOCAL_FIELDS = ("image_bytes", "image_path", "cleanup", "prepared", "prepare_error")
+_RECONNECT_MAX_S = 5.0
+_LOOPBACK_HOSTS = ("127.0.0.1", "localhost", "::1")
+
+
+class TransportError(RuntimeError):
+    pass
+
+
+def parse_address(url: str) -> Tuple[str, int]:
+    parsed = urlparse(url if "://" in url else f"tcp://{url}")
+    if parsed.scheme != "tcp" or not parsed.port:
+        raise ValueError(f"Task broker address must look like tcp://host:port, got {url!r}")
+    return parsed.hostname or "127.0.0.1", parsed.port
+
+
+def encode_frame(header: Dict[str, Any], blob: bytes = b"") -> bytes:
+    data = json.dumps(header, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return _PREFIX.pack(len(data), len(blob)) + data + blob
+
+
+def _frame_sizes(prefix: bytes) -> Tuple[int, int]:
+    header_len, blob_len = _PREFIX.unpack(prefix)
+    if header_len > _MAX_HEADER_BYTES or blob_len > config.VIDEO_MAX_BYTES:
+        raise ValueError(f"Frame too large (header={header_len}, body={blob_len})")
+    return header_len, blob_len
+
+
+def read_frame(stream: BinaryIO) -> Tuple[Dict[str, Any], bytes]:
+    def exactly(n: int) -> bytes:
+        data = stream.read(n)
+        if data is None or len(data) < n:
+            raise ConnectionError("Connection closed")
+        return data
+
+    header_len, blob_len = _frame_sizes(exactly(_PREFIX.size))
+    header = json.loads(exactly(header_len))
+    return header, exactly(blob_len) if blob_len else b""
+
+
+async def read_frame_async(reader: asyncio.StreamReader) -> Tuple[Dict[str, Any], bytes]:
+    header_len, blob_len = _frame_sizes(await reader.readexactly(_PREFIX.size))
+    header = json.loads(await reader.readexactly(header_len))
+    return header, await reader.readexactly(blob_len) if blob_len else b""
+
+
+def task_frame(task: Dict[str, Any]) -> Tuple[Dict[str, Any], bytes]:
+    header = {key: value for key, value in task.items() if key not in _LOCAL_FIELDS}
+    blob = read_task_image(task) if task.get("image_bytes") is not None or task.get("image_path") else b""
+    return header, blob
+
+
+def task_from_frame(header: Dict[str, Any], blob: bytes) -> Dict[str, Any]:
+    task = dict(header)
+    if blob:
+        task["image_bytes"] = blob
+    return task
+
+
+def _set_nodelay(sock: Optional[socket.socket]) -> None:
+    # Кадры маленькие и ждут ответа — без Nagle задержка не копится
+    if sock is not None:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+class _Connection:
+    # Постоянное соединение с брокером задач: переподключается само,
+    # входящие кадры отдаёт в on_frame из своего потока
+    def __init__(
+        self,
+        address: Tuple[str, int],
+        hello: Callable[[], Dict[str, Any]],
+        on_frame: Callable[[Dict[str, Any], bytes], None],
+        on_disconnect: Callable[[], None] | None = None,
+        name: str = "TaskBroker",
+    ) -> None:
+        self.address = address
+        self.hello = hello
+        self.on_frame = on_frame
+        self.on_disconnect = on_disconnect
+        self.name = name
+        self.connected = threading.Event()
+        self._sock: socket.socket | None = None
+        # RLock: вызывающий может держать её вокруг send(), чтобы его учёт не разошёлся с hello
+        self.lock = threading.RLock()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def send(self, header: Dict[str, Any], blob: bytes = b"") -> None:
+        frame = encode_frame(header, blob)
+        with self.lock:
+            if self._sock is None:
+                raise TransportError("Not connected to the task broker")
+            try:
+                self._sock.sendall(frame)
+            except OSError as e:
+                raise TransportError(f"Send to the task broker failed: {e}") from e
+
+    def _run(self) -> None:
+        delay = 0.1
+        host, port = self.address
+        while True:
+            try:
+                sock = socket.create_connection(self.address, timeout=config.TRANSPORT_TIMEOUT_S)
+            except OSError as e:
+                logger.warning(f"[{self.name}] Task broker {host}:{port} unreachable ({e}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+                delay = min(delay * 2, _RECONNECT_MAX_S)
+                continue
+
+            sock.settimeout(None)
+            _set_nodelay(sock)
+            stream = sock.makefile("rb")
+            try:
+                # hello и подключение — одним шагом: send() из других потоков видит либо старое состояние, либо новое
+                with self.lock:
+                    sock.sendall(encode_frame(self.hello()))
+                    self._sock = sock
+                self.connected.set()
+                delay = 0.1
+                logger.info(f"[{self.name}] Connected to task broker {host}:{port} ✅")
+                while True:
+                    header, blob = read_frame(stream)
+                    self.on_frame(header, blob)
+            except (OSError, ConnectionError, ValueError) as e:
+                logger.warning(f"[{self.name}] Lost connection to task broker: {e}")
+            finally:
+                self.connected.clear()
+                with self.lock:
+                    self._sock = None
+                stream.close()
+                sock.close()
+                if self.on_disconnect is not None:
+                    self.on_disconnect()
+            time.sleep(delay)
+
+
+class RemoteTaskQueue:
+    # task_queue фронтенда: задачи уходят брокеру, результаты возвращаются по этому же
+    # соединению и кладутся в result_queue (локальный ResultBroker)
+    def __init__(
+        self,
+        url: str | None = None,
+        result_queue: "queue.Queue[Dict[str, Any]] | None" = None,
+        frontend_id: str | None = None,
+    ) -> None:
+        self.address = parse_address(url or config.TASK_BROKER_URL)
+        self.result_queue = result_queue
+        # id фронтенда: по нему брокер находит, кому вернуть результат, в том числе после переподключения
+        self.frontend_id = frontend_id or f"{socket.gethostname()}-{os.getpid()}-{secrets.token_hex(3)}"
+        self.model_ids = served_models()
+        self.models = list(self.model_ids)
+        self._calls: Dict[int, List[Any]] = {}
+        self._calls_lock = threading.Lock()
+        self._req = itertools.count(1)
+        self._conn = _Connection(
+            self.address,
+            lambda: {"op": "hello", "role": "frontend", "id": self.frontend_id, "token": config.TASK_BROKER_TOKEN},
+            self._on_frame,
+            on_disconnect=self._fail_calls,
+            name="RemoteTaskQueue",
+        )
+        self._conn.start()
+
+    def _on_frame(self, header: Dict[str, Any], blob: bytes) -> None:
+        op = header.get("op")
+        if op == "result":
+            if self.result_queue is not None:
+                self.result_queue.put(header["message"])
+        elif op == "reply":
+            with self._calls_lock:
+                call = self._calls.get(header.get("req"))
+            if call is not None:
+                call[1] = header
+                call[0].set()
+
+    def _fail_calls(self) -> None:
+        # Ответов по оборванному соединению не будет — будим всех, кто ждёт
+        with self._calls_lock:
+            calls = list(self._calls.values())
+        for event, _ in calls:
+            event.set()
+
+    def _call(self, header: Dict[str, Any], blob: bytes = b"") -> Dict[str, Any]:
+        req = next(self._req)
+        call: List[Any] = [threading.Event(), None]
+        with self._calls_lock:
+            self._calls[req] = call
+        try:
+            self._conn.send({**header, "req": req}, blob)
+            if not call[0].wait(config.TRANSPORT_TIMEOUT_S) or call[1] is None:
+                raise TransportError("Task broker did not answer")
+            return call[1]
+        finally:
+            with self._calls_lock:
+                self._calls.pop(req, None)
+
+    def route(self, task: Dict[str, Any]) -> str:
+        # Как ModelRouter.route, но без SLO: очереди и их загрузку видит только брокер
+        if task.get("model_id"):
+            return task["model"]
+        requested = task.get("model") or AUTO
+        if requested == AUTO:
+            name, reason = config.ROUTE_BY_MODE.get(task.get("mode", "chat"), config.MODEL_SIZE), "mode"
+        elif requested in self.model_ids:
+            name, reason = requested, "requested"
+        else:
+            raise UnknownModelError(f"Unknown model {requested!r}, use one of: {', '.join([AUTO, *self.models])}.")
+        task["model"] = name
+        task["model_id"] = self.model_ids[name]
+        metrics.MODEL_ROUTES.inc(model=name, reason=reason)
+        return name
+
+    def put(self, task: Dict[str, Any], block: bool = True, timeout: float | None = None) -> None:
+        self.route(task)
+        task.setdefault("enqueued_at", time.time())
+        header, blob = task_frame(task)
+        try:
+            reply = self._call({"op": "submit", "task": header}, blob)
+        except TransportError as e:
+            # Для клиента недоступный брокер — та же перегрузка: 429 и повтор позже
+            raise QueueFullError(config.TRANSPORT_TIMEOUT_S, f"Task broker is unavailable ({e}).") from e
+        if "rejected" in reply:
+            raise QueueFullError(float(reply.get("retry_after", 1.0)), reply["rejected"])
+        # Картинка уже у брокера, временный файл в uploads/ больше не нужен
+        cleanup_task(task)
+
+    def put_nowait(self, task: Dict[str, Any]) -> None:
+        self.put(task, block=False)
+
+    def cancel(self, task_id: Any) -> bool:
+        try:
+            return bool(self._call({"op": "cancel", "id": task_id}).get("ok"))
+        except TransportError:
+            return False
+
+    def position(self, task_id: Any) -> Optional[Dict[str, Any]]:
+        try:
+            return self._call({"op": "position", "id": task_id}).get("position")
+        except TransportError:
+            return None
+
+    def stats(self) -> Dict[str, Any]:
+        try:
+            return self._call({"op": "stats"})
+        except TransportError:
+            return {}
+
+    def qsize(self) -> int:
+        return sum(model.get("queued", 0) for model in self.stats().get("models", {}).values())
+
+    def empty(self) -> bool:
+        return self.qsize() == 0
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        models = self.stats().get("models", {})
+        return [
+            {
+                "name": name,
+                "model_id": model_id,
+                "state": "remote" if self._conn.connected.is_set() else "disconnected",
+                "queued": models.get(name, {}).get("queued", 0),
+                "workers": models.get(name, {}).get("workers", 0),
+            }
+            for name, model_id in self.model_ids.items()
+        ]
+
+    def is_connected(self) -> bool:
+        return self._conn.connected.is_set()
+
+    def load(self, name: str, warmup: bool = False, phase: Callable[[str], ContextManager[Any]] | None = None) -> None:
+        # Модели на воркерах; фронтенд готов, когда достучался до брокера (дальше /ready смотрит is_connected)
+        phase = phase or (lambda _: nullcontext())
+        with phase("task_broker_connect"):
+            self._conn.connected.wait()
+
+
+class _ResultSender:
+    def __init__(self, conn: _Connection, keep: Callable[[Dict[str, Any]], bool] | None = None) -> None:
+        self.conn = conn
+        self.keep = keep
+
+    def put(self, message: Dict[str, Any]) -> None:
+        if self.keep is not None and not self.keep(message):
+            return
+        try:
+            self.conn.send({"op": "result", "message": message})
+        except TransportError as e:
+            # Брокер уже вернул задачу в очередь (соединение оборвалось) — её выполнит другой воркер
+            logger.warning(f"[RemoteWorker] Result for task_id={message.get('id')} not sent: {e}")
+
+
+class RemoteWorkerQueue:
+    # task_queue воркера на отдельном узле. Брокер присылает задачи только на свободные места
+    # (prefetch — сколько задач воркер держит у себя), task_done() возвращает место;
+    # результаты уходят через results тем же соединением
+    def __init__(self, url: str | None = None, models: List[str] | None = None, prefetch: int | None = None) -> None:
+        self.address = parse_address(url or config.TASK_BROKER_URL)
+        self.models = models or [config.MODEL_SIZE]
+        self.prefetch = max(1, prefetch or config.WORKER_PREFETCH or 2 * config.NUM_WORKERS * config.BATCH_MAX_SIZE)
+        self._tasks: "queue.Queue[Dict[str, Any]]" = queue.Queue()
+        # Задачи, полученные от брокера и ещё не вернувшие место через task_done()
+        self._outstanding = 0
+        # Номер соединения и task_id -> номер соединения, с которым задача пришла. Задачи оборванного
+        # соединения брокер уже вернул в очередь: их не запускаем и их результаты не отправляем
+        self._generation = 0
+        self._owned: Dict[Any, int] = {}
+        self._lock = threading.Lock()
+        self._conn = _Connection(self.address, self._hello, self._on_frame, self._drop_prefetched, "RemoteWorker")
+        self.results = _ResultSender(self._conn, keep=self._is_current_result)
+
+    def connect(self) -> None:
+        # Подключаться после загрузки модели: иначе брокер отдаст задачи воркеру, который ещё не готов
+        self._conn.start()
+
+    def _hello(self) -> Dict[str, Any]:
+        # После переподключения задачи старого соединения ещё досчитываются, и их task_done() придут
+        # уже новому: объявляем только свободные места, иначе кредиты брокера уйдут за prefetch
+        with self._lock:
+            credits = self.prefetch - self._outstanding
+        return {
+            "op": "hello",
+            "role": "worker",
+            "token": config.TASK_BROKER_TOKEN,
+            "name": f"{socket.gethostname()}-{os.getpid()}",
+            "models": self.models,
+            "credits": max(0, credits),
+            "threads": config.NUM_WORKERS,
+        }
+
+    def _on_frame(self, header: Dict[str, Any], blob: bytes) -> None:
+        if header.get("op") == "task":
+            task = task_from_frame(header["task"], blob)
+            with self._lock:
+                self._outstanding += 1
+                self._owned[task.get("id")] = self._generation
+            self._tasks.put(task)
+
+    def _drop_prefetched(self) -> None:
+        # Брокер вернёт в очередь всё, что числилось за оборванным соединением; локальные копии не нужны.
+        # Уже взятые конвейером (предобработка, очередь prepared) отсеет abandoned()
+        with self._lock:
+            self._generation += 1
+        while True:
+            try:
+                task = self._tasks.get_nowait()
+            except queue.Empty:
+                return
+            with self._lock:
+                self._outstanding -= 1
+                self._owned.pop(task.get("id"), None)
+
+    def get(self, block: bool = True, timeout: float | None = None) -> Dict[str, Any]:
+        return self._tasks.get(block=block, timeout=timeout)
+
+    def abandoned(self, task: Dict[str, Any]) -> bool:
+        # True — задача пришла по оборванному соединению и уже стоит в очереди брокера снова:
+        # вызывающий её не запускает и не публикует, только task_done()
+        with self._lock:
+            task_id = task.get("id")
+            if self._owned.get(task_id, self._generation) == self._generation:
+                return False
+            del self._owned[task_id]
+            return True
+
+    def _is_current_result(self, message: Dict[str, Any]) -> bool:
+        # Досчитанная задача оборванного соединения: её копию выполнит (или уже выполняет) другой воркер
+        with self._lock:
+            task_id = message.get("id")
+            generation = self._owned.get(task_id, self._generation)
+            if is_final(message):
+                self._owned.pop(task_id, None)
+            return generation == self._generation
+
+    def task_done(self) -> None:
+        # Счётчик и кредит — под блокировкой соединения: место возвращается либо старому соединению
+        # (и новое hello его уже учло), либо новому (и hello его ещё не учло), но не обоим
+        with self._conn.lock:
+            with self._lock:
+                self._outstanding -= 1
+            try:
+                self._conn.send({"op": "credit", "n": 1})
+            except TransportError:
+                pass
+
+    def record_service(self, mode: str, seconds: float) -> None:
+        # Оценка ожидания и 429 считаются на брокере — отдаём ему время обработки
+        try:
+            self._conn.send({"op": "service", "mode": mode, "seconds": seconds})
+        except TransportError:
+            pass
+
+
+class _WorkerState:
+    __slots__ = ("writer", "name", "models", "credits", "threads", "inflight")
+
+    def __init__(self, writer: asyncio.StreamWriter, hello: Dict[str, Any]) -> None:
+        self.writer = writer
+        self.name = hello.get("name") or str(writer.get_extra_info("peername"))
+        self.models: List[str] = list(hello.get("models") or [config.MODEL_SIZE])
+        self.credits = int(hello.get("credits", 1))
+        self.threads = max(1, int(hello.get("threads", 1)))
+        # task_id -> (модель, задача): выданы воркеру и ещё не завершены
+        self.inflight: Dict[Any, Tuple[str, Dict[str, Any]]] = {}
+
+
+class TaskBroker:
+    # Брокер задач: очередь допуска на каждую модель (тот же TaskScheduler: приоритеты, 429, отмена,
+    # истечение срока), раздача задач воркерам по свободным местам и возврат результатов
+    # фронтенду, который прислал задачу. Однопоточный: всё состояние живёт в event loop.
+    def __init__(
+        self, host: str = "127.0.0.1", port: int = 7070, max_depth: int | None = None, token: str | None = None
+    ) -> None:
+        self.host = host
+        self.port = port
+        self.max_depth = max_depth
+        # Без токена любой, кто достучался до порта, мог бы забирать задачи или назваться чужим фронтендом
+        self.token = config.TASK_BROKER_TOKEN if token is None else token
+        self._schedulers: Dict[str, TaskScheduler] = {}
+        self._blobs: Dict[Any, bytes] = {}
+        self._owners: Dict[Any, str] = {}
+        self._frontends: Dict[str, asyncio.StreamWriter] = {}
+        self._workers: List[_WorkerState] = []
+        self.counters = {"submitted": 0, "rejected": 0, "completed": 0, "requeued": 0, "undelivered": 0}
+        self._server: asyncio.AbstractServer | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+
+    # --- очереди ---
+
+    def _scheduler(self, model: str) -> TaskScheduler:
+        scheduler = self._schedulers.get(model)
+        if scheduler is None:
+            scheduler = TaskScheduler(max_depth=self.max_depth, on_drop=self._on_drop)
+            self._schedulers[model] = scheduler
+            self._update_capacity()
+            metrics.REGISTRY.gauge_callback(
+                "vlm_queue_depth",
+                "Tasks waiting in the admission queue.",
+                lambda: sum(s.qsize() for s in self._schedulers.values()),
+            )
+        return scheduler
+
+    def _update_capacity(self) -> None:
+        # Оценка ожидания делит очередь на число потоков-воркеров, обслуживающих модель
+        for model, scheduler in self._schedulers.items():
+            scheduler.num_workers = max(1, sum(w.threads for w in self._workers if model in w.models))
+
+    def _on_drop(self, task: Dict[str, Any], reason: str) -> None:
+        task_id = task.get("id")
+        self._blobs.pop(task_id, None)
+        self._send_result({"id": task_id, "error": f"Task was {reason} before processing."})
+
+    def _next_task(self, worker: _WorkerState) -> Tuple[str, Dict[str, Any]] | None:
+        for model in worker.models:
+            scheduler = self._schedulers.get(model)
+            if scheduler is None:
+                continue
+            try:
+                return model, scheduler.get(block=False)
+            except queue.Empty:
+                continue
+        return None
+
+    def _dispatch(self) -> None:
+        # По задаче на воркер за проход: нагрузка расходится поровну, а не достаётся первому
+        progress = True
+        while progress:
+            progress = False
+            for worker in self._workers:
+                if worker.credits <= 0:
+                    continue
+                picked = self._next_task(worker)
+                if picked is None:
+                    continue
+                model, task = picked
+                worker.writer.write(encode_frame({"op": "task", "task": task}, self._blobs.get(task.get("id"), b"")))
+                worker.credits -= 1
+                worker.inflight[task.get("id")] = (model, task)
+                progress = True
+
+    def _send_result(self, message: Dict[str, Any]) -> None:
+        task_id = message.get("id")
+        owner = self._owners.pop(task_id, None) if is_final(message) else self._owners.get(task_id)
+        writer = self._frontends.get(owner) if owner is not None else None
+        if writer is None:
+            self.counters["undelivered"] += 1
+            return
+        writer.write(encode_frame({"op": "result", "message": message}))
+
+    # --- фронтенды ---
+
+    def _frontend_op(self, frontend_id: str, header: Dict[str, Any], blob: bytes) -> Dict[str, Any]:
+        op = header.get("op")
+        if op == "submit":
+            task = header["task"]
+            task_id = task.get("id")
+            self._blobs[task_id] = blob
+            self._owners[task_id] = frontend_id
+            try:
+                self._scheduler(task.get("model") or config.MODEL_SIZE).put(task)
+            except QueueFullError as e:
+                self._blobs.pop(task_id, None)
+                self._owners.pop(task_id, None)
+                self.counters["rejected"] += 1
+                return {"rejected": e.reason, "retry_after": e.retry_after}
+            self.counters["submitted"] += 1
+            self._dispatch()
+            return {"ok": True}
+        if op == "cancel":
+            return {"ok": any(s.cancel(header.get("id")) for s in list(self._schedulers.values()))}
+        if op == "position":
+            for model, scheduler in self._schedulers.items():
+                info = scheduler.position(header.get("id"))
+                if info is not None:
+                    workers = sum(1 for w in self._workers if model in w.models)
+                    return {"position": {**info, "model": model, "model_state": "ready" if workers else "no_workers"}}
+            return {"position": None}
+        if op == "stats":
+            return self.stats()
+        return {"error": f"Unknown op {op!r}"}
+
+    async def _serve_frontend(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, frontend_id: str) -> None:
+        self._frontends[frontend_id] = writer
+        logger.info(f"[TaskBroker] Frontend {frontend_id} connected")
+        try:
+            while True:
+                header, blob = await read_frame_async(reader)
+                reply = self._frontend_op(frontend_id, header, blob)
+                writer.write(encode_frame({"op": "reply", "req": header.get("req"), **reply}))
+                await writer.drain()
+        finally:
+            if self._frontends.get(frontend_id) is writer:
+                del self._frontends[frontend_id]
+
+    # --- воркеры ---
+
+    async def _serve_worker(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, hello: Dict[str, Any]) -> None:
+        worker = _WorkerState(writer, hello)
+        self._workers.append(worker)
+        for model in worker.models:
+            self._scheduler(model)
+        self._update_capacity()
+        logger.info(f"[TaskBroker] Worker {worker.name} connected (models={worker.models}, slots={worker.credits})")
+        self._dispatch()
+        try:
+            while True:
+                header, _ = await read_frame_async(reader)
+                op = header.get("op")
+                if op == "credit":
+                    worker.credits += int(header.get("n", 1))
+                    self._dispatch()
+                elif op == "result":
+                    message = header["message"]
+                    if is_final(message):
+                        entry = worker.inflight.pop(message.get("id"), None)
+                        if entry is not None:
+                            self._schedulers[entry[0]].task_done()
+                            self._blobs.pop(message.get("id"), None)
+                            self.counters["completed"] += 1
+                    self._send_result(message)
+                elif op == "service":
+                    for model in worker.models:
+                        self._schedulers[model].record_service(header.get("mode", "chat"), float(header["seconds"]))
+                await writer.drain()
+        finally:
+            self._workers.remove(worker)
+            self._update_capacity()
+            self._requeue(worker)
+            self._dispatch()
+
+    def _requeue(self, worker: _WorkerState) -> None:
+        # Воркер пропал с задачами на руках — они возвращаются в очередь и достанутся другому
+        for task_id, (model, task) in worker.inflight.items():
+            scheduler = self._schedulers[model]
+            scheduler.task_done()
+            try:
+                scheduler.put(task)
+                self.counters["requeued"] += 1
+            except QueueFullError as e:
+                self._blobs.pop(task_id, None)
+                self._send_result({"id": task_id, "error": f"Worker lost and the queue is full: {e.reason}"})
+        if worker.inflight:
+            logger.warning(f"[TaskBroker] Worker {worker.name} left, {len(worker.inflight)} task(s) requeued")
+        worker.inflight.clear()
+
+    # --- сервер ---
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "models": {
+                model: {
+                    "queued": scheduler.qsize(),
+                    "workers": sum(1 for w in self._workers if model in w.models),
+                }
+                for model, scheduler in self._schedulers.items()
+            },
+            "workers": len(self._workers),
+            "inflight": sum(len(w.inflight) for w in self._workers),
+            "frontends": len(self._frontends),
+            **self.counters,
+        }
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        _set_nodelay(writer.get_extra_info("socket"))
+        peer = writer.get_extra_info("peername")
+        try:
+            hello, _ = await read_frame_async(reader)
+            role = hello.get("role")
+            if not secrets.compare_digest(str(hello.get("token") or ""), self.token):
+                logger.warning(f"[TaskBroker] Bad token from {peer} (role={role!r}), closing")
+            elif role == "worker":
+                await self._serve_worker(reader, writer, hello)
+            elif role == "frontend":
+                await self._serve_frontend(reader, writer, str(hello.get("id") or peer))
+            else:
+                logger.warning(f"[TaskBroker] Unknown role {role!r} from {peer}, closing")
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError) as e:
+            logger.info(f"[TaskBroker] {peer} disconnected ({type(e).__name__})")
+        finally:
+            writer.close()
+
+    async def start(self) -> None:
+        if not self.token and self.host not in _LOOPBACK_HOSTS:
+            raise ValueError(f"Set VLM_TASK_BROKER_TOKEN to listen on {self.host!r}: the broker has no other auth")
+        self._loop = asyncio.get_running_loop()
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        # port=0 — свободный порт от ОС (тесты, бенчмарки)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info(f"[TaskBroker] Listening on {self.host}:{self.port} ✅")
+
+    async def serve(self) -> None:
+        await self.start()
+        async with self._server:
+            await self._server.serve_forever()
+
+    def start_in_thread(self) -> str:
+        # Брокер в фоновом потоке этого процесса — замена отдельному узлу в тестах и бенчмарках
+        ready = threading.Event()
+
+        def run() -> None:
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            loop.run_until_complete(self.start())
+            ready.set()
+            loop.run_forever()
+
+        threading.Thread(target=run, name="TaskBroker", daemon=True).start()
+        ready.wait()
+        return f"tcp://{'127.0.0.1' if self.host in ('0.0.0.0', '::', '') else self.host}:{self.port}"
+
+
+def run_worker(url: str | None, warmup: bool) -> None:
+    from .inference import InferenceWorker
+
+    remote = RemoteWorkerQueue(url)
+    worker = InferenceWorker(task_queue=remote, result_queue=remote.results)
+    worker.start(warmup=warmup)
+    remote.connect()
+    threading.Event().wait()
+
+
+def main(argv: List[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="Task broker and remote inference workers")
+    sub = parser.add_subparsers(dest="role", required=True)
+    broker = sub.add_parser("broker", help="Run the task broker")
+    broker.add_argument("--host", default="127.0.0.1", help="0.0.0.0 to accept other nodes; needs VLM_TASK_BROKER_TOKEN")
+    broker.add_argument("--port", type=int, default=parse_address(config.TASK_BROKER_URL)[1])
+    broker.add_argument("--max-depth", type=int, default=None, help="Queue limit per model (default VLM_QUEUE_MAX_DEPTH)")
+    worker = sub.add_parser("worker", help="Load the model and serve tasks from the broker")
+    worker.add_argument("--broker", default=None, help="tcp://host:port (default VLM_TASK_BROKER_URL)")
+    worker.add_argument("--no-warmup", action="store_true")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s] [%(levelname)s] %(name)s: %(message)s")
+    if args.role == "broker":
+        asyncio.run(TaskBroker(args.host, args.port, args.max_depth).serve())
+    else:
+        run_worker(args.broker, warmup=not args.no_warmup and config.WARMUP)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,18 @@
 from __future__ import annotations
 
+import asyncio
 import queue
 import time
 from pathlib import Path
-from typing import Any, Dict, List, Tuple, Optional
+from typing import Any, AsyncIterator, Dict, List, Tuple, Optional
 
 import gradio as gr
 
-from .result_broker import ResultBroker
+from .result_broker import ResultBroker, new_task_id
+from .scheduler import PRIORITY_INTERACTIVE, QueueFullError
+from .tiling import TILING_MODES, tiling_mode
+from .tracing import record_request
+from .video import SAMPLING_MODES
 from . import config
 
 Message = Dict[str, Any]
@@ -19,111 +24,334 @@ class GradioUI:
         self,
         task_queue: "queue.Queue[Dict[str, Any]]",
         result_broker: ResultBroker,
+        response_cache=None,
     ) -> None:
         self.task_queue = task_queue
         self.result_broker = result_broker
-        self._task_id_counter = 0
+        self.response_cache = response_cache
 
-    def _next_task_id(self) -> int:
-        self._task_id_counter += 1
-        return self._task_id_counter
+    def _enqueue(self, task: Dict[str, Any]) -> Optional[str] | QueueFullError:
+        # Возвращает готовый ответ из кэша, None (задача в очереди)
+        # или QueueFullError, если сервер перегружен.
+        try:
+            if self.response_cache is None:
+                self.task_queue.put(task)
+                return None
+            image_bytes = Path(task["image_path"]).read_bytes()
+            return self.response_cache.submit(self.task_queue, task, image_bytes)
+        except QueueFullError as e:
+            return e
+
+    async def _cancel(self, task_id: int) -> None:
+        # Брокер — в памяти, снимаем сразу; очередь может быть удалённой (сеть) или с диском — в потоке
+        self.result_broker.discard(task_id)
+        cancel = getattr(self.task_queue, "cancel", None)
+        if cancel is not None:
+            await asyncio.to_thread(cancel, task_id)
+
+    async def _follow(self, task_id: int, cached: Optional[str]) -> AsyncIterator[Dict[str, Any]]:
+        # Сообщения по задаче: {"queue": позиция или None}, пока первый токен не пришёл,
+        # затем дельты и финальный результат; {"timeout": True}, если ответа нет дольше INFERENCE_TIMEOUT.
+        # Ждём в event loop, а не в потоке Gradio: поток на каждого пользователя не нужен
+        if cached is not None:
+            yield {"id": task_id, "result": cached}
+            return
+
+        stream = self.result_broker.register_stream_async(task_id)
+        position = getattr(self.task_queue, "position", None)
+        deadline = time.monotonic() + config.INFERENCE_TIMEOUT
+        streaming = False
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                yield {"id": task_id, "timeout": True}
+                return
+            try:
+                message = await asyncio.wait_for(
+                    stream.get(), timeout=min(remaining, max(0.1, config.UI_PROGRESS_INTERVAL_S))
+                )
+            except asyncio.TimeoutError:
+                if not streaming:
+                    # У удалённой очереди position — запрос к брокеру задач
+                    info = await asyncio.to_thread(position, task_id) if position is not None else None
+                    yield {"id": task_id, "queue": info}
+                continue
+            if "delta" in message:
+                streaming = True
+                yield message
+                continue
+            yield message
+            return
+
+    @staticmethod
+    def _queue_status(info: Optional[Dict[str, Any]]) -> str:
+        # None — задача уже у воркера (или на предобработке)
+        if info is None:
+            return "Processing…"
+        ahead = int(info.get("position", 0))
+        text = f"Waiting in queue: {ahead} ahead" if ahead else "Next in queue"
+        if info.get("model_state") not in (None, "ready"):
+            text += f", loading model {info.get('model')}"
+        if info.get("eta_s", 0) >= 1:
+            text += f", about {info['eta_s']:.0f}s"
+        return text + "…"
+
+    @staticmethod
+    def _outcome(result: Dict[str, Any], cached: Optional[str]) -> str:
+        if "error" in result:
+            return "error"
+        return "cached" if cached is not None else "ok"
+
+    @staticmethod
+    def _busy_message(error: QueueFullError) -> str:
+        return f"Server is busy ({error.reason}) Please try again in {error.retry_after_header}s."
+
+    async def _submit(self, task: Dict[str, Any]) -> Optional[str] | QueueFullError:
+        # Чтение файла и put в удалённую очередь — блокирующие, уводим их из event loop
+        return await asyncio.to_thread(self._enqueue, task)
 
-    def chat_infer(
+    async def chat_infer(
         self,
         image_path: Optional[str],
         history: Optional[History],
         user_message: str,
+        model: Optional[str] = None,
     ) -> Tuple[History, str, Optional[str]]:
+        # Без промежуточных обновлений: только итог chat_infer_stream
+        update: Tuple[History, str, Optional[str]] = (history or [], "", None)
+        async for update in self.chat_infer_stream(image_path, history, user_message, model, stream=False):
+            pass
+        return update
+
+    async def chat_infer_stream(
+        self,
+        image_path: Optional[str],
+        history: Optional[History],
+        user_message: str,
+        model: Optional[str] = None,
+        stream: bool = True,
+    ) -> AsyncIterator[Tuple[History, str, Optional[str]]]:
         if history is None:
             history = []
 
         user_message = (user_message or "").strip()
 
         if not user_message:
-            return history, "", None
+            yield history, "", None
+            return
 
         if not image_path:
             history.append(
                 {"role": "assistant", "content": "Please upload an image first."}
             )
-            return history, "", None
+            yield history, "", None
+            return
 
         history.append({"role": "user", "content": user_message})
         history.append({"role": "assistant", "content": "…"})
+        yield history, "", None
 
-        task_id = self._next_task_id()
-        self.task_queue.put(
+        started = time.perf_counter()
+        task_id = new_task_id()
+        cached = await self._submit(
             {
                 "id": task_id,
                 "image_path": image_path,
                 "prompt": user_message,
                 "mode": "chat",
+                "stream": stream,
+                "model": model,
+                "source": "ui",
+                "priority": PRIORITY_INTERACTIVE,
+                "enqueued_at": time.time(),
             }
         )
-
-        waiter = self.result_broker.register(task_id)
-
+        if isinstance(cached, QueueFullError):
+            record_request("chat", "ui", "rejected", started)
+            history[-1]["content"] = self._busy_message(cached)
+            yield history, "", None
+            return
+
+        # Вкладку закрыли или нажали Stop — Gradio отменяет корутину, и задача снимается с очереди в finally
+        outcome = "cancelled"
+        partial = ""
         try:
-            result = waiter.get(timeout=config.INFERENCE_TIMEOUT)
-        except queue.Empty:
-            history[-1]["content"] = (
-                "Inference timeout exceeded. Please try again."
-            )
-            return history, "", None
-
-        if "error" in result:
-            history[-1]["content"] = f"Error during processing: {result['error']}"
-            answer_text = history[-1]["content"]
-        else:
-            answer = (result.get("result") or "").strip()
-            if not answer:
-                answer = "(model returned an empty answer)"
-            history[-1]["content"] = answer
-            answer_text = answer
-
+            async for message in self._follow(task_id, cached):
+                if "queue" in message:
+                    history[-1]["content"] = self._queue_status(message["queue"])
+                    yield history, "", None
+                    continue
+                if "delta" in message:
+                    partial += message["delta"]
+                    history[-1]["content"] = partial.strip() or "…"
+                    yield history, "", None
+                    continue
+                if message.get("timeout"):
+                    outcome = "timeout"
+                    history[-1]["content"] = (
+                        "Inference timeout exceeded. Please try again."
+                    )
+                    yield history, "", None
+                    return
+
+                outcome = self._outcome(message, cached)
+                if "error" in message:
+                    answer_text = f"Error during processing: {message['error']}"
+                else:
+                    answer_text = (message.get("result") or "").strip()
+                    if not answer_text:
+                        answer_text = "(model returned an empty answer)"
+                history[-1]["content"] = answer_text
+        finally:
+            record_request("chat", "ui", outcome, started)
+            await self._cancel(task_id)
+
+        out_path = self._save_text("chat_results", "chat_result", answer_text)
+
+        yield history, "", str(out_path)
+
+    def _save_text(self, dir_name: str, prefix: str, text: str) -> Path:
         ts = int(time.time())
-        out_dir = Path("chat_results")
+        out_dir = Path(dir_name)
         out_dir.mkdir(parents=True, exist_ok=True)
-        out_path = out_dir / f"chat_result_{ts}.txt"
-        out_path.write_text(answer_text, encoding="utf-8")
-
-        return history, "", str(out_path)
+        out_path = out_dir / f"{prefix}_{ts}.txt"
+        out_path.write_text(text, encoding="utf-8")
+        return out_path
 
-    def ocr_infer(self, image_path: Optional[str]) -> Tuple[str, Optional[str]]:
+    async def ocr_infer(
+        self,
+        image_path: Optional[str],
+        model: Optional[str] = None,
+        tiling: Optional[str] = None,
+    ) -> AsyncIterator[Tuple[str, Optional[str]]]:
         if not image_path:
-            return "Please upload an image with text.", None
+            yield "Please upload an image with text.", None
+            return
 
-        task_id = self._next_task_id()
-        self.task_queue.put(
+        started = time.perf_counter()
+        task_id = new_task_id()
+        cached = await self._submit(
             {
                 "id": task_id,
                 "image_path": image_path,
                 "prompt": "",
                 "mode": "ocr",
+                "tiling": tiling,
+                # Текст по мере распознавания; полосы документа склеиваются только в конце
+                "stream": tiling_mode(tiling) == "off",
+                "model": model,
+                "source": "ui",
+                "priority": PRIORITY_INTERACTIVE,
+                "enqueued_at": time.time(),
             }
         )
+        if isinstance(cached, QueueFullError):
+            record_request("ocr", "ui", "rejected", started)
+            yield self._busy_message(cached), None
+            return
 
-        waiter = self.result_broker.register(task_id)
-
+        outcome = "cancelled"
+        partial = ""
         try:
-            result = waiter.get(timeout=config.INFERENCE_TIMEOUT)
-        except queue.Empty:
-            return "OCR timeout exceeded. Please try again.", None
+            async for message in self._follow(task_id, cached):
+                if "queue" in message:
+                    yield self._queue_status(message["queue"]), None
+                    continue
+                if "delta" in message:
+                    partial += message["delta"]
+                    yield partial, None
+                    continue
+                if message.get("timeout"):
+                    outcome = "timeout"
+                    yield "OCR timeout exceeded. Please try again.", None
+                    return
+                result = message
+                outcome = self._outcome(result, cached)
+        finally:
+            record_request("ocr", "ui", outcome, started)
+            await self._cancel(task_id)
 
         if "error" in result:
-            return f"OCR error: {result['error']}", None
+            yield f"OCR error: {result['error']}", None
+            return
 
         text = (result.get("result") or "").strip()
         if not text:
             text = "(no text could be recognized)"
 
-        ts = int(time.time())
-        out_dir = Path("ocr_results")
-        out_dir.mkdir(parents=True, exist_ok=True)
-        out_path = out_dir / f"ocr_result_{ts}.txt"
-        out_path.write_text(text, encoding="utf-8")
+        out_path = self._save_text("ocr_results", "ocr_result", text)
+
+        yield text, str(out_path)
+
+    async def video_infer(
+        self,
+        video_path: Optional[str],
+        question: str,
+        sampling: Optional[str] = None,
+        model: Optional[str] = None,
+    ) -> AsyncIterator[Tuple[str, Optional[str]]]:
+        if not video_path:
+            yield "Please upload a video first.", None
+            return
+        question = (question or "").strip()
+        if not question:
+            yield "Please ask a question about the video.", None
+            return
+
+        started = time.perf_counter()
+        task_id = new_task_id()
+        cached = await self._submit(
+            {
+                "id": task_id,
+                "image_path": video_path,
+                "prompt": question,
+                "mode": "video",
+                "sampling": sampling,
+                "stream": True,
+                "model": model,
+                "source": "ui",
+                "priority": PRIORITY_INTERACTIVE,
+                "enqueued_at": time.time(),
+            }
+        )
+        if isinstance(cached, QueueFullError):
+            record_request("video", "ui", "rejected", started)
+            yield self._busy_message(cached), None
+            return
+
+        outcome = "cancelled"
+        partial = ""
+        try:
+            async for message in self._follow(task_id, cached):
+                if "queue" in message:
+                    yield self._queue_status(message["queue"]), None
+                    continue
+                if "delta" in message:
+                    partial += message["delta"]
+                    yield partial.strip() or "…", None
+                    continue
+                if message.get("timeout"):
+                    outcome = "timeout"
+                    yield "Inference timeout exceeded. Please try again.", None
+                    return
+                result = message
+                outcome = self._outcome(result, cached)
+        finally:
+            record_request("video", "ui", outcome, started)
+            await self._cancel(task_id)
+
+        if "error" in result:
+            yield f"Error during processing: {result['error']}", None
+            return
+
+        answer = (result.get("result") or "").strip() or "(model returned an empty answer)"
+        out_path = self._save_text("video_results", "video_result", answer)
+        yield answer, str(out_path)
 
-        return text, str(out_path)
+    def concurrency_limit(self) -> int:
+        # Одновременно к модели идёт не больше, чем воркеры разберут за два батча:
+        # остальные ждут в очереди Gradio, не занимая слотов планировщика
+        return config.UI_CONCURRENCY or 2 * config.NUM_WORKERS * config.BATCH_MAX_SIZE
 
     def build(self):
         style_html = """
@@ -185,18 +413,26 @@ class GradioUI:
         with gr.Blocks(title="SmolVLM2 Demo") as demo:
             gr.HTML(style_html)
 
+            models = getattr(self.task_queue, "models", None) or [config.MODEL_SIZE]
             gr.Markdown(
                 f"""
 <div style="text-align: center">
 
 # SmolVLM Chat
 
-**Model:** `{config.MODEL_ID}`  
+**Model:** `{config.MODEL_ID if len(models) == 1 else ", ".join(models)}`  
 **Device mode:** `{config.DEVICE_MODE}` • **Default port:** `{config.PORT}`
 
 </div>
 """
             )
+            # Выбор модели общий для всех вкладок; auto — сервер выбирает сам (по режиму и загрузке)
+            model_choice = gr.Dropdown(
+                choices=["auto", *models],
+                value="auto",
+                label="Model",
+                visible=len(models) > 1,
+            )
 
             with gr.Tab("Vision Chat (VQA / Captioning)"):
                 with gr.Row(equal_height=True, elem_classes=["main-row"]):
@@ -227,28 +463,29 @@ class GradioUI:
                 with gr.Row():
                     with gr.Column():
                         send_btn = gr.Button("Send")
+                        chat_stop = gr.Button("Stop", variant="stop")
                     with gr.Column():
                         chat_file = gr.File(label="Download last answer (.txt)")
 
-                def chat_wrapper(image, history, message):
-                    new_history, cleared, file_path = self.chat_infer(
-                        image, history, message
-                    )
-                    return new_history, cleared, file_path
-
-                send_btn.click(
-                    fn=chat_wrapper,
-                    inputs=[chat_image, chat_history, chat_input],
-                    outputs=[chat_history, chat_input, chat_file],
-                    api_name=False,
-                )
-
-                chat_input.submit(
-                    fn=chat_wrapper,
-                    inputs=[chat_image, chat_history, chat_input],
-                    outputs=[chat_history, chat_input, chat_file],
-                    api_name=False,
-                )
+                async def chat_wrapper(image, history, message, model):
+                    async for update in self.chat_infer_stream(image, history, message, model):
+                        yield update
+
+                chat_events = [
+                    send_btn.click(
+                        fn=chat_wrapper,
+                        inputs=[chat_image, chat_history, chat_input, model_choice],
+                        outputs=[chat_history, chat_input, chat_file],
+                        api_name=False,
+                    ),
+                    chat_input.submit(
+                        fn=chat_wrapper,
+                        inputs=[chat_image, chat_history, chat_input, model_choice],
+                        outputs=[chat_history, chat_input, chat_file],
+                        api_name=False,
+                    ),
+                ]
+                chat_stop.click(fn=None, cancels=chat_events, api_name=False)
 
             with gr.Tab("OCR (Text recognition)"):
                 with gr.Row(equal_height=True, elem_classes=["main-row"]):
@@ -269,20 +506,86 @@ class GradioUI:
                                 lines=18,
                             )
 
+                with gr.Row():
+                    # Для сканов и длинных чеков: страница читается полосами в высоком разрешении
+                    ocr_tiling = gr.Radio(
+                        choices=list(TILING_MODES),
+                        value=config.OCR_TILING,
+                        label="Document mode (tiles)",
+                    )
+
                 with gr.Row():
                     with gr.Column():
                         ocr_button = gr.Button("Run OCR")
+                        ocr_stop = gr.Button("Stop", variant="stop")
                     with gr.Column():
                         ocr_file = gr.File(label="Download result (.txt)")
 
-                def ocr_wrapper(image):
-                    return self.ocr_infer(image)
+                async def ocr_wrapper(image, tiling, model):
+                    async for update in self.ocr_infer(image, model, tiling):
+                        yield update
 
-                ocr_button.click(
+                ocr_event = ocr_button.click(
                     fn=ocr_wrapper,
-                    inputs=[ocr_image],
+                    inputs=[ocr_image, ocr_tiling, model_choice],
                     outputs=[ocr_text, ocr_file],
                     api_name=False,
                 )
+                ocr_stop.click(fn=None, cancels=[ocr_event], api_name=False)
 
+            with gr.Tab("Video QA"):
+                with gr.Row(equal_height=True, elem_classes=["main-row"]):
+                    with gr.Column():
+                        with gr.Group(elem_classes=["card", "card-main"]):
+                            gr.Markdown("### Video clip")
+                            video_input = gr.Video(
+                                label="Upload a short video",
+                                height=460,
+                            )
+
+                    with gr.Column():
+                        with gr.Group(elem_classes=["card", "card-main"]):
+                            gr.Markdown("### Answer")
+                            video_answer = gr.Textbox(
+                                label="",
+                                lines=18,
+                            )
+
+                with gr.Row():
+                    video_question = gr.Textbox(
+                        label="Your question about the video",
+                        placeholder="What happens in this video?",
+                        lines=2,
+                    )
+                    video_sampling = gr.Radio(
+                        choices=list(SAMPLING_MODES),
+                        value=config.VIDEO_SAMPLING,
+                        label="Frame sampling",
+                    )
+
+                with gr.Row():
+                    with gr.Column():
+                        video_button = gr.Button("Ask")
+                        video_stop = gr.Button("Stop", variant="stop")
+                    with gr.Column():
+                        video_file = gr.File(label="Download answer (.txt)")
+
+                async def video_wrapper(video, question, sampling, model):
+                    async for update in self.video_infer(video, question, sampling, model):
+                        yield update
+
+                video_event = video_button.click(
+                    fn=video_wrapper,
+                    inputs=[video_input, video_question, video_sampling, model_choice],
+                    outputs=[video_answer, video_file],
+                    api_name=False,
+                )
+                video_stop.click(fn=None, cancels=[video_event], api_name=False)
+
+        # Обработчики асинхронные и потоков не держат; лимит — сколько запросов UI одновременно
+        # стоит в очереди планировщика, остальные ждут в очереди Gradio (она сама показывает позицию)
+        demo.queue(
+            default_concurrency_limit=self.concurrency_limit(),
+            max_size=config.UI_QUEUE_SIZE or None,
+        )
         return demo
@@ -0,0 +1,259 @@
+import io
+import logging
+import time
+from datetime import timedelta
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+import torch
+from PIL import Image
+
+from . import config
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+SAMPLING_MODES = ("uniform", "fps", "scene")
+
+# Те же строки, что строит SmolVLMProcessor для видео: на них модель и обучалась
+VIDEO_INTRO = "You are provided the following series of {frame_count} frames from a {video_duration} [H:MM:SS] video.\n"
+FRAME_TIMESTAMP = "\nFrame from {timestamp}:"
+MEDIA_OUTTRO = "\n\n"
+
+# Сторона миниатюры для сравнения кадров (смена сцены, дубликаты)
+_THUMB_SIDE = 32
+
+
+class VideoError(ValueError):
+    pass
+
+
+class SampledFrame:
+    __slots__ = ("image", "timestamp", "thumb")
+
+    def __init__(self, image: Image.Image, timestamp: float, thumb: np.ndarray) -> None:
+        self.image = image
+        self.timestamp = timestamp
+        self.thumb = thumb
+
+
+class PreparedVideo:
+    __slots__ = ("pixel_values", "pixel_attention_mask", "timestamps", "duration", "stats")
+
+    def __init__(
+        self,
+        pixel_values: torch.Tensor,
+        pixel_attention_mask: torch.Tensor | None,
+        timestamps: List[float],
+        duration: float,
+        stats: Dict[str, int],
+    ) -> None:
+        # pixel_values: (1, num_frames, 3, H, W) — по одной квадратной картинке на кадр, без нарезки
+        self.pixel_values = pixel_values
+        self.pixel_attention_mask = pixel_attention_mask
+        self.timestamps = timestamps
+        self.duration = duration
+        self.stats = stats
+
+    @property
+    def num_frames(self) -> int:
+        return len(self.timestamps)
+
+
+def _thumb(image: Image.Image) -> np.ndarray:
+    small = image.convert("L").resize((_THUMB_SIDE, _THUMB_SIDE), Image.BILINEAR)
+    return np.asarray(small, dtype=np.float32) / 255.0
+
+
+def frame_distance(a: np.ndarray, b: np.ndarray) -> float:
+    return float(np.abs(a - b).mean())
+
+
+def _open_container(source: bytes | str):
+    try:
+        import av
+    except ImportError as e:
+        raise RuntimeError("Video support requires PyAV (pip install av)") from e
+    try:
+        return av.open(io.BytesIO(source) if isinstance(source, (bytes, bytearray)) else str(source))
+    except Exception as e:
+        raise VideoError(f"Can't open video: {e}") from e
+
+
+def _duration(container: Any, stream: Any) -> float | None:
+    if stream.duration is not None and stream.time_base is not None:
+        return float(stream.duration * stream.time_base)
+    if container.duration is not None:
+        return container.duration / 1_000_000
+    return None
+
+
+def frame_side(image_processor: Any) -> int | None:
+    # Кадр всё равно приводится к квадрату max_image_size, крупнее декодировать незачем
+    size = getattr(image_processor, "max_image_size", None) or {}
+    edge = size.get("longest_edge") if isinstance(size, dict) else None
+    return int(edge) if edge else None
+
+
+def _thin(frames: List[SampledFrame]) -> List[SampledFrame]:
+    # Кадров стало больше лимита: оставляем каждый второй, память не растёт с длиной ролика
+    return frames[::2]
+
+
+def sample_frames(
+    source: bytes | str,
+    mode: str = "fps",
+    max_frames: int = 32,
+    fps: float = 1.0,
+    max_side: int | None = None,
+    scene_threshold: float = 0.12,
+    dedupe_threshold: float = 0.02,
+    max_duration: float = 0.0,
+) -> Tuple[List[SampledFrame], float, Dict[str, int]]:
+    # Кадры декодируются по одному и сразу отбрасываются, если не нужны;
+    # в памяти держится не больше 2 * max_frames уменьшенных кадров.
+    if mode not in SAMPLING_MODES:
+        raise VideoError(f"Unknown sampling mode {mode!r}. Use one of: {', '.join(SAMPLING_MODES)}")
+    max_frames = max(1, max_frames)
+
+    container = _open_container(source)
+    try:
+        if not container.streams.video:
+            raise VideoError("The file has no video stream.")
+        stream = container.streams.video[0]
+        stream.thread_type = "AUTO"
+        duration = _duration(container, stream)
+        if max_duration > 0 and duration is not None and duration > max_duration:
+            raise VideoError(f"Video is {duration:.0f}s long, the limit is {max_duration:.0f}s.")
+        if mode == "uniform" and not duration:
+            # Без длительности равномерную сетку не построить
+            mode = "fps"
+
+        if mode == "uniform":
+            step = duration / max_frames
+            next_at = step / 2
+        else:
+            step = 1.0 / fps if fps > 0 else 0.0
+            next_at = 0.0
+
+        frames: List[SampledFrame] = []
+        decoded = 0
+        last_ts = 0.0
+        for frame in container.decode(stream):
+            decoded += 1
+            if frame.time is None:
+                continue
+            ts = float(frame.time)
+            last_ts = ts
+            if max_duration > 0 and ts > max_duration:
+                raise VideoError(f"Video is longer than the {max_duration:.0f}s limit.")
+            if ts + 1e-6 < next_at:
+                continue
+
+            width, height = frame.width, frame.height
+            if max_side and max(width, height) > max_side:
+                # Уменьшаем в swscale, до перевода в PIL
+                scale = max_side / max(width, height)
+                width, height = max(1, round(width * scale)), max(1, round(height * scale))
+            image = frame.to_image(width=width, height=height)
+            thumb = _thumb(image)
+
+            if mode == "scene" and frames and frame_distance(thumb, frames[-1].thumb) < scene_threshold:
+                continue
+            frames.append(SampledFrame(image, ts, thumb))
+            next_at = ts + step
+
+            if mode == "uniform" and len(frames) >= max_frames:
+                break
+            if len(frames) >= 2 * max_frames:
+                frames = _thin(frames)
+                step *= 2
+    finally:
+        container.close()
+
+    if not frames:
+        raise VideoError("No frames could be decoded from the video.")
+
+    sampled = len(frames)
+    frames = dedupe_frames(frames, dedupe_threshold)
+    if len(frames) > max_frames:
+        keep = np.linspace(0, len(frames) - 1, max_frames).round().astype(int)
+        frames = [frames[i] for i in sorted(set(keep.tolist()))]
+    stats = {"decoded": decoded, "sampled": sampled, "kept": len(frames)}
+    return frames, duration or last_ts, stats
+
+
+def dedupe_frames(frames: List[SampledFrame], threshold: float) -> List[SampledFrame]:
+    if threshold <= 0:
+        return frames
+    kept = [frames[0]]
+    for frame in frames[1:]:
+        if frame_distance(frame.thumb, kept[-1].thumb) >= threshold:
+            kept.append(frame)
+    return kept
+
+
+def prepare_video(
+    worker: Any,
+    source: bytes | str,
+    mode: str | None = None,
+    max_frames: int | None = None,
+) -> PreparedVideo:
+    # Всё, что не требует модели: декодирование, выбор кадров и подготовка пикселей
+    started = time.perf_counter()
+    image_processor = worker.processor.image_processor
+    limit = config.VIDEO_MAX_FRAMES
+    frames, duration, stats = sample_frames(
+        source,
+        mode=mode or config.VIDEO_SAMPLING,
+        max_frames=min(max_frames, limit) if max_frames else limit,
+        fps=config.VIDEO_FPS,
+        max_side=config.VIDEO_MAX_SIDE or frame_side(image_processor),
+        scene_threshold=config.VIDEO_SCENE_THRESHOLD,
+        dedupe_threshold=config.VIDEO_DEDUPE_THRESHOLD,
+        max_duration=config.VIDEO_MAX_DURATION,
+    )
+    metrics.VIDEO_SAMPLE_SECONDS.observe(time.perf_counter() - started)
+    metrics.VIDEO_FRAMES.observe(len(frames))
+
+    # Кадры видео, как и в SmolVLMVideoProcessor, не нарезаются на тайлы
+    image_inputs = image_processor(
+        [[frame.image for frame in frames]],
+        do_image_splitting=False,
+        return_tensors="pt",
+    )
+    logger.info(
+        f"[Video] {stats['kept']} frame(s) from {duration:.1f}s clip "
+        f"(decoded {stats['decoded']}, sampled {stats['sampled']}, sampling={mode or config.VIDEO_SAMPLING})"
+    )
+    return PreparedVideo(
+        pixel_values=image_inputs["pixel_values"],
+        pixel_attention_mask=image_inputs.get("pixel_attention_mask"),
+        timestamps=[frame.timestamp for frame in frames],
+        duration=duration,
+        stats=stats,
+    )
+
+
+def video_prompt(worker: Any, video: PreparedVideo) -> str:
+    from num2words import num2words
+    from transformers.models.smolvlm.processing_smolvlm import get_image_prompt_string
+
+    processor = worker.processor
+    # rows = cols = 0 — одиночная картинка без тайлов
+    frame_block = get_image_prompt_string(
+        0,
+        0,
+        processor.image_seq_len,
+        fake_token_around_image=processor.fake_image_token,
+        image_token=processor.image_token,
+        global_image_token=processor.global_image_token,
+    )
+    text = VIDEO_INTRO.format(
+        frame_count=num2words(video.num_frames),
+        video_duration=str(timedelta(seconds=int(video.duration))),
+    )
+    for ts in video.timestamps:
+        text += FRAME_TIMESTAMP.format(timestamp=f"{int(ts // 60):02d}:{int(ts % 60):02d}") + frame_block
+    return text + MEDIA_OUTTRO
+
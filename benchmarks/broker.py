@@ -0,0 +1,209 @@
+import argparse
+import asyncio
+import os
+import threading
+import time
+from typing import Any, Dict, List
+
+from .common import summarize, write_results
+
+
+def _publish(broker: Any, count: int, deltas: int, sent: Dict[int, float], rate: float) -> None:
+    # Как воркер: сначала промежуточные токены, затем финальное сообщение.
+    # rate > 0 — задач в секунду, 0 — как можно быстрее.
+    interval = 1.0 / rate if rate > 0 else 0.0
+    started = time.perf_counter()
+    for task_id in range(count):
+        if interval:
+            delay = started + task_id * interval - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        for _ in range(deltas):
+            broker.incoming.put({"id": task_id, "delta": "x"})
+        sent[task_id] = time.perf_counter()
+        broker.incoming.put({"id": task_id, "result": "ok", "sent_at": time.time()})
+
+
+def run_async(waiters: int, deltas: int, rate: float, late: bool, shards: int | None) -> Dict[str, Any]:
+    from app.result_broker import ResultBroker
+
+    broker = ResultBroker(shards=shards)
+    sent: Dict[int, float] = {}
+    latencies: List[float] = []
+
+    async def wait_final(future: "asyncio.Future[Dict[str, Any]]", task_id: int) -> None:
+        await future
+        latencies.append(time.perf_counter() - sent[task_id])
+
+    async def wait_stream(stream: "asyncio.Queue[Dict[str, Any]]", task_id: int) -> None:
+        while "delta" in await stream.get():
+            pass
+        latencies.append(time.perf_counter() - sent[task_id])
+
+    async def main() -> float:
+        def register(task_id: int):
+            if deltas:
+                return wait_stream(broker.register_stream_async(task_id), task_id)
+            return wait_final(broker.register_async(task_id), task_id)
+
+        started = time.perf_counter()
+        if late:
+            # Результаты приходят раньше, чем ожидающие успели зарегистрироваться
+            _publish(broker, waiters, deltas, sent, rate)
+            await asyncio.to_thread(broker.incoming.join)
+            coros = [register(i) for i in range(waiters)]
+        else:
+            coros = [register(i) for i in range(waiters)]
+            producer = threading.Thread(target=_publish, args=(broker, waiters, deltas, sent, rate), daemon=True)
+            producer.start()
+        await asyncio.gather(*coros)
+        return time.perf_counter() - started
+
+    wall = asyncio.run(main())
+    return _report("async", waiters, deltas, rate, late, wall, latencies)
+
+
+def run_threads(waiters: int, deltas: int, rate: float, late: bool, shards: int | None) -> Dict[str, Any]:
+    from app.result_broker import ResultBroker
+
+    broker = ResultBroker(shards=shards)
+    sent: Dict[int, float] = {}
+    latencies: List[float] = []
+    lock = threading.Lock()
+
+    def wait(task_id: int) -> None:
+        if deltas:
+            q = broker.register_stream(task_id)
+            while "delta" in q.get():
+                pass
+        else:
+            broker.register(task_id).get()
+        with lock:
+            latencies.append(time.perf_counter() - sent[task_id])
+
+    started = time.perf_counter()
+    if late:
+        _publish(broker, waiters, deltas, sent, rate)
+        broker.incoming.join()
+    threads = [threading.Thread(target=wait, args=(i,), daemon=True) for i in range(waiters)]
+    for thread in threads:
+        thread.start()
+    if not late:
+        _publish(broker, waiters, deltas, sent, rate)
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - started
+    return _report("threads", waiters, deltas, rate, late, wall, latencies)
+
+
+def _report(kind: str, waiters: int, deltas: int, rate: float, late: bool, wall: float, latencies: List[float]) -> Dict[str, Any]:
+    messages = waiters * (deltas + 1)
+    return {
+        "waiters": kind,
+        "count": waiters,
+        "deltas_per_task": deltas,
+        "rate": rate or None,
+        "late_register": late,
+        "wall_s": wall,
+        "tasks_per_s": waiters / wall if wall else None,
+        "messages_per_s": messages / wall if wall else None,
+        "delivery_s": summarize(latencies),
+    }
+
+
+def rss_mb() -> float | None:
+    # Текущий (не пиковый) RSS процесса; только Linux
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+
+
+def run_stress(cycles: int, ttl: float, batch: int, samples: int, shards: int | None) -> Dict[str, Any]:
+    # Долгая работа в миниатюре: на каждые 10 задач 6 обычных, 1 с поздней регистрацией,
+    # 1 отменённая до результата, 1 результат без ожидающего и 1 ожидающий без результата.
+    # Последние две вида утекали бы без TTL; память должна выйти на плато через ~ttl секунд.
+    from app.result_broker import ResultBroker, new_task_id
+
+    broker = ResultBroker(ttl_s=ttl, shards=shards)
+    sample_every = max(batch, cycles // max(1, samples))
+    points: List[Dict[str, Any]] = []
+    started = time.perf_counter()
+    done = 0
+    while done < cycles:
+        ids = [new_task_id() for _ in range(min(batch, cycles - done))]
+        kinds = [i % 10 for i in range(done, done + len(ids))]
+        waiters = {}
+        for task_id, kind in zip(ids, kinds):
+            if kind <= 5 or kind in (7, 9):
+                waiters[task_id] = broker.register(task_id)
+        for task_id, kind in zip(ids, kinds):
+            if kind == 7:
+                broker.discard(task_id)
+        for task_id, kind in zip(ids, kinds):
+            if kind <= 8:
+                broker.incoming.put({"id": task_id, "result": "ok"})
+        broker.incoming.join()
+        for task_id, kind in zip(ids, kinds):
+            if kind == 6:
+                broker.register(task_id).get(timeout=5)
+            elif kind <= 5:
+                waiters[task_id].get(timeout=5)
+        done += len(ids)
+
+        if done % sample_every < len(ids) or done == cycles:
+            points.append({"cycles": done, "elapsed_s": time.perf_counter() - started, "rss_mb": rss_mb(), **broker.stats()})
+    wall = time.perf_counter() - started
+
+    # Рост считается после прогрева в 2 × ttl: к этому моменту TTL уже начал вычищать записи
+    steady = [p for p in points if p["elapsed_s"] >= 2 * ttl] or points[-1:]
+    rss = [p["rss_mb"] for p in steady if p["rss_mb"] is not None]
+    return {
+        "waiters": "stress",
+        "cycles": cycles,
+        "ttl_s": ttl,
+        "shards": len(broker._shards),
+        "wall_s": wall,
+        "cycles_per_s": cycles / wall if wall else None,
+        "max_entries": max(p["waiters"] + p["pending"] + p["tombstones"] for p in points),
+        "steady_rss_growth_mb": rss[-1] - rss[0] if len(rss) > 1 else None,
+        "samples": points,
+    }
+
+
+def main(argv: List[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="ResultBroker throughput and delivery latency under many waiters")
+    parser.add_argument("--waiters", default="100,1000,10000", help="Comma separated numbers of concurrent waiters")
+    parser.add_argument("--kinds", default="async,threads", help="async (event loop futures) and/or threads")
+    parser.add_argument("--deltas", type=int, default=0, help="Streamed tokens per task before the final result")
+    parser.add_argument("--rate", type=float, default=0.0, help="Results per second (0 = as fast as possible)")
+    parser.add_argument("--late", action="store_true", help="Publish results before the waiters register")
+    parser.add_argument("--max-threads", type=int, default=2000, help="Skip thread runs above this many waiters")
+    parser.add_argument("--shards", type=int, default=None, help="Broker lock shards (default VLM_BROKER_SHARDS)")
+    parser.add_argument("--stress", type=int, default=0, help="Run N register/deliver cycles with orphans and report memory")
+    parser.add_argument("--ttl", type=float, default=2.0, help="Broker TTL for --stress, seconds")
+    parser.add_argument("--samples", type=int, default=20, help="Memory samples taken during --stress")
+    parser.add_argument("--output", default=None, help="Where to write the JSON results")
+    args = parser.parse_args(argv)
+
+    if args.stress:
+        write_results(args.output, "broker", {"runs": [run_stress(args.stress, args.ttl, 1000, args.samples, args.shards)]})
+        return
+
+    runs = []
+    for count in (int(x) for x in args.waiters.split(",")):
+        for kind in (k.strip() for k in args.kinds.split(",")):
+            if kind == "threads":
+                if count > args.max_threads:
+                    continue
+                runs.append(run_threads(count, args.deltas, args.rate, args.late, args.shards))
+            else:
+                runs.append(run_async(count, args.deltas, args.rate, args.late, args.shards))
+
+    write_results(args.output, "broker", {"runs": runs})
+
+
+if __name__ == "__main__":
+    main()
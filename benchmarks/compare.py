@@ -0,0 +1,72 @@
+import argparse
+import json
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Tuple
+
+# Какие листья сравнивать и в какую сторону лучше
+LOWER_IS_BETTER = ("mean", "p50", "p95", "p99")
+HIGHER_IS_BETTER = ("throughput_rps", "tasks_per_s", "messages_per_s", "decode_tokens_per_s", "images_per_s")
+
+
+def _flatten(node: Any, prefix: str = "") -> Iterator[Tuple[str, Any]]:
+    if isinstance(node, dict):
+        for key, value in node.items():
+            yield from _flatten(value, f"{prefix}.{key}" if prefix else key)
+    elif isinstance(node, list):
+        for idx, value in enumerate(node):
+            yield from _flatten(value, f"{prefix}[{idx}]")
+    else:
+        yield prefix, node
+
+
+def compare(base: Dict[str, Any], new: Dict[str, Any], threshold: float) -> List[Dict[str, Any]]:
+    base_values = dict(_flatten(base.get("results", {})))
+    rows = []
+    for key, value in _flatten(new.get("results", {})):
+        leaf = key.rsplit(".", 1)[-1]
+        old = base_values.get(key)
+        if leaf not in LOWER_IS_BETTER + HIGHER_IS_BETTER:
+            continue
+        if not isinstance(value, (int, float)) or not isinstance(old, (int, float)) or not old:
+            continue
+        change = (value - old) / old
+        better = change < 0 if leaf in LOWER_IS_BETTER else change > 0
+        rows.append(
+            {
+                "metric": key,
+                "base": old,
+                "new": value,
+                "change": change,
+                "verdict": "same" if abs(change) < threshold else ("better" if better else "worse"),
+            }
+        )
+    return rows
+
+
+def main(argv: List[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="Compare two benchmark result files")
+    parser.add_argument("base", help="Earlier JSON result")
+    parser.add_argument("new", help="Later JSON result of the same benchmark")
+    parser.add_argument("--threshold", type=float, default=0.05, help="Relative change treated as noise")
+    parser.add_argument("--all", action="store_true", help="Also print metrics within the threshold")
+    args = parser.parse_args(argv)
+
+    base = json.loads(Path(args.base).read_text(encoding="utf-8"))
+    new = json.loads(Path(args.new).read_text(encoding="utf-8"))
+    if base.get("benchmark") != new.get("benchmark"):
+        parser.error(f"different benchmarks: {base.get('benchmark')!r} vs {new.get('benchmark')!r}")
+
+    rows = compare(base, new, args.threshold)
+    print(f"{base.get('benchmark')}: {base.get('revision')} -> {new.get('revision')}")
+    for row in rows:
+        if row["verdict"] == "same" and not args.all:
+            continue
+        print(f"{row['verdict']:>6}  {row['change']:+7.1%}  {row['metric']}  {row['base']:.6g} -> {row['new']:.6g}")
+    worse = sum(row["verdict"] == "worse" for row in rows)
+    print(json.dumps({"compared": len(rows), "worse": worse, "better": sum(r["verdict"] == "better" for r in rows)}))
+    if worse:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+import argparse
+import json
+import os
+import queue
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Dict, List
+
+from .common import SAMPLE_IMAGES, summarize, write_results
+from .quantization import CASES, compare
+
+
+def run_engine(engine: str, images: List[str], repeats: int, max_new_tokens: int) -> Dict[str, Any]:
+    from app import config
+    from app.image_cache import ImageFeatureCache
+    from app.inference import InferenceWorker
+    from app.prefix_cache import PrefixCache
+
+    config.MAX_NEW_TOKENS = config.OCR_MAX_NEW_TOKENS = max_new_tokens
+    config.GENERATION_TEMPERATURE = 0.0
+
+    # Без кэшей признаков и префиксов: каждый запрос проходит и vision encoder, и prefill
+    started = time.perf_counter()
+    worker = InferenceWorker(
+        task_queue=queue.Queue(),
+        result_queue=queue.Queue(),
+        image_cache=ImageFeatureCache(0),
+        prefix_cache=PrefixCache(0),
+        engine=engine,
+    )
+    load_s = time.perf_counter() - started
+    started = time.perf_counter()
+    worker.engine.warmup()
+    compile_s = time.perf_counter() - started
+
+    outputs: Dict[str, str] = {}
+    first: Dict[str, float] = {}
+    latencies: Dict[str, List[float]] = {mode: [] for mode, _ in CASES}
+    for image_path in images:
+        for task_mode, prompt in CASES:
+            # Первый запрос формы — с компиляцией декодера под неё, отдельно от установившегося режима
+            start = time.perf_counter()
+            text = worker.analyze_image(image_path, prompt, mode=task_mode)
+            first.setdefault(task_mode, time.perf_counter() - start)
+            for _ in range(repeats):
+                start = time.perf_counter()
+                worker.analyze_image(image_path, prompt, mode=task_mode)
+                latencies[task_mode].append(time.perf_counter() - start)
+            outputs[f"{task_mode}:{image_path}"] = text
+
+    return {
+        "engine": engine,
+        "load_s": load_s,
+        "compile_s": compile_s,
+        "first_request_s": first,
+        "latency_s": summarize([v for samples in latencies.values() for v in samples]),
+        "latency_by_mode_s": {mode: summarize(samples) for mode, samples in latencies.items()},
+        "details": worker.engine.describe(),
+        "outputs": outputs,
+    }
+
+
+def main(argv: List[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="Eager vs torch.compile engine: compile time, first and steady latency")
+    parser.add_argument(
+        "--engines", default="eager,compiled", help="compiled+static = compiled with VLM_COMPILE_STATIC_CACHE=1"
+    )
+    parser.add_argument("--images", nargs="*", default=[str(p) for p in SAMPLE_IMAGES])
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--max-new-tokens", type=int, default=32)
+    parser.add_argument("--cache-dir", default=None, help="Compile cache dir (default: a fresh temp dir, so the first run is cold)")
+    parser.add_argument("--tiny", action="store_true", help="Use a tiny random SmolVLM, works offline")
+    parser.add_argument("--model-dir", default=None, help="Where the tiny model is built / cached")
+    parser.add_argument("--output", default=None, help="Where to write the JSON results")
+    parser.add_argument("--single", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.single:
+        print(json.dumps(run_engine(args.single, args.images, args.repeats, args.max_new_tokens)))
+        return
+
+    env = dict(os.environ)
+    if args.tiny:
+        from .tiny_model import ensure_tiny_model
+
+        env["VLM_MODEL_ID"] = str(ensure_tiny_model(Path(args.model_dir) if args.model_dir else None))
+    tmp = None
+    if args.cache_dir is None:
+        tmp = tempfile.TemporaryDirectory(prefix="vlm-compile-")
+    env["VLM_COMPILE_CACHE_DIR"] = args.cache_dir or tmp.name
+
+    engines = [e.strip() for e in args.engines.split(",") if e.strip()]
+    if "eager" in engines:
+        # eager — эталон качества и скорости
+        engines.remove("eager")
+        engines.insert(0, "eager")
+
+    runs = []
+    try:
+        for engine in engines:
+            name, _, variant = engine.partition("+")
+            run_env = dict(env, VLM_COMPILE_STATIC_CACHE="1" if variant == "static" else "0")
+            # Скомпилированный движок запускаем дважды: с пустым кэшем на диске и с уже заполненным
+            for cache in ("cold", "warm") if name != "eager" else ("-",):
+                cmd = [
+                    sys.executable, "-m", "benchmarks.engine",
+                    "--single", name,
+                    "--repeats", str(args.repeats),
+                    "--max-new-tokens", str(args.max_new_tokens),
+                    "--images", *args.images,
+                ]
+                proc = subprocess.run(cmd, capture_output=True, text=True, env=run_env)
+                if proc.returncode != 0:
+                    runs.append({"engine": engine, "cache": cache, "error": proc.stderr.strip().splitlines()[-1:]})
+                    continue
+                run = json.loads(proc.stdout.strip().splitlines()[-1])
+                run["engine"] = engine
+                run["cache"] = cache
+                runs.append(run)
+    finally:
+        if tmp is not None:
+            tmp.cleanup()
+
+    reference = next((r for r in runs if r.get("engine") == "eager" and "outputs" in r), None)
+    if reference is not None:
+        base = reference["latency_s"]["mean"]
+        for run in runs:
+            if "outputs" not in run:
+                continue
+            run["quality"] = compare(reference["outputs"], run["outputs"])
+            run["speedup"] = base / run["latency_s"]["mean"] if run["latency_s"]["mean"] else None
+
+    write_results(
+        args.output,
+        "engine",
+        {"cpu_count": os.cpu_count(), "tiny": args.tiny, "cache_dir": args.cache_dir, "runs": runs},
+    )
+
+
+if __name__ == "__main__":
+    main()
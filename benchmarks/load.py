@@ -0,0 +1,268 @@
+import argparse
+import asyncio
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, List
+
+from .common import REPO_ROOT, SAMPLE_IMAGES, summarize, write_results
+
+ENDPOINTS = {
+    "convert": "/ptt/convert",
+    "ocr": "/ptt/ocr",
+}
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@contextmanager
+def local_server(model_dir: Path, extra_env: List[str], ready_timeout: float) -> Iterator[str]:
+    # Отдельный процесс uvicorn с крошечной моделью: без сети, UI и кэша ответов,
+    # с Server-Timing, чтобы видеть разбивку по стадиям
+    import httpx
+
+    port = _free_port()
+    env = {
+        **os.environ,
+        "VLM_MODEL_ID": str(model_dir),
+        "VLM_DEVICE": "cpu",
+        "VLM_ENABLE_UI": "0",
+        "VLM_WARMUP": "0",
+        "VLM_RESPONSE_CACHE_SIZE": "0",
+        "VLM_RESPONSE_CACHE_DB": "",
+        "VLM_TIMING_HEADER": "1",
+        "VLM_MAX_NEW_TOKENS": "32",
+        "VLM_OCR_MAX_NEW_TOKENS": "32",
+        "VLM_MODEL_CACHE": str(REPO_ROOT / "bench" / "hf-cache"),
+        "HF_LOCAL_ONLY": "1",
+    }
+    for item in extra_env:
+        key, _, value = item.partition("=")
+        env[key] = value
+
+    cmd = [sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"]
+    proc = subprocess.Popen(cmd, cwd=REPO_ROOT, env=env)
+    url = f"http://127.0.0.1:{port}"
+    try:
+        deadline = time.monotonic() + ready_timeout
+        while True:
+            if proc.poll() is not None:
+                raise RuntimeError(f"Server exited with code {proc.returncode}")
+            try:
+                if httpx.get(f"{url}/ready", timeout=1.0).status_code == 200:
+                    break
+            except httpx.HTTPError:
+                pass
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"Server was not ready after {ready_timeout:.0f}s")
+            time.sleep(0.2)
+        yield url
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+
+def parse_server_timing(header: str) -> Dict[str, float]:
+    # "queue;dur=12.3, prefill;dur=80.1, input-tokens;desc=\"95\"" -> {"queue": 12.3, "prefill": 80.1}
+    stages = {}
+    for part in header.split(","):
+        name, _, params = part.strip().partition(";")
+        if params.startswith("dur="):
+            try:
+                stages[name] = float(params[4:])
+            except ValueError:
+                continue
+    return stages
+
+
+class LoadGenerator:
+    def __init__(
+        self,
+        url: str,
+        endpoints: List[str],
+        images: List[Path],
+        query: str,
+        concurrency: int,
+        rate: float,
+        timeout: float,
+        seed: int,
+    ) -> None:
+        self.url = url.rstrip("/")
+        self.endpoints = endpoints
+        self.images = [(path.name, path.read_bytes()) for path in images]
+        self.query = query
+        self.concurrency = max(1, concurrency)
+        self.rate = rate
+        self.timeout = timeout
+        self.random = random.Random(seed)
+        self.records: List[Dict[str, Any]] = []
+
+    async def _send(self, client: Any, index: int, scheduled: float) -> None:
+        endpoint = self.endpoints[index % len(self.endpoints)]
+        name, raw = self.images[index % len(self.images)]
+        files = {"image": (name, raw, "image/png")}
+        data = {"query": self.query} if endpoint == "convert" else None
+
+        sent = time.perf_counter()
+        record: Dict[str, Any] = {"endpoint": endpoint}
+        try:
+            response = await client.post(ENDPOINTS[endpoint], files=files, data=data)
+            record["status"] = response.status_code
+            record["server_ms"] = parse_server_timing(response.headers.get("server-timing", ""))
+        except Exception as e:
+            record["status"] = type(e).__name__
+        finished = time.perf_counter()
+        # latency считается от запланированного момента: ожидание свободного слота тоже входит,
+        # иначе перегрузка в open-loop прячется (coordinated omission)
+        record["latency_s"] = finished - scheduled
+        record["service_s"] = finished - sent
+        self.records.append(record)
+
+    async def _closed_loop(self, client: Any, requests: int) -> None:
+        counter = iter(range(requests))
+
+        async def user() -> None:
+            for index in counter:
+                await self._send(client, index, time.perf_counter())
+
+        await asyncio.gather(*(user() for _ in range(self.concurrency)))
+
+    async def _open_loop(self, client: Any, requests: int) -> None:
+        # Пуассоновский поток: интервалы экспоненциальные, в полёте не больше concurrency запросов
+        slots = asyncio.Semaphore(self.concurrency)
+        start = time.perf_counter()
+        at = 0.0
+        tasks = []
+
+        async def limited(index: int, scheduled: float) -> None:
+            async with slots:
+                await self._send(client, index, scheduled)
+
+        for index in range(requests):
+            at += self.random.expovariate(self.rate)
+            delay = start + at - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(limited(index, start + at)))
+        await asyncio.gather(*tasks)
+
+    async def run(self, requests: int, warmup: int) -> Dict[str, Any]:
+        import httpx
+
+        limits = httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency)
+        async with httpx.AsyncClient(base_url=self.url, timeout=self.timeout, limits=limits) as client:
+            for index in range(warmup):
+                await self._send(client, index, time.perf_counter())
+            self.records.clear()
+
+            started = time.perf_counter()
+            if self.rate > 0:
+                await self._open_loop(client, requests)
+            else:
+                await self._closed_loop(client, requests)
+            wall = time.perf_counter() - started
+        return self.report(wall)
+
+    def report(self, wall: float) -> Dict[str, Any]:
+        def section(records: List[Dict[str, Any]]) -> Dict[str, Any]:
+            ok = [r for r in records if r["status"] == 200]
+            statuses: Dict[str, int] = {}
+            for r in records:
+                statuses[str(r["status"])] = statuses.get(str(r["status"]), 0) + 1
+            stages: Dict[str, List[float]] = {}
+            for r in ok:
+                for stage, ms in r.get("server_ms", {}).items():
+                    stages.setdefault(stage, []).append(ms / 1000.0)
+            return {
+                "requests": len(records),
+                "ok": len(ok),
+                "errors": len(records) - len(ok),
+                "status": statuses,
+                "throughput_rps": len(ok) / wall if wall else None,
+                "latency_s": summarize([r["latency_s"] for r in ok]),
+                "service_s": summarize([r["service_s"] for r in ok]),
+                "server_stages_s": {stage: summarize(samples) for stage, samples in stages.items()},
+            }
+
+        return {
+            "url": self.url,
+            "concurrency": self.concurrency,
+            "rate": self.rate or None,
+            "arrival": "poisson" if self.rate > 0 else "closed",
+            "wall_s": wall,
+            **section(self.records),
+            "by_endpoint": {
+                endpoint: section([r for r in self.records if r["endpoint"] == endpoint])
+                for endpoint in self.endpoints
+            },
+        }
+
+
+def main(argv: List[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="HTTP load generator for /ptt/convert and /ptt/ocr")
+    parser.add_argument("--url", default=None, help="Running server; without it a local one is started on the tiny model")
+    parser.add_argument("--endpoints", default="convert,ocr", help=f"Comma separated, any of: {', '.join(ENDPOINTS)}")
+    parser.add_argument("--concurrency", default="1,4,16", help="Comma separated max in-flight requests, one run each")
+    parser.add_argument("--rate", type=float, default=0.0, help="Poisson arrivals per second (0 = closed loop)")
+    parser.add_argument("--requests", type=int, default=64, help="Requests per run")
+    parser.add_argument("--warmup", type=int, default=2, help="Requests sent and discarded before each run")
+    parser.add_argument("--query", default="What is shown in this image?")
+    parser.add_argument("--images", nargs="*", default=[str(p) for p in SAMPLE_IMAGES])
+    parser.add_argument("--timeout", type=float, default=300.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--model-dir", default=None, help="Where the tiny model is built / cached")
+    parser.add_argument("--server-env", action="append", default=[], help="KEY=VALUE for the local server, repeatable")
+    parser.add_argument("--ready-timeout", type=float, default=300.0)
+    parser.add_argument("--output", default=None, help="Where to write the JSON results")
+    args = parser.parse_args(argv)
+
+    try:
+        import httpx  # noqa: F401
+    except ImportError as e:
+        raise SystemExit("The load generator requires httpx (pip install httpx)") from e
+
+    endpoints = [e.strip() for e in args.endpoints.split(",")]
+    unknown = [e for e in endpoints if e not in ENDPOINTS]
+    if unknown:
+        parser.error(f"unknown endpoint(s): {', '.join(unknown)}")
+    images = [Path(p) for p in args.images]
+
+    def run_all(url: str) -> List[Dict[str, Any]]:
+        runs = []
+        for concurrency in (int(x) for x in args.concurrency.split(",")):
+            generator = LoadGenerator(url, endpoints, images, args.query, concurrency, args.rate, args.timeout, args.seed)
+            runs.append(asyncio.run(generator.run(args.requests, args.warmup)))
+        return runs
+
+    if args.url:
+        runs = run_all(args.url)
+        model_id = None
+    else:
+        from .tiny_model import ensure_tiny_model
+
+        model_dir = ensure_tiny_model(Path(args.model_dir) if args.model_dir else None)
+        with local_server(model_dir, args.server_env, args.ready_timeout) as url:
+            runs = run_all(url)
+        model_id = str(model_dir)
+
+    write_results(
+        args.output,
+        "load",
+        {"model_id": model_id, "endpoints": endpoints, "requests": args.requests, "server_env": args.server_env, "runs": runs},
+    )
+
+
+if __name__ == "__main__":
+    main()
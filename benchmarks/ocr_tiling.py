@@ -0,0 +1,205 @@
+import argparse
+import io
+import queue
+import random
+import time
+from difflib import SequenceMatcher
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+
+import torch
+
+from .common import summarize, write_results
+
+WORDS = (
+    "invoice total amount due date customer account order number item quantity price tax "
+    "shipping address payment reference balance discount subtotal delivery contract signature "
+    "page section report summary table value period annual monthly service support"
+).split()
+
+# Синтетические страницы: (имя, ширина, высота, кегль); размеры как у скана A4 в 300 dpi и длинного чека
+PAGES = (
+    ("a4", 2480, 3508, 34),
+    ("receipt", 640, 4200, 24),
+)
+
+
+def render_page(width: int, height: int, font_size: int, seed: int) -> Tuple[bytes, str]:
+    # Чёрный текст на белом с полями и абзацами; возвращает PNG и эталонный текст
+    from PIL import Image, ImageDraw, ImageFont
+
+    rng = random.Random(seed)
+    font = ImageFont.load_default(size=font_size)
+    image = Image.new("RGB", (width, height), "white")
+    draw = ImageDraw.Draw(image)
+    margin = width // 12
+    line_height = int(font_size * 1.5)
+    lines = []
+    y = margin
+    while y + line_height < height - margin:
+        if lines and rng.random() < 0.1:
+            # Пустая строка между абзацами — удобное место для разреза
+            y += line_height
+            continue
+        words = []
+        while True:
+            candidate = " ".join(words + [rng.choice(WORDS)])
+            if draw.textlength(candidate, font=font) > width - 2 * margin:
+                break
+            words = candidate.split()
+        if rng.random() < 0.3:
+            words.append(str(rng.randint(1, 99999)))
+            if draw.textlength(" ".join(words), font=font) > width - 2 * margin:
+                words.pop()
+        line = " ".join(words)
+        draw.text((margin, y), line, fill="black", font=font)
+        lines.append(line)
+        y += line_height
+
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue(), "\n".join(lines)
+
+
+def edit_distance(a: str, b: str) -> int:
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, start=1):
+        current = [i]
+        for j, cb in enumerate(b, start=1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        previous = current
+    return previous[-1]
+
+
+def score(text: str, reference: str) -> Dict[str, Any]:
+    hyp = " ".join(text.split())
+    ref = " ".join(reference.split())
+    ref_lines = {" ".join(line.split()).lower() for line in reference.splitlines() if line.strip()}
+    hyp_lines = {" ".join(line.split()).lower() for line in text.splitlines() if line.strip()}
+    return {
+        # CER: правки на символ эталона; может быть больше 1, если модель пишет лишнее
+        "cer": edit_distance(hyp, ref) / max(1, len(ref)),
+        "similarity": SequenceMatcher(None, hyp, ref, autojunk=False).ratio(),
+        "line_recall": len(ref_lines & hyp_lines) / max(1, len(ref_lines)),
+        "chars": len(hyp),
+    }
+
+
+def load_worker(tiny: bool, model_dir: str | None) -> Any:
+    from app.image_cache import ImageFeatureCache
+    from app.inference import InferenceWorker
+    from app.prefix_cache import PrefixCache
+
+    model_id = None
+    if tiny:
+        from .tiny_model import ensure_tiny_model
+
+        model_id = str(ensure_tiny_model(Path(model_dir) if model_dir else None))
+    # Без кэшей: каждый повтор честно кодирует все полосы заново
+    return InferenceWorker(
+        task_queue=queue.Queue(),
+        result_queue=queue.Queue(),
+        model_id=model_id,
+        batch_max_size=1,
+        image_cache=ImageFeatureCache(0),
+        prefix_cache=PrefixCache(0),
+    )
+
+
+def run_case(worker: Any, raw: bytes, reference: str | None, tiling: str, repeats: int) -> Dict[str, Any]:
+    from app.preprocess import prepare_document
+
+    latencies: List[float] = []
+    timing: Dict[str, Any] = {}
+    text = ""
+    for _ in range(repeats):
+        timing = {}
+        started = time.perf_counter()
+        # Предобработка входит в замер: нарезка на полосы — часть цены документного режима
+        prepared = prepare_document(worker, raw, tiling)
+        text = worker.analyze_document(prepared, timing=timing, tiling=tiling)
+        latencies.append(time.perf_counter() - started)
+    run = {
+        "tiling": tiling,
+        "latency_s": summarize(latencies),
+        "tiles": timing.get("tiles", 1),
+        "output_tokens": timing.get("output_tokens"),
+        "stop_reason": timing.get("stop_reason"),
+    }
+    if reference is not None:
+        run.update(score(text, reference))
+    return run
+
+
+def main(argv: List[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="Single-shot vs tiled OCR: accuracy and wall-clock per page")
+    parser.add_argument("--images", nargs="*", default=None, help="Pages to read (default: synthetic A4 page and receipt)")
+    parser.add_argument("--references", nargs="*", default=None, help="Text files with the expected text, one per image")
+    parser.add_argument("--modes", default="off,on", help="Comma separated tiling modes to compare")
+    parser.add_argument("--repeats", type=int, default=2)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--max-new-tokens", type=int, default=1024, help="Budget per page and per strip")
+    parser.add_argument("--tile-batch", type=int, default=None, help="Strips per generate() (default VLM_OCR_TILE_BATCH)")
+    parser.add_argument("--threads", type=int, default=0, help="torch threads (0 = torch default)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--tiny", action="store_true", help="Use a tiny random SmolVLM, works offline")
+    parser.add_argument("--model-dir", default=None, help="Where the tiny model is built / cached")
+    parser.add_argument("--output", default=None, help="Where to write the JSON results")
+    args = parser.parse_args(argv)
+
+    from app import config
+
+    if args.references and len(args.references) != len(args.images or []):
+        parser.error("--references needs exactly one file per --images entry")
+    torch.manual_seed(args.seed)
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    config.MAX_NEW_TOKENS_LIMIT = max(config.MAX_NEW_TOKENS_LIMIT, args.max_new_tokens)
+    config.OCR_MAX_NEW_TOKENS = args.max_new_tokens
+    if args.tile_batch:
+        config.OCR_TILE_BATCH = args.tile_batch
+
+    if args.images:
+        references = [Path(p).read_text(encoding="utf-8") for p in args.references] if args.references else None
+        pages = [
+            (Path(p).name, Path(p).read_bytes(), references[i] if references else None)
+            for i, p in enumerate(args.images)
+        ]
+    else:
+        pages = [
+            (name, *render_page(width, height, font_size, args.seed + i))
+            for i, (name, width, height, font_size) in enumerate(PAGES)
+        ]
+
+    worker = load_worker(args.tiny, args.model_dir)
+    modes = [m.strip() for m in args.modes.split(",")]
+    results = []
+    for name, raw, reference in pages:
+        for _ in range(args.warmup):
+            worker.analyze_document(raw, tiling=modes[-1])
+        runs = [run_case(worker, raw, reference, tiling, args.repeats) for tiling in modes]
+        baseline = runs[0]["latency_s"]["mean"]
+        for run in runs:
+            run["slowdown"] = run["latency_s"]["mean"] / baseline if baseline else None
+        results.append({"page": name, "bytes": len(raw), "runs": runs})
+
+    write_results(
+        args.output,
+        "ocr_tiling",
+        {
+            "model_id": worker.model_id,
+            "tiny": args.tiny,
+            "device": str(worker.device),
+            "dtype": str(worker.dtype),
+            "torch_threads": torch.get_num_threads(),
+            "max_new_tokens": args.max_new_tokens,
+            "tile_batch": config.OCR_TILE_BATCH,
+            "tile_overlap": config.OCR_TILE_OVERLAP,
+            "max_tiles": config.OCR_MAX_TILES,
+            "pages": results,
+        },
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+import argparse
+import queue
+from typing import List
+
+import torch
+
+from app.inference import InferenceWorker
+from app.prefix_cache import PrefixCache
+
+from .common import SAMPLE_IMAGES, summarize, time_call, write_results
+
+
+def bench_prefill(worker: InferenceWorker, image_path: str, prompt: str, mode: str, repeats: int):
+    image = worker._encode_image(image_path)
+    prefix, suffix, prefix_has_image = worker._render_prompt(prompt, mode, image)
+
+    tokenizer = worker.processor.tokenizer
+    prefix_ids = tokenizer(prefix, add_special_tokens=False)["input_ids"]
+    suffix_ids = tokenizer(suffix, add_special_tokens=False)["input_ids"]
+    full_ids = torch.tensor([prefix_ids + suffix_ids], device=worker.device)
+    tail_ids = torch.tensor([suffix_ids], device=worker.device)
+    attention_mask = torch.ones_like(full_ids)
+    cache_position = torch.arange(len(prefix_ids), full_ids.shape[1], device=worker.device)
+
+    entry = worker._prefill_prefix(prefix_ids, image.features if prefix_has_image else None)
+
+    @torch.no_grad()
+    def full_prefill():
+        worker.model(
+            input_ids=full_ids,
+            attention_mask=attention_mask,
+            image_hidden_states=image.features,
+            use_cache=True,
+        )
+
+    @torch.no_grad()
+    def cached_prefill():
+        worker.model(
+            input_ids=tail_ids,
+            attention_mask=attention_mask,
+            image_hidden_states=image.features,
+            past_key_values=PrefixCache.fork(entry),
+            cache_position=cache_position,
+            use_cache=True,
+        )
+
+    full = summarize(time_call(full_prefill, repeats))
+    cached = summarize(time_call(cached_prefill, repeats))
+    return {
+        "image": image_path,
+        "mode": mode,
+        "prefix_tokens": len(prefix_ids),
+        "total_tokens": full_ids.shape[1],
+        "full_prefill_s": full,
+        "cached_prefill_s": cached,
+        "saved_ms": (full["mean"] - cached["mean"]) * 1000.0,
+        "speedup": full["mean"] / cached["mean"] if cached["mean"] else None,
+    }
+
+
+def main(argv: List[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="Prefill latency with and without the prefix KV-cache")
+    parser.add_argument("--images", nargs="*", default=[str(p) for p in SAMPLE_IMAGES])
+    parser.add_argument("--prompt", default="What is shown in this image?")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--output", default=None, help="Where to write the JSON results")
+    args = parser.parse_args(argv)
+
+    worker = InferenceWorker(task_queue=queue.Queue(), result_queue=queue.Queue())
+
+    results = []
+    for image_path in args.images:
+        for mode in ("ocr", "chat"):
+            results.append(bench_prefill(worker, image_path, args.prompt, mode, args.repeats))
+
+    write_results(args.output, "prefix_cache", {"model_id": worker.model_id, "runs": results})
+
+
+if __name__ == "__main__":
+    main()
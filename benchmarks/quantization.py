@@ -0,0 +1,124 @@
+import argparse
+import difflib
+import json
+import queue
+import resource
+import subprocess
+import sys
+import time
+from typing import Any, Dict, List
+
+from .common import SAMPLE_IMAGES, summarize, write_results
+
+CASES = (
+    ("ocr", ""),
+    ("chat", "Describe this image briefly."),
+)
+
+
+def run_mode(mode: str, images: List[str], repeats: int, max_new_tokens: int) -> Dict[str, Any]:
+    from app import config
+    from app.image_cache import ImageFeatureCache
+    from app.inference import InferenceWorker
+    from app.prefix_cache import PrefixCache
+
+    config.MAX_NEW_TOKENS = config.OCR_MAX_NEW_TOKENS = max_new_tokens
+    # Сравниваем качество на детерминированном (greedy) выводе
+    config.GENERATION_TEMPERATURE = 0.0
+
+    started = time.perf_counter()
+    worker = InferenceWorker(
+        task_queue=queue.Queue(),
+        result_queue=queue.Queue(),
+        image_cache=ImageFeatureCache(0),
+        prefix_cache=PrefixCache(0),
+        quant=mode,
+    )
+    load_s = time.perf_counter() - started
+
+    outputs: Dict[str, str] = {}
+    latencies: List[float] = []
+    for image_path in images:
+        for task_mode, prompt in CASES:
+            worker.analyze_image(image_path, prompt, mode=task_mode)
+            for _ in range(repeats):
+                start = time.perf_counter()
+                text = worker.analyze_image(image_path, prompt, mode=task_mode)
+                latencies.append(time.perf_counter() - start)
+            outputs[f"{task_mode}:{image_path}"] = text
+
+    return {
+        "quant": mode,
+        "dtype": str(worker.dtype),
+        "load_s": load_s,
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+        "latency_s": summarize(latencies),
+        "outputs": outputs,
+    }
+
+
+def compare(reference: Dict[str, str], outputs: Dict[str, str]) -> Dict[str, Any]:
+    # Похожесть на ответ fp32-модели: 1.0 — совпадение символ в символ
+    scores = {
+        key: difflib.SequenceMatcher(None, reference[key], outputs.get(key, "")).ratio()
+        for key in reference
+    }
+    ocr = [v for k, v in scores.items() if k.startswith("ocr:")]
+    return {
+        "similarity": scores,
+        "mean_similarity": sum(scores.values()) / len(scores) if scores else None,
+        "ocr_min_similarity": min(ocr) if ocr else None,
+        "exact_matches": sum(1 for v in scores.values() if v == 1.0),
+    }
+
+
+def main(argv: List[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="Quality vs latency of the VLM_QUANT modes")
+    parser.add_argument("--modes", default="none,bf16,int8-dynamic,int8-weight-only")
+    parser.add_argument("--images", nargs="*", default=[str(p) for p in SAMPLE_IMAGES])
+    parser.add_argument("--repeats", type=int, default=2)
+    parser.add_argument("--max-new-tokens", type=int, default=128)
+    parser.add_argument("--output", default=None, help="Where to write the JSON results")
+    parser.add_argument("--single", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.single:
+        # Каждый режим грузит свою копию модели, поэтому — отдельный процесс
+        print(json.dumps(run_mode(args.single, args.images, args.repeats, args.max_new_tokens)))
+        return
+
+    modes = [m.strip() for m in args.modes.split(",") if m.strip()]
+    if "none" in modes:
+        # fp32 служит эталоном качества, его считаем первым
+        modes.remove("none")
+        modes.insert(0, "none")
+
+    runs = []
+    for mode in modes:
+        cmd = [
+            sys.executable, "-m", "benchmarks.quantization",
+            "--single", mode,
+            "--repeats", str(args.repeats),
+            "--max-new-tokens", str(args.max_new_tokens),
+            "--images", *args.images,
+        ]
+        proc = subprocess.run(cmd, capture_output=True, text=True)
+        if proc.returncode != 0:
+            runs.append({"quant": mode, "error": proc.stderr.strip().splitlines()[-1:]})
+            continue
+        runs.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+
+    reference = next((r for r in runs if r.get("quant") == "none" and "outputs" in r), None)
+    if reference is not None:
+        base = reference["latency_s"]["mean"]
+        for run in runs:
+            if "outputs" not in run:
+                continue
+            run["quality"] = compare(reference["outputs"], run["outputs"])
+            run["speedup"] = base / run["latency_s"]["mean"] if run["latency_s"]["mean"] else None
+
+    write_results(args.output, "quantization", {"runs": runs})
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+import argparse
+import queue
+import time
+from pathlib import Path
+from typing import Any, Dict, List
+
+import torch
+
+from .common import SAMPLE_IMAGES, summarize, write_results
+
+CASES = (
+    ("chat", "Describe this image briefly."),
+    ("ocr", ""),
+)
+
+
+def load_worker(tiny: bool, model_dir: str | None, draft_model_id: str | None) -> Any:
+    from app import config
+    from app.image_cache import ImageFeatureCache
+    from app.inference import InferenceWorker
+    from app.prefix_cache import PrefixCache
+
+    # Спекуляция работает только на жадном выводе
+    config.GENERATION_TEMPERATURE = 0.0
+    model_id = None
+    if tiny:
+        from .tiny_model import ensure_tiny_model
+
+        # Крошечная модель служит черновиком самой себе: проверка механики, все токены принимаются
+        model_id = str(ensure_tiny_model(Path(model_dir) if model_dir else None))
+        draft_model_id = draft_model_id or model_id
+    return InferenceWorker(
+        task_queue=queue.Queue(),
+        result_queue=queue.Queue(),
+        model_id=model_id,
+        batch_max_size=1,
+        image_cache=ImageFeatureCache(0),
+        prefix_cache=PrefixCache(0),
+        draft_model_id=draft_model_id or config.DRAFT_MODEL_ID or config.SMOLVLM2_MODELS["256M"],
+    )
+
+
+def run_case(worker: Any, decoder: Any, images: List[str], mode: str, prompt: str, repeats: int) -> Dict[str, Any]:
+    # decoder=None — обычный generate(), иначе спекулятивный цикл
+    worker.speculative = decoder
+    latencies: List[float] = []
+    speeds: List[float] = []
+    proposed = accepted = 0
+    outputs: Dict[str, str] = {}
+    for image_path in images:
+        worker.analyze_image(image_path, prompt, mode=mode)
+        for _ in range(repeats):
+            timing: Dict[str, Any] = {}
+            started = time.perf_counter()
+            text = worker.analyze_batch([(image_path, prompt, mode)], timings=[timing])[0]
+            latencies.append(time.perf_counter() - started)
+            if timing["decode_s"] > 0 and timing["output_tokens"] > 1:
+                speeds.append((timing["output_tokens"] - 1) / timing["decode_s"])
+            proposed += timing.get("draft_tokens", 0)
+            accepted += timing.get("accepted_tokens", 0)
+        outputs[image_path] = text
+
+    return {
+        "latency_s": summarize(latencies),
+        "decode_tokens_per_s": sum(speeds) / len(speeds) if speeds else None,
+        "draft_tokens": proposed,
+        "acceptance": accepted / proposed if proposed else None,
+        "outputs": outputs,
+    }
+
+
+def main(argv: List[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="Greedy decoding with and without a draft model")
+    parser.add_argument("--images", nargs="*", default=[str(p) for p in SAMPLE_IMAGES])
+    parser.add_argument("--modes", default="chat,ocr")
+    parser.add_argument("--num-tokens", default="3,5,8", help="Comma separated draft lengths, one run each")
+    parser.add_argument("--fixed", action="store_true", help="Keep the draft length fixed (no adaptation)")
+    parser.add_argument("--draft-model-id", default=None, help="Draft checkpoint (default: VLM_DRAFT_MODEL_ID or 256M)")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--max-new-tokens", type=int, default=128)
+    parser.add_argument("--threads", type=int, default=0, help="torch threads (0 = torch default)")
+    parser.add_argument("--tiny", action="store_true", help="Use a tiny random SmolVLM as both models, works offline")
+    parser.add_argument("--model-dir", default=None, help="Where the tiny model is built / cached")
+    parser.add_argument("--output", default=None, help="Where to write the JSON results")
+    args = parser.parse_args(argv)
+
+    from app import config
+
+    torch.manual_seed(0)
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    config.MAX_NEW_TOKENS = config.OCR_MAX_NEW_TOKENS = args.max_new_tokens
+    worker = load_worker(args.tiny, args.model_dir, args.draft_model_id)
+    decoder = worker.speculative
+    if decoder is None:
+        raise SystemExit("Draft model could not be used, see the log above")
+    decoder.adaptive = not args.fixed
+
+    runs = []
+    for mode, prompt in (case for case in CASES if case[0] in args.modes.split(",")):
+        baseline = run_case(worker, None, args.images, mode, prompt, args.repeats)
+        for num_tokens in (int(x) for x in args.num_tokens.split(",")):
+            decoder.num_tokens = num_tokens
+            run = run_case(worker, decoder, args.images, mode, prompt, args.repeats)
+            base_mean, mean = baseline["latency_s"]["mean"], run["latency_s"]["mean"]
+            runs.append(
+                {
+                    "mode": mode,
+                    "num_tokens": num_tokens,
+                    "adaptive": decoder.adaptive,
+                    "baseline": {k: v for k, v in baseline.items() if k != "outputs"},
+                    "speculative": {k: v for k, v in run.items() if k != "outputs"},
+                    "speedup": base_mean / mean if mean else None,
+                    # Жадный спекулятивный вывод обязан совпадать с обычным
+                    "identical_outputs": sum(
+                        run["outputs"][key] == text for key, text in baseline["outputs"].items()
+                    ),
+                    "cases": len(baseline["outputs"]),
+                }
+            )
+
+    write_results(
+        args.output,
+        "speculative",
+        {
+            "model_id": worker.model_id,
+            "draft_model_id": worker.draft_model_id,
+            "tiny": args.tiny,
+            "device": str(worker.device),
+            "dtype": str(worker.dtype),
+            "torch_threads": torch.get_num_threads(),
+            "max_new_tokens": args.max_new_tokens,
+            "runs": runs,
+        },
+    )
+
+
+if __name__ == "__main__":
+    main()
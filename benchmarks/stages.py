@@ -0,0 +1,148 @@
+import argparse
+import queue
+import time
+from pathlib import Path
+from typing import Any, Dict, List
+
+import torch
+
+from .common import SAMPLE_IMAGES, summarize, time_call, write_results
+
+
+def load_worker(tiny: bool, model_dir: str | None) -> Any:
+    from app.image_cache import ImageFeatureCache
+    from app.inference import InferenceWorker
+    from app.prefix_cache import PrefixCache
+
+    model_id = None
+    if tiny:
+        from .tiny_model import ensure_tiny_model
+
+        model_id = str(ensure_tiny_model(Path(model_dir) if model_dir else None))
+    # Кэши выключены: каждая итерация проходит стадию целиком
+    return InferenceWorker(
+        task_queue=queue.Queue(),
+        result_queue=queue.Queue(),
+        model_id=model_id,
+        batch_max_size=1,
+        image_cache=ImageFeatureCache(0),
+        prefix_cache=PrefixCache(0),
+    )
+
+
+def bench_stages(worker: Any, image_path: str, prompt: str, mode: str, new_tokens: int, repeats: int) -> Dict[str, Any]:
+    from app.preprocess import decode_image, prepare_image, processor_longest_edge, read_image_bytes
+
+    raw = read_image_bytes(image_path)
+    image_processor = worker.processor.image_processor
+    longest_edge = processor_longest_edge(image_processor)
+    tokenizer = worker.processor.tokenizer
+
+    decode = summarize(time_call(lambda: decode_image(raw, longest_edge), repeats))
+    patches = summarize(time_call(lambda: prepare_image(worker, raw), repeats))
+    prepared = prepare_image(worker, raw)
+    encode = summarize(time_call(lambda: worker._encode_image(prepared), repeats))
+    image = worker._encode_image(prepared)
+
+    def template():
+        prefix, suffix, _ = worker._render_prompt(prompt, mode, image)
+        return tokenizer(prefix + suffix, add_special_tokens=False)["input_ids"]
+
+    templated = summarize(time_call(template, repeats))
+    input_ids = torch.tensor([template()], device=worker.device)
+    attention_mask = torch.ones_like(input_ids)
+
+    @torch.inference_mode()
+    def prefill():
+        return worker.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            image_hidden_states=image.features,
+            use_cache=True,
+        )
+
+    prefilled = summarize(time_call(prefill, repeats))
+
+    @torch.inference_mode()
+    def decode_steps() -> List[float]:
+        # Жадный декод вручную: generate() добавил бы свои накладные расходы и остановку по EOS
+        outputs = prefill()
+        past = outputs.past_key_values
+        next_ids = outputs.logits[:, -1:].argmax(dim=-1)
+        length = input_ids.shape[1]
+        samples = []
+        for _ in range(new_tokens):
+            started = time.perf_counter()
+            outputs = worker.model(
+                input_ids=next_ids,
+                attention_mask=torch.ones((1, length + 1), dtype=attention_mask.dtype, device=worker.device),
+                past_key_values=past,
+                cache_position=torch.tensor([length], device=worker.device),
+                use_cache=True,
+            )
+            past = outputs.past_key_values
+            next_ids = outputs.logits[:, -1:].argmax(dim=-1)
+            length += 1
+            samples.append(time.perf_counter() - started)
+        return samples
+
+    decode_steps()
+    per_token = []
+    for _ in range(repeats):
+        per_token.extend(decode_steps())
+    per_token_summary = summarize(per_token)
+
+    return {
+        "image": image_path,
+        "mode": mode,
+        "tiles": prepared.rows * prepared.cols + 1,
+        "input_tokens": int(input_ids.shape[1]),
+        "image_decode_s": decode,
+        "image_prepare_s": patches,
+        "image_encode_s": encode,
+        "template_s": templated,
+        "prefill_s": prefilled,
+        "decode_token_s": per_token_summary,
+        "decode_tokens_per_s": 1.0 / per_token_summary["mean"] if per_token_summary["mean"] else None,
+    }
+
+
+def main(argv: List[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="Latency of each analyze_image stage")
+    parser.add_argument("--images", nargs="*", default=[str(p) for p in SAMPLE_IMAGES])
+    parser.add_argument("--prompt", default="What is shown in this image?")
+    parser.add_argument("--modes", default="chat,ocr")
+    parser.add_argument("--new-tokens", type=int, default=32, help="Decode steps timed per repeat")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--threads", type=int, default=0, help="torch threads (0 = torch default)")
+    parser.add_argument("--tiny", action="store_true", help="Use a tiny random SmolVLM, works offline")
+    parser.add_argument("--model-dir", default=None, help="Where the tiny model is built / cached")
+    parser.add_argument("--output", default=None, help="Where to write the JSON results")
+    args = parser.parse_args(argv)
+
+    torch.manual_seed(0)
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    worker = load_worker(args.tiny, args.model_dir)
+
+    runs = []
+    for image_path in args.images:
+        for mode in (m.strip() for m in args.modes.split(",")):
+            runs.append(bench_stages(worker, image_path, args.prompt, mode, args.new_tokens, args.repeats))
+
+    write_results(
+        args.output,
+        "stages",
+        {
+            "model_id": worker.model_id,
+            "tiny": args.tiny,
+            "device": str(worker.device),
+            "dtype": str(worker.dtype),
+            "torch_threads": torch.get_num_threads(),
+            "runs": runs,
+        },
+    )
+
+
+if __name__ == "__main__":
+    main()
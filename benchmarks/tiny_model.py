@@ -0,0 +1,181 @@
+import argparse
+import json
+from pathlib import Path
+from typing import List
+
+from .common import REPO_ROOT
+
+DEFAULT_DIR = REPO_ROOT / "bench" / "tiny-smolvlm"
+
+# Токены, которые SmolVLMProcessor и шаблон чата ищут в словаре
+SPECIAL_TOKENS = [
+    "<unk>",
+    "<pad>",
+    "<|im_start|>",
+    "<end_of_utterance>",
+    "<fake_token_around_image>",
+    "<global-img>",
+    "<image>",
+    "<video>",
+] + [f"<row_{r}_col_{c}>" for r in range(1, 7) for c in range(1, 7)]
+
+# Тот же шаблон, что у SmolVLM2: от него зависят префиксы и разбиение промпта
+CHAT_TEMPLATE = (
+    "<|im_start|>{% for message in messages %}{{message['role'] | capitalize}}"
+    "{% if message['content'][0]['type'] == 'image' %}{{':'}}{% else %}{{': '}}{% endif %}"
+    "{% for line in message['content'] %}{% if line['type'] == 'text' %}{{line['text']}}"
+    "{% elif line['type'] == 'image' %}{{ '<image>' }}{% elif line['type'] == 'video' %}{{ '<video>' }}"
+    "{% endif %}{% endfor %}<end_of_utterance>\n{% endfor %}"
+    "{% if add_generation_prompt %}{{ 'Assistant:' }}{% endif %}"
+)
+
+
+def _corpus() -> List[str]:
+    from app import config
+
+    words = (
+        "the a an is are of to in on with what who where when how why this that image picture photo text "
+        "document page line word read extract describe briefly shown cat dog person street sign table chart "
+        "number date name total price receipt invoice video frame scene happens assistant user answer question"
+    ).split()
+    lines = [config.OCR_SYSTEM_PROMPT, "What is shown in this image?", "Describe this image briefly."]
+    lines += [" ".join(words[i:] + words[:i]) for i in range(len(words))]
+    return lines
+
+
+def build_tiny_model(
+    output: Path,
+    vocab_size: int = 2048,
+    hidden_size: int = 64,
+    layers: int = 2,
+    vision_hidden_size: int = 32,
+    vision_layers: int = 2,
+    image_size: int = 64,
+    patch_size: int = 16,
+    seed: int = 0,
+) -> Path:
+    # Случайно инициализированная модель архитектуры SmolVLM: те же процессоры, шаблон
+    # и пути в коде, что у настоящей, но собирается без сети и считается за миллисекунды.
+    import torch
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+    from transformers import (
+        AutoModelForImageTextToText,
+        PreTrainedTokenizerFast,
+        SmolVLMConfig,
+        SmolVLMImageProcessor,
+        SmolVLMProcessor,
+        SmolVLMVideoProcessor,
+    )
+
+    torch.manual_seed(seed)
+
+    backend = Tokenizer(models.BPE(unk_token="<unk>"))
+    backend.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    backend.decoder = decoders.ByteLevel()
+    backend.train_from_iterator(
+        _corpus(),
+        trainers.BpeTrainer(
+            vocab_size=vocab_size,
+            special_tokens=SPECIAL_TOKENS,
+            initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+            show_progress=False,
+        ),
+    )
+    tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=backend,
+        unk_token="<unk>",
+        pad_token="<pad>",
+        bos_token="<|im_start|>",
+        eos_token="<end_of_utterance>",
+        additional_special_tokens=SPECIAL_TOKENS[4:],
+    )
+
+    scale_factor = 2
+    image_seq_len = (image_size // patch_size) ** 2 // scale_factor ** 2
+    image_processor = SmolVLMImageProcessor(
+        size={"longest_edge": image_size * 4},
+        max_image_size={"longest_edge": image_size},
+    )
+    video_processor = SmolVLMVideoProcessor(
+        size={"longest_edge": image_size},
+        max_image_size={"longest_edge": image_size},
+    )
+    processor = SmolVLMProcessor(
+        image_processor=image_processor,
+        tokenizer=tokenizer,
+        video_processor=video_processor,
+        image_seq_len=image_seq_len,
+        chat_template=CHAT_TEMPLATE,
+    )
+
+    model_config = SmolVLMConfig(
+        vision_config={
+            "hidden_size": vision_hidden_size,
+            "intermediate_size": vision_hidden_size * 2,
+            "num_hidden_layers": vision_layers,
+            "num_attention_heads": 2,
+            "image_size": image_size,
+            "patch_size": patch_size,
+        },
+        text_config={
+            "model_type": "llama",
+            "vocab_size": len(tokenizer),
+            "hidden_size": hidden_size,
+            "intermediate_size": hidden_size * 2,
+            "num_hidden_layers": layers,
+            "num_attention_heads": 4,
+            "num_key_value_heads": 2,
+            "max_position_embeddings": 8192,
+            "pad_token_id": tokenizer.pad_token_id,
+            "bos_token_id": tokenizer.bos_token_id,
+            "eos_token_id": tokenizer.eos_token_id,
+        },
+        scale_factor=scale_factor,
+        image_token_id=tokenizer.convert_tokens_to_ids("<image>"),
+        pad_token_id=tokenizer.pad_token_id,
+        tie_word_embeddings=False,
+    )
+    model = AutoModelForImageTextToText.from_config(model_config)
+    model.generation_config.pad_token_id = tokenizer.pad_token_id
+    model.generation_config.bos_token_id = tokenizer.bos_token_id
+    model.generation_config.eos_token_id = tokenizer.eos_token_id
+
+    output.mkdir(parents=True, exist_ok=True)
+    model.save_pretrained(output)
+    processor.save_pretrained(output)
+    return output
+
+
+def ensure_tiny_model(path: Path | None = None) -> Path:
+    # Уже собранная модель переиспользуется: веса детерминированы seed'ом
+    path = Path(path or DEFAULT_DIR)
+    if not (path / "config.json").exists():
+        build_tiny_model(path)
+    return path
+
+
+def main(argv: List[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="Build a tiny random SmolVLM checkpoint for offline benchmarks")
+    parser.add_argument("--output", default=str(DEFAULT_DIR))
+    parser.add_argument("--vocab-size", type=int, default=2048)
+    parser.add_argument("--hidden-size", type=int, default=64)
+    parser.add_argument("--layers", type=int, default=2)
+    parser.add_argument("--vision-hidden-size", type=int, default=32)
+    parser.add_argument("--vision-layers", type=int, default=2)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    path = build_tiny_model(
+        Path(args.output),
+        vocab_size=args.vocab_size,
+        hidden_size=args.hidden_size,
+        layers=args.layers,
+        vision_hidden_size=args.vision_hidden_size,
+        vision_layers=args.vision_layers,
+        seed=args.seed,
+    )
+    print(json.dumps({"model_dir": str(path)}))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+import argparse
+import os
+import queue
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Any, Dict, List
+
+from .common import REPO_ROOT, SAMPLE_IMAGES, summarize, write_results
+
+
+def start_workers(url: str, count: int, env: Dict[str, str]) -> List[subprocess.Popen]:
+    cmd = [sys.executable, "-m", "app.transport", "worker", "--broker", url, "--no-warmup"]
+    return [
+        subprocess.Popen(cmd, cwd=REPO_ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        for _ in range(count)
+    ]
+
+
+def wait_for_workers(broker: Any, count: int, timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    while broker.stats()["workers"] < count:
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"Only {broker.stats()['workers']} of {count} workers connected in {timeout:.0f}s")
+        time.sleep(0.2)
+
+
+def run_config(workers: int, requests: int, images: List[bytes], env: Dict[str, str], connect_timeout: float) -> Dict[str, Any]:
+    from app.result_broker import new_task_id
+    from app.transport import RemoteTaskQueue, TaskBroker
+
+    # Свежий брокер на каждую конфигурацию: очередь и статистика времени обработки с нуля
+    broker = TaskBroker(host="127.0.0.1", port=0, max_depth=requests)
+    url = broker.start_in_thread()
+    procs = start_workers(url, workers, env)
+    try:
+        wait_for_workers(broker, workers, connect_timeout)
+        results: "queue.Queue[Dict[str, Any]]" = queue.Queue()
+        frontend = RemoteTaskQueue(url, result_queue=results)
+        frontend.load("")
+
+        submitted: Dict[int, float] = {}
+        start = time.perf_counter()
+        for i in range(requests):
+            task_id = new_task_id()
+            submitted[task_id] = time.perf_counter()
+            frontend.put(
+                {
+                    "id": task_id,
+                    "image_bytes": images[i % len(images)],
+                    "prompt": "Describe this image briefly.",
+                    "mode": "chat",
+                }
+            )
+
+        latencies = []
+        errors = 0
+        while len(latencies) < requests:
+            message = results.get(timeout=600)
+            if "delta" in message:
+                continue
+            latencies.append(time.perf_counter() - submitted[message["id"]])
+            errors += "error" in message
+        wall = time.perf_counter() - start
+        stats = broker.stats()
+    finally:
+        for proc in procs:
+            proc.terminate()
+        for proc in procs:
+            proc.wait(timeout=30)
+
+    return {
+        "workers": workers,
+        "requests": requests,
+        "errors": errors,
+        "requeued": stats["requeued"],
+        "wall_s": wall,
+        "throughput_rps": requests / wall if wall else None,
+        "latency_s": summarize(latencies),
+    }
+
+
+def main(argv: List[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="Throughput of the TCP task broker with 1..N worker processes")
+    parser.add_argument("--workers", default="1,2,4", help="Comma separated worker process counts")
+    parser.add_argument("--requests", type=int, default=32)
+    parser.add_argument("--max-new-tokens", type=int, default=16)
+    parser.add_argument("--threads", type=int, default=1, help="torch threads per worker process")
+    parser.add_argument("--images", nargs="*", default=[str(p) for p in SAMPLE_IMAGES])
+    parser.add_argument("--connect-timeout", type=float, default=300, help="How long to wait for workers to load the model")
+    parser.add_argument("--tiny", action="store_true", help="Use a tiny random SmolVLM, works offline")
+    parser.add_argument("--model-dir", default=None, help="Where the tiny model is built / cached")
+    parser.add_argument("--output", default=None, help="Where to write the JSON results")
+    args = parser.parse_args(argv)
+
+    # Воркеры — отдельные процессы, как на разных узлах; одно ядро на процесс, без кэшей,
+    # чтобы повторяющиеся картинки не завышали пропускную способность
+    env = {
+        **os.environ,
+        "VLM_NUM_WORKERS": "1",
+        "VLM_THREADS_PER_WORKER": str(args.threads),
+        "VLM_PIN_WORKER_CORES": "0",
+        "VLM_MAX_NEW_TOKENS": str(args.max_new_tokens),
+        "VLM_IMAGE_CACHE_MB": "0",
+        "VLM_PREFIX_CACHE_MB": "0",
+    }
+    if args.tiny:
+        from .tiny_model import ensure_tiny_model
+
+        env["VLM_MODEL_ID"] = str(ensure_tiny_model(Path(args.model_dir) if args.model_dir else None))
+    os.environ.update({k: v for k, v in env.items() if k.startswith("VLM_")})
+
+    images = [Path(p).read_bytes() for p in args.images]
+    runs = [
+        run_config(int(count), args.requests, images, env, args.connect_timeout)
+        for count in args.workers.split(",")
+    ]
+    base = runs[0]["throughput_rps"]
+    for run in runs:
+        run["speedup"] = run["throughput_rps"] / base if base and run["throughput_rps"] else None
+
+    write_results(
+        args.output,
+        "transport",
+        {"cpu_count": os.cpu_count(), "threads_per_worker": args.threads, "tiny": args.tiny, "runs": runs},
+    )
+
+
+if __name__ == "__main__":
+    main()
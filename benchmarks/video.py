@@ -0,0 +1,120 @@
+import argparse
+import io
+import queue
+import time
+from types import SimpleNamespace
+from typing import Any, Dict, List
+
+import numpy as np
+from PIL import Image
+
+from .common import SAMPLE_IMAGES, summarize, write_results
+
+
+def make_clip(seconds: float, fps: int = 24, size: int = 640, scene_every: float = 5.0) -> bytes:
+    # Синтетический ролик: медленная панорама по демо-картинкам со сменой сцены каждые scene_every секунд
+    import av
+
+    sources = [Image.open(p).convert("RGB").resize((size * 2, size)) for p in SAMPLE_IMAGES] or [
+        Image.new("RGB", (size * 2, size), (90, 120, 200))
+    ]
+    buffer = io.BytesIO()
+    container = av.open(buffer, mode="w", format="mp4")
+    stream = container.add_stream("libx264", rate=fps)
+    stream.width, stream.height = size, size
+    stream.pix_fmt = "yuv420p"
+
+    total = int(seconds * fps)
+    for i in range(total):
+        t = i / fps
+        scene = sources[int(t // scene_every) % len(sources)]
+        offset = int((t % scene_every) / scene_every * size)
+        frame = np.asarray(scene.crop((offset, 0, offset + size, size)))
+        for packet in stream.encode(av.VideoFrame.from_ndarray(frame, format="rgb24")):
+            container.mux(packet)
+    for packet in stream.encode():
+        container.mux(packet)
+    container.close()
+    return buffer.getvalue()
+
+
+def bench_sampling(processor: Any, clip: bytes, mode: str, max_frames: int, repeats: int) -> Dict[str, Any]:
+    from app.video import prepare_video
+
+    worker = SimpleNamespace(processor=processor)
+    samples = []
+    video = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        video = prepare_video(worker, clip, mode, max_frames)
+        samples.append(time.perf_counter() - start)
+    return {"prepare_s": summarize(samples), "frames": video.num_frames, **video.stats}
+
+
+def bench_end_to_end(worker: Any, clip: bytes, mode: str, max_frames: int, prompt: str, repeats: int) -> Dict[str, Any]:
+    from app.video import prepare_video
+
+    totals, stages = [], []
+    for _ in range(repeats):
+        timing: Dict[str, Any] = {}
+        start = time.perf_counter()
+        worker.analyze_video(clip, prompt, timing=timing, sampling=mode, max_frames=max_frames)
+        totals.append(time.perf_counter() - start)
+        stages.append(timing)
+    video = prepare_video(worker, clip, mode, max_frames)
+    return {
+        "latency_s": summarize(totals),
+        "image_s": summarize([t["image_s"] for t in stages]),
+        "prefill_s": summarize([t["prefill_s"] for t in stages]),
+        "decode_s": summarize([t["decode_s"] for t in stages]),
+        "input_tokens": stages[-1]["input_tokens"],
+        "frames": video.num_frames,
+        **video.stats,
+    }
+
+
+def main(argv: List[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="Video QA latency against clip length")
+    parser.add_argument("--lengths", default="5,15,30,60", help="Comma separated clip lengths in seconds")
+    parser.add_argument("--modes", default="uniform,fps,scene")
+    parser.add_argument("--max-frames", type=int, default=16)
+    parser.add_argument("--prompt", default="What happens in this video?")
+    parser.add_argument("--max-new-tokens", type=int, default=32)
+    parser.add_argument("--repeats", type=int, default=2)
+    parser.add_argument("--sampling-only", action="store_true", help="Measure decoding and frame sampling without the model")
+    parser.add_argument("--output", default=None, help="Where to write the JSON results")
+    args = parser.parse_args(argv)
+
+    from app import config
+
+    config.MAX_NEW_TOKENS = args.max_new_tokens
+
+    if args.sampling_only:
+        from transformers import AutoProcessor
+
+        processor = AutoProcessor.from_pretrained(config.MODEL_ID)
+        worker = None
+        model_id = config.MODEL_ID
+    else:
+        from app.inference import InferenceWorker
+
+        worker = InferenceWorker(task_queue=queue.Queue(), result_queue=queue.Queue())
+        processor = worker.processor
+        model_id = worker.model_id
+
+    runs = []
+    for length in (float(x) for x in args.lengths.split(",")):
+        clip = make_clip(length)
+        for mode in (m.strip() for m in args.modes.split(",")):
+            run = {"clip_s": length, "clip_mb": len(clip) / (1024 * 1024), "mode": mode}
+            if worker is None:
+                run.update(bench_sampling(processor, clip, mode, args.max_frames, args.repeats))
+            else:
+                run.update(bench_end_to_end(worker, clip, mode, args.max_frames, args.prompt, args.repeats))
+            runs.append(run)
+
+    write_results(args.output, "video", {"model_id": model_id, "max_frames": args.max_frames, "runs": runs})
+
+
+if __name__ == "__main__":
+    main()
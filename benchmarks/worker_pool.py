@@ -0,0 +1,103 @@
+import argparse
+import json
+import queue
+import subprocess
+import sys
+import time
+from typing import Any, Dict, List
+
+from .common import SAMPLE_IMAGES, summarize, write_results
+
+
+def run_config(num_workers: int, threads: int, requests: int, images: List[str], max_new_tokens: int) -> Dict[str, Any]:
+    from app import config
+    from app.image_cache import ImageFeatureCache
+    from app.inference import InferenceWorker
+    from app.prefix_cache import PrefixCache
+
+    config.MAX_NEW_TOKENS = config.OCR_MAX_NEW_TOKENS = max_new_tokens
+
+    task_queue: "queue.Queue[Dict[str, Any]]" = queue.Queue()
+    result_queue: "queue.Queue[Dict[str, Any]]" = queue.Queue()
+    # Кэши выключены, чтобы повторяющиеся картинки не искажали пропускную способность
+    worker = InferenceWorker(
+        task_queue=task_queue,
+        result_queue=result_queue,
+        batch_max_size=1,
+        image_cache=ImageFeatureCache(0),
+        prefix_cache=PrefixCache(0),
+    )
+    worker.start(warmup=False, num_workers=num_workers, threads_per_worker=threads)
+
+    submitted: Dict[int, float] = {}
+    start = time.perf_counter()
+    for i in range(requests):
+        submitted[i] = time.perf_counter()
+        task_queue.put(
+            {
+                "id": i,
+                "image_path": images[i % len(images)],
+                "prompt": "Describe this image briefly.",
+                "mode": "ocr" if i % 2 else "chat",
+                "enqueued_at": time.time(),
+            }
+        )
+
+    latencies = []
+    errors = 0
+    for _ in range(requests):
+        result = result_queue.get()
+        latencies.append(time.perf_counter() - submitted[result["id"]])
+        if "error" in result:
+            errors += 1
+    wall = time.perf_counter() - start
+
+    return {
+        "workers": num_workers,
+        "threads_per_worker": threads,
+        "requests": requests,
+        "errors": errors,
+        "wall_s": wall,
+        "throughput_rps": requests / wall if wall else None,
+        "latency_s": summarize(latencies),
+    }
+
+
+def main(argv: List[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="End-to-end throughput of the inference worker pool")
+    parser.add_argument(
+        "--configs",
+        default="1x32,4x8,8x4",
+        help="Comma separated WORKERSxTHREADS pairs, each one runs in a fresh process",
+    )
+    parser.add_argument("--requests", type=int, default=32)
+    parser.add_argument("--max-new-tokens", type=int, default=32)
+    parser.add_argument("--images", nargs="*", default=[str(p) for p in SAMPLE_IMAGES])
+    parser.add_argument("--output", default=None, help="Where to write the JSON results")
+    parser.add_argument("--single", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.single:
+        # torch.set_num_threads глобален для процесса, поэтому каждая конфигурация — отдельный процесс
+        workers, threads = (int(x) for x in args.single.split("x"))
+        print(json.dumps(run_config(workers, threads, args.requests, args.images, args.max_new_tokens)))
+        return
+
+    runs = []
+    for spec in args.configs.split(","):
+        spec = spec.strip()
+        cmd = [
+            sys.executable, "-m", "benchmarks.worker_pool",
+            "--single", spec,
+            "--requests", str(args.requests),
+            "--max-new-tokens", str(args.max_new_tokens),
+            "--images", *args.images,
+        ]
+        proc = subprocess.run(cmd, capture_output=True, text=True, check=True)
+        runs.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+
+    write_results(args.output, "worker_pool", {"runs": runs})
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,21 @@
+import json
+
+import pytest
+
+pytest.importorskip("torch")
+
+from app.batch import load_done
+
+
+def test_load_done_skips_failed_items_and_cuts_a_partial_line(tmp_path):
+    output = tmp_path / "out.jsonl"
+    records = [
+        {"id": "a.png", "result": "text"},
+        {"id": "b.png", "error": "cannot identify image file"},
+        {"id": "c.png", "result": ""},
+    ]
+    output.write_text("".join(json.dumps(r) + "\n" for r in records) + '{"id": "d.png", "res')
+
+    # Ошибку пробуем снова, пустой ответ — тоже результат
+    assert load_done(output) == {"a.png", "c.png"}
+    assert output.read_text().endswith('"result": ""}\n')
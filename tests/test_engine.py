@@ -0,0 +1,32 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from app.engine import CompiledEngine, pick_bucket
+
+
+def test_pick_bucket_fills_the_largest_bucket_then_the_smallest_that_fits():
+    assert pick_bucket([1, 4, 8], 11) == 8
+    assert pick_bucket([1, 4, 8], 3) == 1
+    assert pick_bucket([4, 8], 3) == 4
+
+
+def test_decoder_shape_classes_follow_dynamo_specialization():
+    shape = CompiledEngine._decoder_shape
+    assert shape({"inputs_embeds": torch.zeros(1, 37, 4)}) == (1, 2)
+    assert shape({"inputs_embeds": torch.zeros(1, 90, 4)}) == (1, 2)
+    assert shape({"input_ids": torch.zeros(3, 1)}) == (2, 1)
+    assert shape({}) is None
+
+
+def test_static_cache_length_is_the_smallest_bucket_that_fits():
+    engine = CompiledEngine.__new__(CompiledEngine)
+    engine.static_cache, engine.cache_buckets = True, [256, 512]
+    ids = torch.zeros(2, 200, dtype=torch.long)
+    assert engine._static_length({"input_ids": ids, "max_new_tokens": 56}) == 256
+    assert engine._static_length({"input_ids": ids, "max_new_tokens": 57}) == 512
+    # Длиннее последней корзины и запросы с префикс-кэшем — на динамическом кэше
+    assert engine._static_length({"input_ids": ids, "max_new_tokens": 400}) is None
+    assert engine._static_length({"input_ids": ids, "max_new_tokens": 8, "past_key_values": object()}) is None
+    engine.static_cache = False
+    assert engine._static_length({"input_ids": ids, "max_new_tokens": 8}) is None
@@ -0,0 +1,73 @@
+import queue
+
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from app.inference import InferenceWorker
+
+
+class Recorder:
+    def __init__(self):
+        self.done = 0
+
+    def task_done(self):
+        self.done += 1
+
+
+def make_worker(analyze_batch):
+    # Без модели: методы анализа подменяются, проверяется только разбор батча
+    worker = InferenceWorker.__new__(InferenceWorker)
+    worker.task_queue = Recorder()
+    worker.result_queue = queue.Queue()
+    worker.analyze_batch = analyze_batch
+    worker.analyze_video = lambda *args, **kwargs: "a video"
+    worker.batch_max_size, worker.batch_max_wait = 8, 0.0
+    return worker
+
+
+def finals(worker):
+    messages = []
+    while not worker.result_queue.empty():
+        messages.append(worker.result_queue.get_nowait())
+    return [(m["id"], m.get("result", m.get("error"))) for m in messages]
+
+
+def test_failed_last_task_of_a_mixed_batch_gets_a_single_error(monkeypatch):
+    def analyze_batch(items, **kwargs):
+        raise RuntimeError("broken image")
+
+    worker = make_worker(analyze_batch)
+    batch = [{"id": 1, "mode": "video", "image_bytes": b""}, {"id": 2, "image_bytes": b""}]
+    monkeypatch.setattr(worker, "_collect_batch", iter([batch, []]).__next__)
+    worker._loop()
+
+    assert finals(worker) == [(1, "a video"), (2, "broken image")]
+    assert worker.task_queue.done == 2
+
+
+def test_service_time_is_recorded_per_part_of_the_batch(monkeypatch):
+    clock = iter([0.0, 30.0, 30.0, 32.0])
+    monkeypatch.setattr("app.inference.time.perf_counter", lambda: next(clock))
+    recorded = []
+    worker = make_worker(lambda items, **kwargs: ["a cat"] * len(items))
+    worker.task_queue.record_service = lambda mode, seconds: recorded.append((mode, seconds))
+
+    worker._run_batch([
+        {"id": 1, "mode": "video", "image_bytes": b""},
+        {"id": 2, "mode": "chat", "image_bytes": b""},
+        {"id": 3, "mode": "chat", "image_bytes": b""},
+    ])
+    # Видео шло 30 с, батч из двух чатов — 2 с
+    assert recorded == [("video", 30.0), ("chat", 1.0), ("chat", 1.0)]
+
+
+def test_preprocessing_error_is_reported_only_for_its_task():
+    worker = make_worker(lambda items, **kwargs: ["a cat"] * len(items))
+    worker._run_batch([
+        {"id": 1, "mode": "video", "image_bytes": b""},
+        {"id": 2, "image_bytes": b"", "prepare_error": ValueError("not an image")},
+        {"id": 3, "image_bytes": b""},
+    ])
+    assert finals(worker) == [(1, "a video"), (2, "not an image"), (3, "a cat")]
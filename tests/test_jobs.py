@@ -0,0 +1,42 @@
+import pytest
+
+pytest.importorskip("torch")
+
+from app import config
+from app.jobs import JobManager, JobStore
+from app.result_broker import ResultBroker
+
+
+class BrokenQueue:
+    def __init__(self):
+        self.calls = 0
+
+    def put(self, task):
+        self.calls += 1
+        raise ConnectionError("broker is down")
+
+
+@pytest.fixture
+def manager(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "JOBS_MAX_ATTEMPTS", 2)
+    store = JobStore(tmp_path / "jobs.db")
+    return JobManager(BrokenQueue(), ResultBroker(ttl_s=60.0), store=store, max_inflight=4)
+
+
+def test_unexpected_queue_error_requeues_the_item_and_counts_the_attempt(manager):
+    job_id = manager.submit([({"prompt": "", "mode": "ocr"}, b"image")])
+    [(_, idx, task, image, attempts)] = manager.store.next_queued(10)
+
+    assert manager._feed(job_id, idx, task, image, attempts) == 1.0
+    assert manager._inflight == {}
+    [(_, _, _, _, attempts)] = manager.store.next_queued(10)
+    assert attempts == 1
+
+    manager._feed(job_id, idx, task, image, attempts)
+    [(_, _, _, _, attempts)] = manager.store.next_queued(10)
+    # Попытки исчерпаны — элемент завершается ошибкой, а не ставится в очередь снова
+    assert manager._feed(job_id, idx, task, image, attempts) is None
+    assert manager.store.next_queued(10) == []
+    assert manager.task_queue.calls == 2
+    [item] = manager.get(job_id)["items"]
+    assert item["status"] == "error" and item["error"] == "Gave up after 2 attempts."
@@ -0,0 +1,19 @@
+import os
+import time
+
+from app.payload import SPOOL_PREFIX, build_image_payload, sweep_spool_dir
+
+
+def test_sweep_removes_only_old_spooled_files(tmp_path, monkeypatch):
+    monkeypatch.setattr("app.config.SPOOL_THRESHOLD_BYTES", 0)
+    old = build_image_payload(b"image", "page.jpg", tmp_path)["image_path"]
+    fresh = build_image_payload(b"image", "page.jpg", tmp_path)["image_path"]
+    foreign = tmp_path / "notes.txt"
+    foreign.write_text("not ours")
+    hour_ago = time.time() - 3600
+    for path in (old, foreign):
+        os.utime(path, (hour_ago, hour_ago))
+
+    assert os.path.basename(old).startswith(SPOOL_PREFIX) and old.endswith(".jpg")
+    assert sweep_spool_dir(tmp_path, max_age=600) == 1
+    assert sorted(p.name for p in tmp_path.iterdir()) == sorted([os.path.basename(fresh), "notes.txt"])
@@ -0,0 +1,155 @@
+import os
+import threading
+
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from app import config
+from app.response_cache import ResponseCache, model_revision
+from app.result_broker import ResultBroker
+from app.scheduler import PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE, TaskScheduler
+
+
+@pytest.fixture
+def setup(monkeypatch):
+    monkeypatch.setattr(config, "GENERATION_TEMPERATURE", 0.0)
+    broker = ResultBroker(ttl_s=60.0)
+    cache = ResponseCache(broker, max_entries=16, ttl=0, disk_path="")
+    scheduler = TaskScheduler(max_depth=0, num_workers=1, max_wait=0, on_drop=lambda task, reason: broker.incoming.put(
+        {"id": task.get("id"), "error": "Task was cancelled before processing."}
+    ))
+    return broker, cache, scheduler
+
+
+def submit(cache, scheduler, task_id, **task):
+    return cache.submit(scheduler, {"id": task_id, "prompt": "What is it?", "mode": "chat", **task}, b"image")
+
+
+def test_follower_is_promoted_when_the_leader_is_cancelled(setup):
+    broker, cache, scheduler = setup
+    assert submit(cache, scheduler, 1) is None
+    assert submit(cache, scheduler, 2) is None
+    assert scheduler.qsize() == 1
+    follower = broker.register(2)
+
+    # Клиент лидера ушёл: его задачу сняли с очереди, on_drop отдал ошибку
+    broker.discard(1)
+    assert scheduler.cancel(1)
+    broker.incoming.join()
+    cache._background.join()
+
+    # Последователь ошибку не получил, его задача встала в очередь сама
+    assert follower.empty()
+    assert scheduler.get_nowait()["id"] == 2
+    broker.incoming.put({"id": 2, "result": "a cat"})
+    assert follower.get(timeout=5) == {"id": 2, "result": "a cat"}
+    assert submit(cache, scheduler, 3) == "a cat"
+
+
+def test_remaining_followers_join_the_promoted_leader(setup):
+    broker, cache, scheduler = setup
+    for task_id in (1, 2, 3):
+        submit(cache, scheduler, task_id)
+    second, third = broker.register(2), broker.register(3)
+    # Лидер упал уже у воркера
+    assert scheduler.get_nowait()["id"] == 1
+    scheduler.task_done()
+    broker.incoming.put({"id": 1, "error": "CUDA out of memory."})
+    broker.incoming.join()
+    cache._background.join()
+
+    assert scheduler.qsize() == 1
+    assert scheduler.get_nowait()["id"] == 2
+    broker.incoming.put({"id": 2, "result": "a cat"})
+    assert second.get(timeout=5)["result"] == "a cat"
+    assert third.get(timeout=5) == {"id": 3, "result": "a cat"}
+
+
+def test_followers_get_the_error_when_the_queue_refuses_the_new_leader(setup):
+    broker, cache, scheduler = setup
+    submit(cache, scheduler, 1)
+    submit(cache, scheduler, 2)
+    follower = broker.register(2)
+    # Лидер ещё в очереди и занимает единственное место
+    scheduler.max_depth = 1
+    broker.incoming.put({"id": 1, "error": "boom"})
+    assert follower.get(timeout=5) == {"id": 2, "error": "boom"}
+
+
+def test_followers_whose_clients_left_are_not_promoted(setup):
+    broker, cache, scheduler = setup
+    for task_id in (1, 2, 3):
+        submit(cache, scheduler, task_id)
+    third = broker.register(3)
+    assert scheduler.get_nowait()["id"] == 1
+    scheduler.task_done()
+    # Клиент второго отключился раньше, чем упал лидер
+    broker.discard(2)
+    broker.incoming.put({"id": 1, "error": "boom"})
+    broker.incoming.join()
+    cache._background.join()
+
+    assert scheduler.qsize() == 1
+    assert scheduler.get_nowait()["id"] == 3
+    broker.incoming.put({"id": 3, "result": "a cat"})
+    assert third.get(timeout=5) == {"id": 3, "result": "a cat"}
+
+
+def test_promotion_does_not_hold_up_result_delivery(setup):
+    broker, cache, _ = setup
+    release = threading.Event()
+
+    class SlowQueue:
+        # Очередь на другом узле: постановка нового лидера ждёт сеть
+        def put(self, task):
+            if task["id"] == 2:
+                release.wait(5)
+
+    slow = SlowQueue()
+    submit(cache, slow, 1)
+    submit(cache, slow, 2)
+    broker.register(2)
+    other = broker.register(9)
+    broker.incoming.put({"id": 1, "error": "boom"})
+    broker.incoming.put({"id": 9, "result": "a dog"})
+    try:
+        assert other.get(timeout=2) == {"id": 9, "result": "a dog"}
+    finally:
+        release.set()
+
+
+def test_interactive_request_does_not_join_a_background_leader(setup):
+    broker, cache, scheduler = setup
+    submit(cache, scheduler, 1, priority=PRIORITY_BACKGROUND)
+    submit(cache, scheduler, 2, priority=PRIORITY_INTERACTIVE)
+    submit(cache, scheduler, 3, priority=PRIORITY_INTERACTIVE)
+
+    # Интерактивный запрос встал в очередь сам и обгоняет фоновый; третий присоединился ко второму
+    assert scheduler.qsize() == 2
+    assert scheduler.get_nowait()["id"] == 2
+    third = broker.register(3)
+    broker.incoming.put({"id": 2, "result": "a cat"})
+    assert third.get(timeout=5) == {"id": 3, "result": "a cat"}
+    # Готовый ответ общий для всех приоритетов
+    assert submit(cache, scheduler, 4, priority=PRIORITY_BACKGROUND) == "a cat"
+
+
+def test_key_changes_with_the_weights_and_the_runtime_settings(tmp_path, monkeypatch):
+    model = tmp_path / "model"
+    model.mkdir()
+    (model / "config.json").write_text("{}")
+
+    def key():
+        model_revision.cache_clear()
+        return ResponseCache.make_key(b"image", "", "ocr", model_id=str(model))
+
+    keys = {key()}
+    for name, value in (("QUANT", "int8-dynamic"), ("ENGINE", "compiled"), ("DRAFT_MODEL_ID", "draft")):
+        monkeypatch.setattr(config, name, value)
+        keys.add(key())
+    # Веса обновили на месте
+    os.utime(model / "config.json", ns=(0, 0))
+    keys.add(key())
+    assert len(keys) == 5
@@ -0,0 +1,139 @@
+import asyncio
+import math
+import threading
+
+from app.result_broker import ResultBroker, new_task_id
+
+
+def make_broker(ttl_s=60.0, shards=4):
+    return ResultBroker(ttl_s=ttl_s, shards=shards)
+
+
+def test_task_ids_are_unique_across_threads():
+    ids = []
+    lock = threading.Lock()
+
+    def take():
+        batch = [new_task_id() for _ in range(5000)]
+        with lock:
+            ids.extend(batch)
+
+    threads = [threading.Thread(target=take) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(set(ids)) == len(ids)
+    assert all(0 < task_id < 2**53 for task_id in ids)
+
+
+def test_result_before_register_is_held_until_the_caller_arrives():
+    broker = make_broker()
+    broker._deliver(1, {"id": 1, "result": "late"})
+    assert broker.stats()["pending"] == 1
+    waiter = broker.register(1)
+    assert waiter.get_nowait() == {"id": 1, "result": "late"}
+    assert broker.stats() == {"waiters": 0, "pending": 0, "tombstones": 0}
+
+
+def test_stream_gets_deltas_in_order_and_plain_waiter_only_the_final():
+    broker = make_broker()
+    stream = broker.register_stream(1)
+    plain = broker.register(2)
+    for task_id in (1, 2):
+        broker._deliver(task_id, {"id": task_id, "delta": "a"})
+        broker._deliver(task_id, {"id": task_id, "delta": "b"})
+        broker._deliver(task_id, {"id": task_id, "result": "ab"})
+    assert [stream.get_nowait() for _ in range(3)] == [
+        {"id": 1, "delta": "a"},
+        {"id": 1, "delta": "b"},
+        {"id": 1, "result": "ab"},
+    ]
+    assert plain.get_nowait() == {"id": 2, "result": "ab"}
+    assert plain.empty()
+
+
+def test_pending_deltas_are_replayed_to_a_late_stream():
+    broker = make_broker()
+    broker._deliver(1, {"id": 1, "delta": "a"})
+    broker._deliver(1, {"id": 1, "result": "a"})
+    stream = broker.register_stream(1)
+    assert [stream.get_nowait() for _ in range(2)] == [{"id": 1, "delta": "a"}, {"id": 1, "result": "a"}]
+
+
+def test_discarded_task_drops_late_results_and_forgets_the_tombstone():
+    broker = make_broker()
+    broker.register(1)
+    broker.discard(1)
+    broker._deliver(1, {"id": 1, "delta": "x"})
+    assert broker.stats() == {"waiters": 0, "pending": 0, "tombstones": 1}
+    broker._deliver(1, {"id": 1, "result": "x"})
+    assert broker.stats() == {"waiters": 0, "pending": 0, "tombstones": 0}
+
+
+def test_reap_expires_waiters_with_an_error_and_drops_old_results():
+    broker = make_broker(ttl_s=10.0)
+    waiter = broker.register(1)
+    broker._deliver(2, {"id": 2, "result": "nobody"})
+    broker.discard(3)
+    now = broker._shard(1).waiters[1][2]
+
+    assert broker.reap(now - 1) == {"waiters": 0, "pending": 0, "tombstones": 0}
+    reaped = broker.reap(now + 1)
+    assert reaped == {"waiters": 1, "pending": 1, "tombstones": 1}
+    assert waiter.get_nowait() == {"id": 1, "error": "Result expired in the broker."}
+    # Поздний результат по просроченному ожидающему выбрасывается, а не копится в pending
+    broker._deliver(1, {"id": 1, "result": "too late"})
+    assert broker.stats()["pending"] == 0
+
+
+def test_reap_stops_at_the_first_live_entry_of_each_shard(monkeypatch):
+    clock = [100.0]
+    monkeypatch.setattr("app.result_broker.time.monotonic", lambda: clock[0])
+    broker = make_broker(ttl_s=10.0, shards=1)
+    broker.register(1)
+    clock[0] = 105.0
+    broker.register(2)
+    # Порядок вставки совпадает с порядком истечения: 1 истекает в 110, 2 — в 115
+    assert broker.reap(112.0)["waiters"] == 1
+    assert list(broker._shard(2).waiters) == [2]
+    assert broker.reap(116.0)["waiters"] == 1
+
+
+def test_register_callback_gets_only_the_final_message():
+    broker = make_broker()
+    seen = []
+    broker.register_callback(1, seen.append)
+    broker._deliver(1, {"id": 1, "delta": "a"})
+    broker._deliver(1, {"id": 1, "result": "a"})
+    assert seen == [{"id": 1, "result": "a"}]
+
+
+def test_callback_without_ttl_outlives_the_reaper():
+    broker = make_broker(ttl_s=10.0, shards=1)
+    seen = []
+    broker.register_callback(1, seen.append, ttl=math.inf)
+    short = broker.register(2)
+    # Бессрочный ожидающий в начале не мешает истечь тем, кто за ним
+    assert broker.reap(broker._shard(2).waiters[2][2] + 1)["waiters"] == 1
+    assert short.get_nowait()["error"] == "Result expired in the broker."
+    broker._deliver(1, {"id": 1, "result": "late"})
+    assert seen == [{"id": 1, "result": "late"}]
+
+
+def test_async_waiters_resolve_from_the_delivery_thread():
+    broker = make_broker()
+
+    async def main():
+        future = broker.register_async(1)
+        stream = broker.register_stream_async(2)
+        broker.incoming.put({"id": 1, "result": "one"})
+        broker.incoming.put({"id": 2, "delta": "t"})
+        broker.incoming.put({"id": 2, "result": "two"})
+        result = await asyncio.wait_for(future, 5)
+        messages = [await asyncio.wait_for(stream.get(), 5) for _ in range(2)]
+        return result, messages
+
+    result, messages = asyncio.run(main())
+    assert result == {"id": 1, "result": "one"}
+    assert messages == [{"id": 2, "delta": "t"}, {"id": 2, "result": "two"}]
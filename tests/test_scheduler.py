@@ -0,0 +1,132 @@
+import queue
+import threading
+import time
+
+import pytest
+
+from app.scheduler import PRIORITY_BACKGROUND, PRIORITY_BATCH, PRIORITY_INTERACTIVE, QueueFullError, TaskScheduler
+
+
+def make_scheduler(**kwargs):
+    dropped = []
+    kwargs.setdefault("max_depth", 0)
+    kwargs.setdefault("num_workers", 1)
+    kwargs.setdefault("max_wait", 0)
+    scheduler = TaskScheduler(on_drop=lambda task, reason: dropped.append((task["id"], reason)), **kwargs)
+    return scheduler, dropped
+
+
+def task(task_id, priority=PRIORITY_BATCH, mode="chat", **extra):
+    return {"id": task_id, "priority": priority, "mode": mode, **extra}
+
+
+def test_higher_priority_first_then_fifo():
+    scheduler, _ = make_scheduler()
+    scheduler.put(task(1, PRIORITY_BACKGROUND))
+    scheduler.put(task(2))
+    scheduler.put(task(3, PRIORITY_INTERACTIVE))
+    scheduler.put(task(4))
+    assert [scheduler.get_nowait()["id"] for _ in range(4)] == [3, 2, 4, 1]
+    with pytest.raises(queue.Empty):
+        scheduler.get_nowait()
+
+
+def test_cancel_accounts_for_the_task_and_reports_the_drop():
+    scheduler, dropped = make_scheduler()
+    scheduler.put(task(1))
+    scheduler.put(task(2))
+    assert scheduler.cancel(1)
+    assert not scheduler.cancel(1)
+    assert dropped == [(1, "cancelled")]
+    assert scheduler.qsize() == 1
+    assert scheduler.get_nowait()["id"] == 2
+    assert not scheduler.idle()
+    scheduler.task_done()
+    assert scheduler.idle()
+
+
+def test_expired_tasks_are_dropped_on_get():
+    scheduler, dropped = make_scheduler()
+    scheduler.put(task(1, deadline=time.time() - 1))
+    scheduler.put(task(2, deadline=None))
+    assert scheduler.get_nowait()["id"] == 2
+    assert dropped == [(1, "expired")]
+    scheduler.task_done()
+    assert scheduler.idle()
+
+
+def test_join_waits_for_task_done():
+    scheduler, _ = make_scheduler()
+    scheduler.put(task(1))
+    scheduler.get_nowait()
+    finished = threading.Event()
+
+    def wait():
+        scheduler.join()
+        finished.set()
+
+    threading.Thread(target=wait, daemon=True).start()
+    assert not finished.wait(0.1)
+    scheduler.task_done()
+    assert finished.wait(2)
+
+
+def test_blocking_get_wakes_up_on_put():
+    scheduler, _ = make_scheduler()
+    threading.Timer(0.05, scheduler.put, args=(task(1),)).start()
+    assert scheduler.get(timeout=2)["id"] == 1
+    with pytest.raises(queue.Empty):
+        scheduler.get(timeout=0.05)
+
+
+def test_full_queue_rejects_with_retry_after():
+    scheduler, _ = make_scheduler(max_depth=1)
+    scheduler.put(task(1))
+    with pytest.raises(QueueFullError) as error:
+        scheduler.put(task(2))
+    assert error.value.retry_after_header == "5"
+
+
+def test_lower_priority_tasks_do_not_fill_the_queue_for_higher_ones():
+    scheduler, _ = make_scheduler(max_depth=2)
+    scheduler.put(task(1, PRIORITY_BACKGROUND))
+    scheduler.put(task(2, PRIORITY_BACKGROUND))
+    with pytest.raises(QueueFullError):
+        scheduler.put(task(3, PRIORITY_BACKGROUND))
+    scheduler.put(task(4, PRIORITY_INTERACTIVE))
+    scheduler.put(task(5, PRIORITY_INTERACTIVE))
+    with pytest.raises(QueueFullError):
+        scheduler.put(task(6, PRIORITY_INTERACTIVE))
+    # Для фоновых места по-прежнему нет: впереди уже четыре задачи
+    with pytest.raises(QueueFullError):
+        scheduler.put(task(7, PRIORITY_BACKGROUND))
+
+
+def test_slow_queue_rejects_when_the_estimated_wait_is_too_long():
+    scheduler, _ = make_scheduler(max_wait=8)
+    scheduler.record_service("chat", 5.0)
+    scheduler.put(task(1))
+    scheduler.put(task(2))
+    with pytest.raises(QueueFullError, match="Estimated wait"):
+        scheduler.put(task(3))
+    # Интерактивной задаче фоновые впереди не стоят
+    scheduler.put(task(4, PRIORITY_INTERACTIVE))
+
+
+def test_position_and_eta_follow_priority_order():
+    scheduler, _ = make_scheduler(num_workers=2)
+    scheduler.record_service("chat", 4.0)
+    scheduler.record_service("ocr", 2.0)
+    scheduler.put(task(1))
+    scheduler.put(task(2, mode="ocr"))
+    scheduler.put(task(3, PRIORITY_INTERACTIVE))
+    assert scheduler.position(3) == {"position": 0, "eta_s": 4.0}
+    assert scheduler.position(2) == {"position": 2, "eta_s": (4.0 + 4.0) / 2 + 2.0}
+    assert scheduler.position(99) is None
+
+
+def test_service_time_is_a_moving_average():
+    scheduler, _ = make_scheduler()
+    scheduler.record_service("chat", 10.0)
+    scheduler.record_service("chat", 0.0)
+    assert scheduler.service_time("chat") == pytest.approx(8.0)
@@ -0,0 +1,39 @@
+import pytest
+
+pytest.importorskip("torch")
+
+from app.snapshot import save_snapshot, snapshot_exists
+
+
+class FakeModel:
+    def __init__(self, on_save=None):
+        self.on_save = on_save
+
+    def save_pretrained(self, path, safe_serialization=True):
+        (path / "config.json").write_text("{}")
+        (path / "model.safetensors").write_bytes(b"weights")
+        if self.on_save is not None:
+            self.on_save()
+
+
+class FakeProcessor:
+    def save_pretrained(self, path):
+        (path / "tokenizer.json").write_text("{}")
+
+
+def test_save_snapshot_writes_through_a_private_temp_dir(tmp_path):
+    path = tmp_path / "snapshots" / "model-bfloat16"
+    assert save_snapshot(FakeModel(), FakeProcessor(), path)
+    assert snapshot_exists(path)
+    assert [p.name for p in path.parent.iterdir()] == [path.name]
+
+
+def test_losing_the_rename_race_to_another_pod_is_success(tmp_path):
+    path = tmp_path / "model-bfloat16"
+
+    def other_pod_finishes_first():
+        assert save_snapshot(FakeModel(), FakeProcessor(), path)
+
+    assert save_snapshot(FakeModel(on_save=other_pod_finishes_first), FakeProcessor(), path)
+    assert snapshot_exists(path)
+    assert [p.name for p in tmp_path.iterdir()] == [path.name]
@@ -0,0 +1,33 @@
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from app.stopping import cut_at_stop, find_loop, loop_start
+
+
+def test_repeated_tail_is_a_loop():
+    tokens = [1, 2, 3] + [7, 8] * 10
+    assert find_loop(tokens, max_period=4, min_span=12) == 2
+    assert loop_start(tokens, 2) == 3
+
+
+def test_short_repetition_is_not_a_loop():
+    # Строка точек в таблице: повторов мало для min_span
+    assert find_loop([1, 2] + [5] * 6, max_period=4, min_span=12) is None
+
+
+def test_at_least_three_repeats_are_needed():
+    assert find_loop([4, 5, 6, 4, 5, 6], max_period=3, min_span=1) is None
+    assert find_loop([4, 5, 6] * 3, max_period=3, min_span=1) == 3
+
+
+def test_period_above_the_limit_is_ignored():
+    tokens = list(range(6)) * 4
+    assert find_loop(tokens, max_period=5, min_span=12) is None
+    assert find_loop(tokens, max_period=6, min_span=12) == 6
+
+
+def test_cut_at_the_earliest_stop_string():
+    assert cut_at_stop("answer\nUser: next\nAssistant:", ["\nAssistant:", "\nUser:"]) == "answer"
+    assert cut_at_stop("answer", ["", "\nUser:"]) == "answer"
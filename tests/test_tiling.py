@@ -0,0 +1,50 @@
+import pytest
+
+pytest.importorskip("numpy")
+Image = pytest.importorskip("PIL.Image")
+
+from app.tiling import merge_texts, plan_tiles
+
+
+def test_overlapping_lines_are_kept_once_with_the_longer_reading():
+    top = "Invoice 1042\nCustomer: ACME\nShipping address: Main stre"
+    bottom = "Shipping address: Main street\nPayment reference 77"
+    merged = merge_texts([top, bottom], [True])
+    assert merged == "Invoice 1042\nCustomer: ACME\nShipping address: Main street\nPayment reference 77"
+
+
+def test_lines_with_different_numbers_are_not_merged():
+    assert merge_texts(["Item 1\nItem 2", "Item 3\nItem 4"], [True]) == "Item 1\nItem 2\nItem 3\nItem 4"
+
+
+def test_no_dedup_across_a_clean_cut():
+    assert merge_texts(["Total", "Total"], [False]) == "Total\nTotal"
+
+
+def test_empty_strips_are_skipped():
+    assert merge_texts(["", "  \n", "text"], [True, True]) == "text"
+
+
+def draw_lines(height, rows):
+    from PIL import ImageDraw
+
+    image = Image.new("L", (400, height), 255)
+    draw = ImageDraw.Draw(image)
+    for y in rows:
+        draw.rectangle((40, y, 360, y + 12), fill=0)
+    return image.convert("RGB")
+
+
+def test_short_page_is_a_single_tile():
+    image = draw_lines(300, range(40, 260, 30))
+    boxes, overlaps = plan_tiles(image, 512, 0.1, 8)
+    assert len(boxes) == 1 and overlaps == []
+
+
+def test_long_page_is_cut_into_strips_top_to_bottom():
+    image = draw_lines(3000, range(40, 2960, 30))
+    boxes, overlaps = plan_tiles(image, 512, 0.1, 8)
+    assert 2 <= len(boxes) <= 8
+    assert len(overlaps) == len(boxes) - 1
+    assert [box[1] for box in boxes] == sorted(box[1] for box in boxes)
+    assert boxes[0][1] <= 40 and boxes[-1][3] >= 2952
@@ -0,0 +1,126 @@
+import asyncio
+import io
+import socket
+
+import pytest
+
+pytest.importorskip("torch")
+
+from app.transport import (
+    RemoteWorkerQueue,
+    TaskBroker,
+    encode_frame,
+    parse_address,
+    read_frame,
+    read_frame_async,
+    task_frame,
+    task_from_frame,
+)
+
+
+def test_frame_round_trip_with_body():
+    header = {"op": "task", "prompt": "Что на картинке?"}
+    stream = io.BytesIO(encode_frame(header, b"\x89PNG\x00") + encode_frame({"op": "ping"}))
+    assert read_frame(stream) == (header, b"\x89PNG\x00")
+    assert read_frame(stream) == ({"op": "ping"}, b"")
+
+
+def test_truncated_frame_is_a_closed_connection():
+    frame = encode_frame({"op": "task"}, b"12345")
+    with pytest.raises(ConnectionError):
+        read_frame(io.BytesIO(frame[:-1]))
+
+
+def test_oversized_header_is_rejected_before_reading_it():
+    with pytest.raises(ValueError, match="Frame too large"):
+        read_frame(io.BytesIO((2**31).to_bytes(4, "big") + (0).to_bytes(4, "big")))
+
+
+def test_async_reader_matches_the_blocking_one():
+    async def main():
+        reader = asyncio.StreamReader()
+        reader.feed_data(encode_frame({"op": "result", "id": 7}, b"blob"))
+        reader.feed_eof()
+        return await read_frame_async(reader)
+
+    assert asyncio.run(main()) == ({"op": "result", "id": 7}, b"blob")
+
+
+def test_task_frame_sends_the_image_as_body_and_drops_local_fields(tmp_path):
+    path = tmp_path / "page.png"
+    path.write_bytes(b"image")
+    header, blob = task_frame({"id": 1, "prompt": "", "image_path": str(path), "prepared": object()})
+    assert header == {"id": 1, "prompt": ""}
+    assert blob == b"image"
+    assert task_from_frame(header, blob) == {"id": 1, "prompt": "", "image_bytes": b"image"}
+
+
+def test_parse_address():
+    assert parse_address("tcp://10.0.0.5:7000") == ("10.0.0.5", 7000)
+    assert parse_address("broker:7000") == ("broker", 7000)
+    with pytest.raises(ValueError):
+        parse_address("http://broker:7000")
+    with pytest.raises(ValueError):
+        parse_address("tcp://broker")
+
+
+def _hello_and_ask_stats(address, token):
+    with socket.create_connection(address, timeout=5) as sock:
+        stream = sock.makefile("rb")
+        sock.sendall(encode_frame({"op": "hello", "role": "frontend", "id": "f1", "token": token}))
+        sock.sendall(encode_frame({"op": "stats", "req": 1}))
+        return read_frame(stream)[0]
+
+
+def test_broker_drops_peers_with_a_wrong_token():
+    broker = TaskBroker(port=0, token="secret")
+    address = parse_address(broker.start_in_thread())
+    assert _hello_and_ask_stats(address, "secret")["req"] == 1
+    with pytest.raises(ConnectionError):
+        _hello_and_ask_stats(address, "guess")
+
+
+def test_broker_refuses_other_hosts_without_a_token():
+    with pytest.raises(ValueError):
+        asyncio.run(TaskBroker(host="0.0.0.0", port=0, token="").start())
+
+
+def test_worker_hello_announces_only_free_slots_after_a_reconnect():
+    # Не подключаемся: кадры и обрыв соединения подаём вручную
+    worker = RemoteWorkerQueue("tcp://127.0.0.1:1", prefetch=4)
+    assert worker._hello()["credits"] == 4
+    for task_id in (1, 2, 3):
+        worker._on_frame({"op": "task", "task": {"id": task_id}}, b"")
+    worker.get()
+    worker.get()
+
+    # Обрыв: невзятая задача брокер вернёт в очередь, две взятые ещё считаются
+    worker._drop_prefetched()
+    assert worker._hello()["credits"] == 2
+    # Их task_done() вернут места уже новому соединению
+    worker.task_done()
+    assert worker._hello()["credits"] == 3
+
+
+def test_tasks_of_a_dropped_connection_are_neither_run_nor_reported():
+    from app.inference import InferenceWorker
+
+    worker = RemoteWorkerQueue("tcp://127.0.0.1:1", prefetch=4)
+    sent = []
+    worker._conn.send = lambda header, blob=b"": sent.append(header)
+    for task_id in (1, 2):
+        worker._on_frame({"op": "task", "task": {"id": task_id}}, b"")
+    running, prepared = worker.get(), worker.get()
+
+    # Обрыв: задача 1 уже у модели, задача 2 ждёт в очереди предобработанных
+    worker._drop_prefetched()
+    worker._on_frame({"op": "task", "task": {"id": 3}}, b"")
+    inference = InferenceWorker.__new__(InferenceWorker)
+    inference.task_queue = worker
+    assert inference._drop_abandoned([prepared, worker.get()]) == [{"id": 3}]
+
+    worker.results.put({"id": 1, "delta": "a"})
+    worker.results.put({"id": 1, "result": "stale"})
+    worker.results.put({"id": 3, "result": "fresh"})
+    assert [h for h in sent if h["op"] == "result"] == [{"op": "result", "message": {"id": 3, "result": "fresh"}}]
+    assert worker._owned == {}
@@ -0,0 +1,85 @@
+import queue
+import time
+
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from app import preprocess
+from app.preprocess import Preprocessor
+from app.router import ModelRouter
+from app.scheduler import TaskScheduler
+
+
+class FakeWorker:
+    created = []
+
+    def __init__(self):
+        self.stopping = False
+        self.leftover = []
+        FakeWorker.created.append(self)
+
+    def start(self, warmup=False):
+        pass
+
+    def begin_stop(self):
+        self.stopping = True
+
+    def stop(self):
+        return self.leftover
+
+
+@pytest.fixture
+def router(monkeypatch):
+    FakeWorker.created = []
+    monkeypatch.setattr(ModelRouter, "_create_worker", lambda self, slot: FakeWorker())
+    monkeypatch.setattr("app.router.weight_bytes", lambda worker: 0)
+    return ModelRouter(queue.Queue(), models={"A": "a", "B": "b"}, default="A", idle_unload_s=0)
+
+
+def wait_for(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_task_taken_by_an_unloading_worker_is_requeued_and_reloads_the_model(router):
+    slot = router.slots["B"]
+    router.load("B")
+    old = slot.worker
+    router.put({"id": 1, "model": "B", "prepared": object()})
+    # Предобработчик старого воркера успел взять задачу перед выгрузкой
+    taken = slot.scheduler.get_nowait()
+    old.leftover = [taken]
+
+    with router._lock:
+        victims = [router._detach(slot)]
+    assert old.stopping
+    router._release(victims, "test")
+
+    assert "prepared" not in taken
+    wait_for(lambda: slot.state == "ready")
+    assert slot.worker is not old
+    assert slot.scheduler.get_nowait()["id"] == 1
+    slot.scheduler.task_done()
+    # Учёт сошёлся: модель снова можно выгрузить
+    assert slot.scheduler.idle()
+    assert router.unload("B")
+
+
+def test_preprocessor_stop_returns_every_task_it_took(monkeypatch):
+    monkeypatch.setattr(preprocess, "prepare_task", lambda worker, task: "prepared")
+    source = TaskScheduler(max_depth=0, num_workers=1, max_wait=0)
+    for task_id in range(6):
+        source.put({"id": task_id, "deadline": None})
+    # Модель не читает prepared: в него помещается одна задача, остальные ждут на put()
+    pre = Preprocessor(worker=None, source=source, num_threads=2, max_prepared=1)
+    wait_for(lambda: source.qsize() <= 3)
+    leftover = pre.stop()
+
+    # Никакая задача не пропала: каждая либо вернулась, либо ещё в очереди
+    assert len(leftover) + source.qsize() == 6
+    assert len({task["id"] for task in leftover}) == len(leftover)
+    assert all(thread.is_alive() is False for thread in pre.threads)